@@ -0,0 +1,73 @@
+# coding: utf-8
+"""Benchmark of the import stage checks of the records in
+   ckanext/fisbroker/tests/xml: the cost of check_record() alone, of the
+   whole path of a record through check_record() and, if it is accepted,
+   ckanext-spatial's ISODocument (as in FisbrokerPlugin.import_stage()),
+   and of ISODocument alone (as before check_record() existed).
+
+   python bin/benchmark_iso_values.py [repetitions]
+"""
+
+import os
+import sys
+import timeit
+
+from lxml import etree
+
+from ckanext.fisbroker.iso_values import FisbrokerISOValues, ISO_FIELDS, INFERRED_FIELDS
+from ckanext.fisbroker.plugin import check_record
+
+XML_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                             'ckanext', 'fisbroker', 'tests', 'xml')
+MD_METADATA = '{http://www.isotc211.org/2005/gmd}MD_Metadata'
+
+
+def records():
+    '''Return the names and contents of the ISO records in XML_DIRECTORY.'''
+
+    fixtures = []
+    for filename in sorted(os.listdir(XML_DIRECTORY)):
+        with open(os.path.join(XML_DIRECTORY, filename), 'rb') as f:
+            content = f.read()
+        try:
+            if etree.fromstring(content).tag == MD_METADATA:
+                fixtures.append((filename, content))
+        except etree.XMLSyntaxError:
+            pass
+    return fixtures
+
+
+def accept_path(content, ISODocument):
+    '''Check `content` like the import stage does, and read the full ISO
+       values of accepted records.'''
+
+    if check_record(content) is None:
+        ISODocument(content).read_values()
+
+
+def main(repetitions=200):
+    try:
+        from ckanext.spatial.model import ISODocument
+    except ImportError:
+        ISODocument = None
+
+    print "{:<45} {:>8} {:>12} {:>12} {:>12}".format(
+        'record', 'accepted', 'check', 'accept path', 'spatial')
+    for filename, content in records():
+        timings = [timeit.timeit(lambda: check_record(content), number=repetitions)]
+        if ISODocument:
+            timings.append(timeit.timeit(lambda: accept_path(content, ISODocument),
+                                         number=repetitions))
+            timings.append(timeit.timeit(lambda: ISODocument(content).read_values(),
+                                         number=repetitions))
+            iso_values = ISODocument(content).read_values()
+            fisbroker_values = FisbrokerISOValues(content)
+            for name in list(ISO_FIELDS) + list(INFERRED_FIELDS):
+                if fisbroker_values[name] != iso_values[name]:
+                    print "  {}: {!r} != {!r}".format(name, fisbroker_values[name], iso_values[name])
+        print "{:<45} {:>8} {}".format(filename, check_record(content) is None, " ".join(
+            "{:>9.3f} ms".format(timing * 1000 / repetitions) for timing in timings))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,63 @@
+# coding: utf-8
+"""Benchmark of the de-duplication of resources by URL: the pairwise
+   comparison used before helper.uniq_resources_by_url() normalised each URL
+   only once, and uniq_resources_by_url() with a cold and with a warm
+   ParsedUrlCache. Half of the generated resources are duplicates.
+
+   python bin/benchmark_uniq_resources.py [repetitions]
+"""
+
+import sys
+import timeit
+
+from ckanext.fisbroker.helper import ParsedUrlCache, normalize_url, uniq_resources_by_url
+
+SIZES = [10, 50, 200]
+URL_TEMPLATE = ("https://fbinter.stadt-berlin.de/fb/wfs/data/senstadt/s_{}"
+                "?service=wfs&version=2.0.0&request=GetCapabilities")
+
+
+def resources(size):
+    '''Return `size` resources, half of them with the URL of another one
+       in different case.'''
+
+    urls = [URL_TEMPLATE.format(index) for index in range(size // 2)]
+    urls += [url.replace('GetCapabilities', 'getcapabilities') for url in urls]
+    return [{'url': url} for url in urls]
+
+
+def uniq_resources_pairwise(resources):
+    '''The de-duplication as it was before uniq_resources_by_url() used a
+       ParsedUrlCache: each resource is compared with every resource kept
+       so far, normalising both URLs at each comparison.'''
+
+    uniq_resources = []
+    for resource in resources:
+        unique = True
+        for uniq_resource in uniq_resources:
+            if normalize_url(resource['url']) == normalize_url(uniq_resource['url']):
+                unique = False
+        if unique:
+            uniq_resources.append(resource)
+    return uniq_resources
+
+
+def main(repetitions=20):
+    print "{:>10} {:>12} {:>12} {:>12}".format('resources', 'pairwise', 'cold cache', 'warm cache')
+    for size in SIZES:
+        items = resources(size)
+        assert uniq_resources_pairwise(items) == uniq_resources_by_url(items, ParsedUrlCache())
+        warm_cache = ParsedUrlCache()
+        uniq_resources_by_url(items, warm_cache)
+        timings = [
+            timeit.timeit(lambda: uniq_resources_pairwise(items), number=repetitions),
+            timeit.timeit(lambda: uniq_resources_by_url(items, ParsedUrlCache()),
+                          number=repetitions),
+            timeit.timeit(lambda: uniq_resources_by_url(items, warm_cache), number=repetitions),
+        ]
+        print "{:>10} {}".format(size, " ".join(
+            "{:>9.3f} ms".format(timing * 1000 / repetitions) for timing in timings))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -4,29 +4,35 @@ This module implements the main controller for ckanext-fisbroker.
 """
 
 import datetime
+import itertools
+import json
 import logging
+import time
 
 # from ckan.common import OrderedDict, _, c, request, response, config
 from ckan import model
-from ckan.common import c, request, response
+from ckan.common import c, config, request, response
 import ckan.lib.base as base
 import ckan.lib.helpers as h
-from ckan.model import Package, Session
+from ckan.model import Session
 from ckan.plugins import toolkit
 
-from owslib.csw import CatalogueServiceWeb, namespaces
-from requests.exceptions import RequestException
+from requests.exceptions import RequestException, Timeout
 
 from ckanext.harvest.model import (
     HarvestJob,
     HarvestObject,
     HarvestObjectExtra
 )
+from ckanext.harvest.logic import HarvestJobExists
+from ckanext.harvest.queue import get_fetch_publisher
 
 from ckanext.fisbroker import HARVESTER_ID
 from ckanext.fisbroker.exceptions import (
     ERROR_MESSAGES,
     ERROR_DURING_IMPORT,
+    ERROR_JOB_EXISTS,
+    ERROR_JOB_NOT_FOUND,
     ERROR_MISSING_ID,
     ERROR_NO_CONNECTION,
     ERROR_NO_GUID,
@@ -45,17 +51,29 @@ from ckanext.fisbroker.exceptions import (
     NoConnectionError,
     NotFoundInFisbrokerError,
     FBImportError,
+    ReimportDeferred,
+    ReimportError,
+    ReimportJobExistsError,
+)
+from ckanext.fisbroker.csw_client import (
+    BATCH_SIZE_DEFAULT,
+    FETCH_WORKERS_DEFAULT,
+    QUEUE_SIZE_DEFAULT,
+    BatchedRecordFetcher,
+    RecordFetchPipeline,
 )
 from ckanext.fisbroker.helper import (
-    dataset_was_harvested,
-    harvester_for_package,
-    fisbroker_guid,
     get_fisbroker_source,
     is_reimport_job,
+    package_ids_for_guids,
+    resolve_fisbroker_packages,
 )
 from ckanext.fisbroker.plugin import FisbrokerPlugin
+from ckanext.fisbroker.record_cache import get_record_cache
 
 LOG = logging.getLogger(__name__)
+BROWSER_DEADLINE_DEFAULT = 30
+CHUNK_SIZE_DEFAULT = 20
 
 def get_error_dict(error_code):
     '''Return a dict for an error_code, raise ValueError if code doesn't exist.'''
@@ -66,6 +84,24 @@ def get_error_dict(error_code):
         }
     raise ValueError("No error code {} exists, must be one of {}".format(error_code, ERROR_MESSAGES.keys()))
 
+def accepts_json(accept):
+    '''Return True if the parsed Accept header `accept` includes application/json.'''
+    if hasattr(accept, '_parsed_nonzero'):
+        for element in accept._parsed_nonzero:
+            if element[0] == "application/json":
+                return True
+    return False
+
+def queue_requested():
+    '''Return True if the current reimport request should be queued for the
+       harvest workers instead of being run synchronously, either because of
+       the request's `async` parameter or, without one, because of
+       `ckanext.fisbroker.reimport.async`.'''
+    queue = request.params.get('async')
+    if queue is None:
+        queue = config.get('ckanext.fisbroker.reimport.async', False)
+    return toolkit.asbool(queue)
+
 class FISBrokerController(base.BaseController):
     """
     Main controller class for ckanext-fisbroker.
@@ -81,7 +117,10 @@ class FISBrokerController(base.BaseController):
            the use of a /dataset/{name}/reimport pattern URL).'''
 
         # try to reimport through API
-        response_data = self.reimport(package_id, direct_call=True)
+        deadline = toolkit.asint(config.get('ckanext.fisbroker.reimport.browser_deadline',
+                                            BROWSER_DEADLINE_DEFAULT))
+        response_data = self.reimport(package_id, direct_call=True, queue=queue_requested(),
+                                      deadline=deadline)
         if response_data['success']:
             h.flash_success(response_data['message'])
         else:
@@ -94,13 +133,6 @@ class FISBrokerController(base.BaseController):
         '''Initiate the reimport action through the api (signified by
            the use of an /api/harvest/reimport URL).'''
 
-        def accepts_json(accept):
-            if hasattr(accept, '_parsed_nonzero'):
-                for element in accept._parsed_nonzero:
-                    if element[0] == "application/json":
-                        return True
-            return False
-
         accept = request.accept
         response_code = 400
         response_data = {
@@ -115,35 +147,137 @@ class FISBrokerController(base.BaseController):
             response_data['error'] = get_error_dict(ERROR_MISSING_ID)
             return self._finish(response_code, response_data)
 
-        return self.reimport(package_id)
-
-    def reimport_batch(self, package_ids, context):
-        '''Batch-reimport all packages in `package_ids` from their original
-           harvest source.'''
+        try:
+            deadline = float(request.params.get('deadline', 0))
+        except ValueError:
+            deadline = 0
+        return self.reimport(package_id, queue=queue_requested(), deadline=deadline)
+
+    def reimport_batch_api(self):
+        '''Reimport a list of packages through the api (signified by a POST to
+           an /api/harvest/reimport/batch URL). The request body is a JSON
+           object with the list of package ids, names or FIS-Broker GUIDs
+           under 'ids'. All packages are reimported in a single harvest job,
+           and the outcome of each package is streamed back as a line of JSON
+           as soon as the package is done. If another job of the harvest source
+           is unfinished, nothing is streamed, and the response is an HTTP 409.'''
 
-        ckan_fb_mapping = {}
+        response_data = {
+            "success": False
+        }
+        if request.method != 'POST':
+            response_data['error'] = get_error_dict(ERROR_WRONG_HTTP)
+            response_data['error']['message'] = "Wrong HTTP method, only POST is allowed."
+            return self._finish(405, response_data)
 
-        # first, do checks that can be done without connection to FIS-Broker
-        for package_id in package_ids:
-            package = Package.get(package_id)
+        try:
+            ids = json.loads(request.body or '{}').get('ids')
+        except (ValueError, AttributeError):
+            ids = None
+        if not ids or not isinstance(ids, list):
+            response_data['error'] = get_error_dict(ERROR_MISSING_ID)
+            response_data['error']['message'] = "Missing parameter 'ids'."
+            return self._finish(400, response_data)
+        if not all(isinstance(package_id, basestring) for package_id in ids):
+            response_data['error'] = get_error_dict(ERROR_MISSING_ID)
+            response_data['error']['message'] = "Parameter 'ids' must be a list of strings."
+            return self._finish(400, response_data)
 
-            if not package:
-                raise PackageIdDoesNotExistError(package_id)
+        fb_source = get_fisbroker_source()
+        if not fb_source:
+            response_data['error'] = get_error_dict(ERROR_UNEXPECTED)
+            response_data['error']['message'] = str(NoFBHarvesterDefined())
+            return self._finish(500, response_data)
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': c.user
+        }
+        toolkit.check_access('harvest_job_create', context, {'source_id': fb_source['id']})
+
+        guids = package_ids_for_guids(ids)
+        package_ids = [guids.get(package_id, package_id) for package_id in ids]
+        requested_guids = dict((package_id, guid) for guid, package_id in guids.items())
+
+        # do everything that can fail as a whole before the response is
+        # streamed: the checks that don't need FIS-Broker and the job
+        resolved, errors = resolve_fisbroker_packages(package_ids)
+        failures = [(package_id, self._failure_outcome(errors[package_id].error_code,
+                                                       str(errors[package_id])))
+                    for package_id in package_ids if package_id in errors]
+        job_id = None
+        if resolved:
+            try:
+                job_id = self.create_reimport_job(context).id
+            except ReimportJobExistsError:
+                response_data['error'] = get_error_dict(ERROR_JOB_EXISTS)
+                return self._finish(409, response_data)
+
+        def results():
+            # the response is streamed after the controller has removed the
+            # session, so the session used while streaming is removed here
+            try:
+                outcomes = failures
+                if job_id:
+                    outcomes = itertools.chain(failures, self.iter_reimport_batch(
+                        [package_id for package_id in package_ids if package_id in resolved],
+                        context, job_id=job_id, continue_on_error=True))
+                for package_id, outcome in outcomes:
+                    line = {'package_id': package_id}
+                    if package_id in requested_guids:
+                        line['guid'] = requested_guids[package_id]
+                    line.update(outcome)
+                    yield json.dumps(line) + "\n"
+            finally:
+                if job_id:
+                    self.finish_reimport_job(HarvestJob.get(job_id))
+                Session.remove()
+
+        response.status_int = 200
+        response.headers['Content-Type'] = 'application/x-ndjson;charset=utf-8'
+        return results()
+
+    def reimport_status_api(self):
+        '''Report the progress of a reimport job through the api (signified by
+           the use of an /api/harvest/reimport/status URL).'''
 
-            if not dataset_was_harvested(package):
-                raise PackageNotHarvestedError(package_id)
+        response_data = {
+            "success": False
+        }
+        if not accepts_json(request.accept):
+            response_data['error'] = get_error_dict(ERROR_WRONG_CONTENT_TYPE)
+            return self._finish(400, response_data)
 
-            harvester = harvester_for_package(package)
-            harvester_url = harvester.url
-            harvester_type = harvester.type
-            if not harvester_type == HARVESTER_ID:
-                raise PackageNotHarvestedInFisbrokerError(package_id)
+        job_id = request.params.get('id')
+        if not job_id:
+            response_data['error'] = get_error_dict(ERROR_MISSING_ID)
+            return self._finish(400, response_data)
+
+        harvest_job = HarvestJob.get(job_id)
+        if not harvest_job or not is_reimport_job(harvest_job):
+            response_data['error'] = get_error_dict(ERROR_JOB_NOT_FOUND)
+            response_data['error']['message'] = response_data['error']['message'].format(job_id)
+            return self._finish(404, response_data)
+
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': c.user
+        }
+        toolkit.check_access('harvest_job_show', context, {'id': job_id})
+        response_data = self.reimport_status(harvest_job)
+        response_data['success'] = True
 
-            fb_guid = fisbroker_guid(package)
-            if not fb_guid:
-                raise NoFisbrokerIdError(package_id)
+        return self._finish(200, response_data)
 
-            ckan_fb_mapping[package.id] = fb_guid
+    def create_reimport_job(self, context):
+        '''Create and start a new harvest job for a reimport from the FIS-Broker
+           harvest source. The job is set to Running straight away, so that it
+           isn't sent to the gather queue by `harvester run` like a new harvest
+           job. Without `gather_finished`, it is also not finished by `harvester
+           run`, but must be finished by the caller (see finish_reimport_job()).
+           Raise ReimportJobExistsError if the harvest source has another
+           unfinished job (a harvest or a queued reimport).'''
 
         # get the harvest source for FIS-Broker datasets
         fb_source = get_fisbroker_source()
@@ -152,65 +286,254 @@ class FISBrokerController(base.BaseController):
         source_id = fb_source.get('id', None)
 
         # Create and start a new harvest job
-        job_dict = toolkit.get_action('harvest_job_create')(context, {'source_id': source_id})
+        try:
+            job_dict = toolkit.get_action('harvest_job_create')(context, {'source_id': source_id})
+        except HarvestJobExists:
+            raise ReimportJobExistsError()
         harvest_job = HarvestJob.get(job_dict['id'])
-        harvest_job.gather_started = datetime.datetime.utcnow()
         assert harvest_job
+        harvest_job.status = u'Running'
+        harvest_job.gather_started = datetime.datetime.utcnow()
+        harvest_job.save()
 
-        # instatiate the CSW connector (on the reasonable assumption that harvester_url is
-        # the same for all package_ids)
-        package_id = None
-        reimported_packages = []
-        try:
-            csw = CatalogueServiceWeb(harvester_url)
-            for package_id, fb_guid in ckan_fb_mapping.items():
-                # query connector to get resource document
-                csw.getrecordbyid([fb_guid], outputschema=namespaces['gmd'])
-
-                # show resource document
-                record = csw.records.get(fb_guid, None)
-                if record:
-                    obj = HarvestObject(guid=fb_guid,
-                                        job=harvest_job,
-                                        content=record.xml,
-                                        package_id=package_id,
-                                        extras=[
-                                            HarvestObjectExtra(key='status',value='change'),
-                                            HarvestObjectExtra(key='type',value='reimport'),
-                                        ])
-                    obj.save()
-
-                    assert obj, obj.content
-
-                    harvester = FisbrokerPlugin()
-                    harvester.force_import = True
-                    harvester.import_stage(obj)
-                    rejection_reason = self._dataset_rejected(obj)
-                    if rejection_reason:
-                        raise FBImportError(package_id, rejection_reason)
-
-                    harvester.force_import = False
-                    Session.refresh(obj)
-
-                    reimported_packages.append(record)
+        return harvest_job
 
-                else:
-                    raise NotFoundInFisbrokerError(package_id, fb_guid)
+    def queue_reimport(self, package_ids, context):
+        '''Queue all packages in `package_ids` for reimport by the harvest workers
+           instead of reimporting them in this process. The packages are checked
+           as in reimport_batch(), then a reimport job with one harvest object per
+           package is created and the objects are sent to the fetch queue.
+           Return the job, which is finished by the `harvester run` command once
+           all objects have been fetched and imported (see reimport_status()).'''
+
+        resolved, errors = resolve_fisbroker_packages(package_ids)
+        for package_id in package_ids:
+            if package_id in errors:
+                raise errors[package_id]
+
+        harvest_job = self.create_reimport_job(context)
+        object_ids = []
+        for package_id, package_info in resolved.items():
+            obj = HarvestObject(guid=package_info['fb_guid'],
+                                job=harvest_job,
+                                harvest_source_id=harvest_job.source_id,
+                                package_id=package_id,
+                                extras=[
+                                    HarvestObjectExtra(key='status', value='change'),
+                                    HarvestObjectExtra(key='type', value='reimport'),
+                                ])
+            obj.save()
+            object_ids.append(obj.id)
+
+        # nothing to gather, the job is finished with its last object
+        harvest_job.status = u'Running'
+        harvest_job.gather_finished = datetime.datetime.utcnow()
+        harvest_job.save()
+
+        publisher = get_fetch_publisher()
+        for object_id in object_ids:
+            publisher.send({'harvest_object_id': object_id})
+        publisher.close()
+        LOG.info("queued %d packages for reimport in job %s", len(object_ids), harvest_job.id)
+
+        return harvest_job
+
+    def reimport_status(self, harvest_job):
+        '''Return the progress of the reimport job `harvest_job`: the job status,
+           the number of pending, reimported and failed packages and, under
+           'packages', the outcome of each package as in reimport_batch(). The
+           outcome of a package that hasn't been imported yet is
+           {'success': None, 'state': <state of its harvest object>}.'''
+
+        packages = {}
+        for harvest_object in harvest_job.objects:
+            packages[harvest_object.package_id] = self._object_outcome(harvest_object)
+        outcomes = packages.values()
 
-        except RequestException as error:
-            raise NoConnectionError(package_id, harvester_url, str(error.__class__.__name__))
+        return {
+            'job_id': harvest_job.id,
+            'status': harvest_job.status,
+            'pending': len([outcome for outcome in outcomes if outcome['success'] is None]),
+            'reimported': len([outcome for outcome in outcomes if outcome['success']]),
+            'failed': len([outcome for outcome in outcomes if outcome['success'] is False]),
+            'packages': packages,
+        }
 
+    def finish_reimport_job(self, harvest_job):
+        '''Successfully finish the reimport job `harvest_job`.'''
 
-        # successfully finish harvest job
         harvest_job.status = u'Finished'
         harvest_job.finished = datetime.datetime.utcnow()
         harvest_job.save()
 
+    def reimport_batch(self, package_ids, context, job_id=None, outcomes=None, deadline=None):
+        '''Batch-reimport all packages in `package_ids` from their original
+           harvest source. Return the ids of the reimported packages.
+           If `job_id` is given, the packages are reimported in that existing
+           harvest job (see create_reimport_job()), which is left running for
+           the caller to finish, instead of in a new job.
+           By default, the first package that cannot be reimported raises a
+           ReimportError. If a dict is passed as `outcomes`, the reimport
+           continues instead, and the outcome of each package is stored in
+           `outcomes` under its id (as given in `package_ids`, or the package's
+           real id if it was resolved), either as {'success': True} or as
+           {'success': False, 'error': {'code': ..., 'message': ...}}.
+           If a `deadline` (a time.time() value) is given, the packages that
+           can't be reimported before it are queued for the harvest workers (see
+           queue_reimport()). This raises ReimportDeferred or, with `outcomes`,
+           is recorded as {'success': None, 'job_id': <id of the queued job>}.
+           The deadline is ignored if `job_id` is given.'''
+
+        reimported_packages = []
+        for package_id, outcome in self.iter_reimport_batch(
+                package_ids, context, job_id=job_id, continue_on_error=outcomes is not None,
+                deadline=deadline):
+            if outcomes is not None:
+                outcomes[package_id] = outcome
+            if outcome['success']:
+                reimported_packages.append(package_id)
+
         return reimported_packages
 
-    def reimport(self, package_id, direct_call=False, context=None):
+    def iter_reimport_batch(self, package_ids, context, job_id=None, continue_on_error=False,
+                            deadline=None):
+        '''Generate a tuple (package_id, outcome) for each package in
+           `package_ids` as soon as its reimport is done (see reimport_batch()
+           for `job_id`, `deadline` and the outcomes). Packages that fail the
+           checks done before contacting FIS-Broker come first. Unless
+           `continue_on_error` is set, the first package that cannot be
+           reimported raises a ReimportError instead.'''
+
+        if job_id:
+            deadline = None
+
+        # first, do checks that can be done without connection to FIS-Broker
+        resolved, errors = resolve_fisbroker_packages(package_ids)
+        for package_id in package_ids:
+            if package_id in errors:
+                if not continue_on_error:
+                    raise errors[package_id]
+                yield package_id, self._failure_outcome(
+                    errors[package_id].error_code, str(errors[package_id]))
+        if package_ids and not resolved:
+            # nothing left to fetch, don't create an empty job
+            return
+
+        ckan_fb_mapping = {}
+        harvester_url = None
+        harvester_config = None
+        for package_id, package_info in resolved.items():
+            ckan_fb_mapping[package_id] = package_info['fb_guid']
+            harvester_url = package_info['source_url']
+            harvester_config = package_info['source_config']
+
+        if job_id:
+            harvest_job = HarvestJob.get(job_id)
+        else:
+            harvest_job = self.create_reimport_job(context)
+
+        # fetch the records concurrently in batches and import them serially as
+        # they arrive (on the reasonable assumption that harvester_url is the same
+        # for all package_ids)
+        fb_harvester = FisbrokerPlugin()
+        fb_harvester._set_source_config(harvester_config)
+        timeout = fb_harvester.get_timeout()
+        if deadline:
+            # don't wait for a single request for longer than the whole reimport may take
+            timeout = max(1, min(timeout, deadline - time.time()))
+        fetcher = BatchedRecordFetcher(
+            harvester_url,
+            batch_size=toolkit.asint(config.get(
+                'ckanext.fisbroker.reimport.batch_size', BATCH_SIZE_DEFAULT)),
+            timeout=timeout,
+            cache=get_record_cache(),
+            lookup_modified=True
+        )
+        pipeline = RecordFetchPipeline(
+            fetcher,
+            workers=toolkit.asint(config.get(
+                'ckanext.fisbroker.reimport.fetch_workers', FETCH_WORKERS_DEFAULT)),
+            queue_size=toolkit.asint(config.get(
+                'ckanext.fisbroker.reimport.queue_size', QUEUE_SIZE_DEFAULT))
+        )
+        reimported = 0
+        cache_hits = 0
+        done = set()
+        chunk_size = max(1, toolkit.asint(config.get(
+            'ckanext.fisbroker.reimport.chunk_size', CHUNK_SIZE_DEFAULT)))
+        pending = []
+        durations = []
+        records = pipeline.records(ckan_fb_mapping.items(), deadline=deadline)
+        try:
+            for package_id, fb_guid, record_xml, from_cache, error in records:
+                if deadline and (isinstance(error, Timeout) or time.time() > deadline):
+                    break
+                try:
+                    if isinstance(error, RequestException):
+                        raise NoConnectionError(package_id, harvester_url,
+                                                str(error.__class__.__name__))
+                    if error:
+                        if not continue_on_error:
+                            raise error
+                        LOG.error("unexpected error while fetching %s: %s", fb_guid, error)
+                        done.add(package_id)
+                        yield package_id, self._failure_outcome(ERROR_UNEXPECTED, str(error))
+                        continue
+                    if not record_xml:
+                        raise NotFoundInFisbrokerError(package_id, fb_guid)
+                except ReimportError as reimport_error:
+                    if not continue_on_error:
+                        raise
+                    done.add(package_id)
+                    yield package_id, self._failure_outcome(
+                        reimport_error.error_code, str(reimport_error))
+                    continue
+
+                if from_cache:
+                    cache_hits += 1
+                pending.append((package_id, fb_guid, record_xml, from_cache))
+                if len(pending) >= chunk_size:
+                    for package_id, outcome in self._import_records(
+                            fb_harvester, harvest_job, pending, continue_on_error, deadline, durations):
+                        done.add(package_id)
+                        reimported += 1 if outcome['success'] else 0
+                        yield package_id, outcome
+                    if deadline and any(item[0] not in done for item in pending):
+                        break
+                    pending = []
+            else:
+                for package_id, outcome in self._import_records(
+                        fb_harvester, harvest_job, pending, continue_on_error, deadline, durations):
+                    done.add(package_id)
+                    reimported += 1 if outcome['success'] else 0
+                    yield package_id, outcome
+        finally:
+            records.close()
+            # also finish the job if the reimport failed, as it would block the
+            # next reimport otherwise (see create_reimport_job())
+            if not job_id:
+                self.finish_reimport_job(harvest_job)
+        LOG.info("reimported %d packages, %d records from record cache",
+                 reimported, cache_hits)
+
+        deferred = [package_id for package_id in ckan_fb_mapping if package_id not in done]
+        if deferred:
+            # hand the rest over to the harvest workers
+            queued_job = self.queue_reimport(deferred, context)
+            LOG.info("deadline passed, queued %d packages for reimport in job %s",
+                     len(deferred), queued_job.id)
+            if not continue_on_error:
+                raise ReimportDeferred(queued_job.id, deferred)
+            for package_id in deferred:
+                yield package_id, {'success': None, 'job_id': queued_job.id}
+
+    def reimport(self, package_id, direct_call=False, context=None, queue=False, deadline=None):
         '''Reimport package with `package_id` from the original harvest
-           source.'''
+           source. If `queue` is set, the reimport is only queued for the
+           harvest workers (see queue_reimport()), and the response contains
+           the id of the reimport job. If the reimport can't be done within
+           `deadline` seconds, it is handed over to the harvest workers in the
+           same way.'''
 
         if not context:
             context = {
@@ -223,7 +546,19 @@ class FISBrokerController(base.BaseController):
         }
         response_code = 200
         try:
-            self.reimport_batch([package_id], context)
+            if queue:
+                harvest_job = self.queue_reimport([package_id], context)
+            else:
+                self.reimport_batch([package_id], context,
+                                    deadline=time.time() + deadline if deadline else None)
+        except ReimportDeferred as deferred:
+            response_code = 202
+            response_data = {
+                'success': True,
+                'message': "Package re-import is still running in the background.",
+                'job_id': deferred.job_id,
+                'status_url': "/api/harvest/reimport/status?id={}".format(deferred.job_id)
+            }
         except PackageNotHarvestedInFisbrokerError:
             response_code = 422
             response_data['error'] = get_error_dict(ERROR_NOT_HARVESTED_BY_FISBROKER)
@@ -248,20 +583,136 @@ class FISBrokerController(base.BaseController):
             response_data['error'] = get_error_dict(ERROR_NOT_FOUND_IN_CKAN)
             message = response_data['error']['message'].format(error.package_id)
             response_data['error']['message'] = message
+        except ReimportJobExistsError:
+            response_code = 409
+            response_data['error'] = get_error_dict(ERROR_JOB_EXISTS)
         except FBImportError as error:
             response_data['error'] =  get_error_dict(ERROR_DURING_IMPORT)
             message = response_data['error']['message'].format(error.reason)
             response_data['error']['message'] = message
         else:
-            response_data = {
-                'success': True,
-                'message': "Package was successfully re-imported."
-            }
+            if queue:
+                response_code = 202
+                response_data = {
+                    'success': True,
+                    'message': "Package was queued for re-import.",
+                    'job_id': harvest_job.id,
+                    'status_url': "/api/harvest/reimport/status?id={}".format(harvest_job.id)
+                }
+            else:
+                response_data = {
+                    'success': True,
+                    'message': "Package was successfully re-imported."
+                }
 
         response_data['package_id'] = package_id
 
         return self._finish(response_code, response_data, direct_call)
 
+    def _failure_outcome(self, error_code, message):
+        '''Return the outcome of a package that could not be reimported
+           (see reimport_batch()).'''
+
+        return {
+            'success': False,
+            'error': {
+                'code': error_code,
+                'message': message,
+            }
+        }
+
+    def _import_records(self, harvester, harvest_job, records, continue_on_error=False,
+                        deadline=None, durations=None):
+        '''Create the harvest objects in `harvest_job` for all `records` (a list of
+           (package_id, fb_guid, record_xml, from_cache) tuples) with a single
+           commit, then import them one after the other with `harvester`.
+           Generate a tuple (package_id, outcome) for each imported record (see
+           iter_reimport_batch()). The duration of each import is appended to
+           `durations`. If the longest import so far would not be done before
+           `deadline`, stop and delete the harvest objects that weren't
+           imported. The same is done before a rejected record raises an
+           FBImportError (unless `continue_on_error` is set).'''
+
+        if not records:
+            return
+        if durations is None:
+            durations = []
+        objects = []
+        for package_id, fb_guid, record_xml, from_cache in records:
+            extras = [
+                HarvestObjectExtra(key='status', value='change'),
+                HarvestObjectExtra(key='type', value='reimport'),
+            ]
+            if from_cache:
+                extras.append(HarvestObjectExtra(key='record_cache', value='hit'))
+            objects.append(HarvestObject(guid=fb_guid,
+                                         job=harvest_job,
+                                         content=record_xml,
+                                         package_id=package_id,
+                                         extras=extras))
+        Session.add_all(objects)
+        Session.commit()
+
+        harvester.force_import = True
+        try:
+            for index, obj in enumerate(objects):
+                if deadline and time.time() + max(durations or [0]) > deadline:
+                    self._delete_objects(objects[index:])
+                    return
+                started = time.time()
+                harvester.import_stage(obj)
+                durations.append(time.time() - started)
+
+                rejection_reason = self._dataset_rejected(obj)
+                if rejection_reason:
+                    import_error = FBImportError(obj.package_id, rejection_reason)
+                    if not continue_on_error:
+                        self._delete_objects(objects[index + 1:])
+                        raise import_error
+                    yield obj.package_id, self._failure_outcome(
+                        import_error.error_code, str(import_error))
+                else:
+                    yield obj.package_id, {'success': True}
+        finally:
+            harvester.force_import = False
+
+    def _delete_objects(self, harvest_objects):
+        '''Delete the `harvest_objects` of a reimport that weren't imported.'''
+
+        for harvest_object in harvest_objects:
+            Session.delete(harvest_object)
+        Session.commit()
+
+    def _object_outcome(self, harvest_object):
+        '''Return the outcome of the reimport of a queued harvest object
+           (see reimport_status()).'''
+
+        if harvest_object.state not in [u'COMPLETE', u'ERROR']:
+            return {
+                'success': None,
+                'state': harvest_object.state,
+            }
+
+        rejection_reason = self._dataset_rejected(harvest_object)
+        if rejection_reason:
+            return self._failure_outcome(
+                ERROR_DURING_IMPORT, ERROR_MESSAGES[ERROR_DURING_IMPORT].format(rejection_reason))
+        if harvest_object.state == u'COMPLETE':
+            return {'success': True}
+
+        error_code = ERROR_UNEXPECTED
+        for extra in harvest_object.extras:
+            if extra.key == 'reimport_error':
+                error_code = int(extra.value)
+        if error_code == ERROR_NOT_FOUND_IN_FISBROKER:
+            message = ERROR_MESSAGES[error_code].format(harvest_object.guid)
+        elif harvest_object.errors:
+            message = harvest_object.errors[-1].message
+        else:
+            message = ERROR_MESSAGES[error_code]
+
+        return self._failure_outcome(error_code, message)
+
     def _dataset_rejected(self, harvest_object):
         """Look at harvest_object to see if the dataset was rejected during
            import. If rejected, return the reason, if not, return None."""
@@ -0,0 +1,562 @@
+# coding: utf-8
+"""Code for fetching records from the FIS-Broker CSW service."""
+
+from itertools import islice
+import logging
+from Queue import Empty, Queue, Full
+from threading import Event, Lock, Thread
+import time
+
+from lxml import etree
+from owslib.csw import CatalogueServiceWeb, namespaces
+from owslib.ows import ExceptionReport
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout
+from requests.packages.urllib3.util.retry import Retry
+
+LOG = logging.getLogger(__name__)
+FETCH_WORKERS_DEFAULT = 4
+QUEUE_SIZE_DEFAULT = 20
+BATCH_SIZE_DEFAULT = 20
+PAGE_SIZE_DEFAULT = 100
+TIMEOUT_DEFAULT = 20
+CAPABILITIES_TTL_DEFAULT = 3600
+POOL_SIZE_DEFAULT = 10
+MAX_RETRIES_DEFAULT = 3
+BACKOFF_FACTOR_DEFAULT = 0.5
+# all requests we send to the CSW service only read data, so POST requests
+# (GetRecords) are just as safe to retry as GET requests
+RETRY_METHODS = frozenset(['HEAD', 'GET', 'POST'])
+RETRY_STATUS_CODES = frozenset([500, 502, 503, 504])
+# the attributes of CatalogueServiceWeb that are set from the GetCapabilities response
+CAPABILITIES_ATTRIBUTES = [
+    'updateSequence',
+    'identification',
+    'provider',
+    'operations',
+    'constraints',
+    'parameters',
+    'filters',
+    'contents',
+]
+CSW_NAMESPACES = {
+    'csw': namespaces['csw'],
+    'dc': namespaces['dc'],
+    'dct': namespaces['dct'],
+    'gco': namespaces['gco'],
+    'gmd': namespaces['gmd'],
+    'ogc': namespaces['ogc'],
+    'ows': namespaces['ows'],
+}
+_WORKER_DONE = object()
+_PUT_INTERVAL = 0.5
+_SESSION = None
+_SESSION_SETTINGS = {}
+_SESSION_LOCK = Lock()
+
+
+def _build_session(pool_size=POOL_SIZE_DEFAULT, max_retries=MAX_RETRIES_DEFAULT,
+                   backoff_factor=BACKOFF_FACTOR_DEFAULT):
+    '''Build an HTTP session that keeps up to `pool_size` connections alive per
+       host, retries failed connections and 5xx responses up to `max_retries`
+       times with exponential backoff and negotiates gzip/deflate compression.
+       Read timeouts are not retried, callers handle those themselves.'''
+
+    retry = Retry(
+        total=max_retries,
+        read=0,
+        status=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        method_whitelist=RETRY_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def configure_session(pool_size=POOL_SIZE_DEFAULT, max_retries=MAX_RETRIES_DEFAULT,
+                      backoff_factor=BACKOFF_FACTOR_DEFAULT):
+    '''(Re)build the HTTP session shared by the requests to FIS-Broker.'''
+
+    global _SESSION
+
+    settings = {
+        'pool_size': pool_size,
+        'max_retries': max_retries,
+        'backoff_factor': backoff_factor,
+    }
+    session = _build_session(**settings)
+    with _SESSION_LOCK:
+        old_session = _SESSION
+        _SESSION = session
+        _SESSION_SETTINGS.clear()
+        _SESSION_SETTINGS.update(settings)
+    if old_session is not None:
+        old_session.close()
+    return session
+
+
+def reset_session():
+    '''Rebuild the shared HTTP session with the settings of the last call to
+       configure_session(), abandoning the connections of the old session
+       without closing them. To be called in processes forked from the one
+       that built the session, so that they don't share its connections.'''
+
+    global _SESSION
+
+    with _SESSION_LOCK:
+        _SESSION = _build_session(**_SESSION_SETTINGS)
+        return _SESSION
+
+
+def get_session():
+    '''Return the HTTP session shared by the requests to FIS-Broker, building
+       it with the default settings if it hasn't been configured yet.
+       Requests sent by owslib (the GetCapabilities handshake in
+       catalogue_service() and the GetRecords requests of CSWHarvester's
+       gather stage) don't go through this session, as owslib uses requests'
+       module-level functions.'''
+
+    global _SESSION
+
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = _build_session()
+        return _SESSION
+
+
+def split_records(response_content):
+    '''Split the content of a (multi-record) GetRecordById response into
+       the individual ISO records. The response is parsed only once, the
+       records are serialized directly from the parsed tree.
+       Return a dict mapping each record's GUID to its XML.
+       Raise an owslib ExceptionReport if the response is an OWS exception.'''
+
+    root = etree.fromstring(response_content)
+    if root.tag == etree.QName(CSW_NAMESPACES['ows'], 'ExceptionReport'):
+        raise ExceptionReport(etree.ElementTree(root), CSW_NAMESPACES['ows'])
+
+    records = {}
+    for record in root.iterfind('gmd:MD_Metadata', namespaces=CSW_NAMESPACES):
+        guid = record.findtext('gmd:fileIdentifier/gco:CharacterString', namespaces=CSW_NAMESPACES)
+        if guid:
+            records[guid.strip()] = etree.tostring(record)
+        else:
+            LOG.warning("skipping record without fileIdentifier in GetRecordById response")
+
+    return records
+
+
+def _modified_dates(root):
+    '''Return a dict mapping the GUID of each record below `root` to its
+       modification date (None if the record has none).'''
+
+    if root.tag == etree.QName(CSW_NAMESPACES['ows'], 'ExceptionReport'):
+        raise ExceptionReport(etree.ElementTree(root), CSW_NAMESPACES['ows'])
+
+    modified_dates = {}
+    for record in root.iterfind('.//csw:SummaryRecord', namespaces=CSW_NAMESPACES):
+        guid = record.findtext('dc:identifier', namespaces=CSW_NAMESPACES)
+        modified = record.findtext('dct:modified', namespaces=CSW_NAMESPACES)
+        if guid:
+            modified_dates[guid.strip()] = modified.strip() if modified else None
+    for record in root.iterfind('.//gmd:MD_Metadata', namespaces=CSW_NAMESPACES):
+        guid = record.findtext('gmd:fileIdentifier/gco:CharacterString', namespaces=CSW_NAMESPACES)
+        modified = record.findtext('gmd:dateStamp/gco:DateTime', namespaces=CSW_NAMESPACES) or \
+            record.findtext('gmd:dateStamp/gco:Date', namespaces=CSW_NAMESPACES)
+        if guid:
+            modified_dates[guid.strip()] = modified.strip() if modified else None
+
+    return modified_dates
+
+
+def parse_modified_dates(response_content):
+    '''Extract the modification date of each record in a GetRecordById or GetRecords
+       response. Both CSW summary records (`dct:modified`) and ISO records
+       (`gmd:dateStamp`) are understood.
+       Return a dict mapping each record's GUID to its modification date, or to
+       None if the record has no modification date.'''
+
+    return _modified_dates(etree.fromstring(response_content))
+
+
+def _summary_request(start_position, page_size):
+    '''Return a GetRecords request for `page_size` records of the summary
+       element set, which is the smallest element set that includes the
+       modification date, and the Query element of the request.'''
+
+    csw = CSW_NAMESPACES['csw']
+    request = etree.Element(etree.QName(csw, 'GetRecords'), nsmap={
+        'csw': csw,
+        'dc': CSW_NAMESPACES['dc'],
+        'ogc': CSW_NAMESPACES['ogc'],
+    }, attrib={
+        'service': 'CSW',
+        'version': '2.0.2',
+        'resultType': 'results',
+        'outputSchema': csw,
+        'startPosition': str(start_position),
+        'maxRecords': str(page_size),
+    })
+    query = etree.SubElement(request, etree.QName(csw, 'Query'), typeNames='csw:Record')
+    etree.SubElement(query, etree.QName(csw, 'ElementSetName')).text = 'summary'
+    return request, query
+
+
+def _post_request(service_url, request, timeout=TIMEOUT_DEFAULT):
+    '''POST `request` to the CSW service and return the parsed response.'''
+
+    response = get_session().post(
+        service_url, data=etree.tostring(request, xml_declaration=True, encoding='utf-8'),
+        headers={'Content-Type': 'application/xml'}, timeout=timeout)
+    response.raise_for_status()
+    return etree.fromstring(response.content)
+
+
+def iter_modified_dates(service_url, page_size=PAGE_SIZE_DEFAULT, timeout=TIMEOUT_DEFAULT,
+                        cql=None):
+    '''Page through all records of a CSW service with GetRecords requests for the
+       summary element set. Yield one dict mapping GUIDs to modification dates (see
+       parse_modified_dates()) per page.'''
+
+    csw = CSW_NAMESPACES['csw']
+    start_position = 1
+    while True:
+        request, query = _summary_request(start_position, page_size)
+        if cql:
+            constraint = etree.SubElement(query, etree.QName(csw, 'Constraint'), version='1.1.0')
+            etree.SubElement(constraint, etree.QName(csw, 'CqlText')).text = cql
+
+        LOG.debug("GetRecords request (summary) starting at %d", start_position)
+        root = _post_request(service_url, request, timeout)
+        modified_dates = _modified_dates(root)
+        yield modified_dates
+
+        results = root.find('csw:SearchResults', namespaces=CSW_NAMESPACES)
+        if results is None or not modified_dates:
+            break
+        matched = int(results.get('numberOfRecordsMatched', 0))
+        next_record = int(results.get('nextRecord', 0))
+        # stop on servers that don't advance nextRecord, too
+        if next_record == 0 or next_record > matched or next_record <= start_position:
+            break
+        start_position = next_record
+
+
+def get_modified_dates(service_url, guids, timeout=TIMEOUT_DEFAULT):
+    '''Request the modification dates of all `guids` with a single GetRecords
+       request for the summary element set, filtered by identifier. Return a
+       dict mapping GUIDs to modification dates (see parse_modified_dates()).'''
+
+    csw = CSW_NAMESPACES['csw']
+    ogc = CSW_NAMESPACES['ogc']
+    request, query = _summary_request(1, len(guids))
+    constraint = etree.SubElement(query, etree.QName(csw, 'Constraint'), version='1.1.0')
+    parent = etree.SubElement(constraint, etree.QName(ogc, 'Filter'))
+    if len(guids) > 1:
+        parent = etree.SubElement(parent, etree.QName(ogc, 'Or'))
+    for guid in guids:
+        condition = etree.SubElement(parent, etree.QName(ogc, 'PropertyIsEqualTo'))
+        etree.SubElement(condition, etree.QName(ogc, 'PropertyName')).text = 'dc:identifier'
+        etree.SubElement(condition, etree.QName(ogc, 'Literal')).text = guid
+
+    LOG.debug("GetRecords request (summary) for %d records", len(guids))
+    return _modified_dates(_post_request(service_url, request, timeout))
+
+
+class CapabilitiesCache(object):
+    '''A cache of parsed CSW capabilities per service URL. Entries expire
+       after `ttl` seconds, or can be invalidated explicitly.'''
+
+    def __init__(self, ttl=CAPABILITIES_TTL_DEFAULT):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, url):
+        '''Return the cached capabilities for `url` as a dict of
+           CatalogueServiceWeb attributes, or None if there are none or
+           they have expired.'''
+
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            timestamp, capabilities = entry
+            if time.time() - timestamp > self.ttl:
+                del self._entries[url]
+                return None
+            return capabilities
+
+    def put(self, url, csw):
+        '''Cache the capabilities of `csw`, a CatalogueServiceWeb instance that
+           has done the GetCapabilities handshake with `url`.'''
+
+        capabilities = {}
+        for attribute in CAPABILITIES_ATTRIBUTES:
+            if hasattr(csw, attribute):
+                capabilities[attribute] = getattr(csw, attribute)
+        with self._lock:
+            self._entries[url] = (time.time(), capabilities)
+
+    def invalidate(self, url=None):
+        '''Remove the cached capabilities for `url`, or all cached capabilities
+           if `url` is None.'''
+
+        with self._lock:
+            if url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(url, None)
+
+
+CAPABILITIES_CACHE = CapabilitiesCache()
+
+
+def catalogue_service(url, timeout=TIMEOUT_DEFAULT, cache=CAPABILITIES_CACHE):
+    '''Return an owslib CatalogueServiceWeb for `url`. If `cache` has parsed
+       capabilities for `url`, the client is built from those, without the
+       GetCapabilities handshake. Otherwise, the handshake is done and its
+       result is cached.'''
+
+    capabilities = cache.get(url)
+    if capabilities is None:
+        LOG.debug("no cached capabilities for %s, doing GetCapabilities handshake", url)
+        csw = CatalogueServiceWeb(url, timeout=timeout)
+        cache.put(url, csw)
+        return csw
+
+    csw = CatalogueServiceWeb(url, timeout=timeout, skip_caps=True)
+    for attribute, value in capabilities.items():
+        setattr(csw, attribute, value)
+    return csw
+
+
+class BatchedRecordFetcher(object):
+    '''Fetch full ISO records from a CSW service, asking for up to `batch_size`
+       GUIDs per GetRecordById request. Whenever a request times out, the batch
+       is split in half and `batch_size` is reduced accordingly for all
+       subsequent batches.
+       If a `cache` (see ckanext.fisbroker.record_cache) is given, records whose
+       modification date is known (e.g. from a brief gather) are read through
+       the cache, and all fetched records are stored in it with the modification
+       date from their `gmd:dateStamp`, unless it is known. With
+       `lookup_modified`, the unknown modification dates of each batch are
+       requested with a single summary GetRecords request (see
+       get_modified_dates()) before the cache is read. This pays off for
+       batches (as in reimports), but not for single records (as in the fetch
+       stage), where it would cost a second request for every record that
+       isn't cached.'''
+
+    def __init__(self, service_url, batch_size=BATCH_SIZE_DEFAULT, timeout=TIMEOUT_DEFAULT,
+                 cache=None, lookup_modified=False):
+        self.service_url = service_url
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+        self.cache = cache
+        self.lookup_modified = lookup_modified
+
+    def _get_record_by_id(self, guids, output_schema=namespaces['gmd'], element_set='full'):
+        '''Send a single GetRecordById request for all `guids` and return the
+           raw response content.'''
+
+        params = {
+            'service': 'CSW',
+            'version': '2.0.2',
+            'request': 'GetRecordById',
+            'outputSchema': output_schema,
+            'elementSetName': element_set,
+            'id': ','.join(guids),
+        }
+        LOG.debug("GetRecordById request (%s) for %d records", element_set, len(guids))
+        response = get_session().get(self.service_url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def _fetch_records(self, guids):
+        '''Fetch the full records for all `guids` from the CSW service.'''
+
+        try:
+            records = split_records(self._get_record_by_id(guids))
+        except Timeout:
+            if len(guids) == 1:
+                raise
+            half = len(guids) // 2
+            self.batch_size = max(1, min(self.batch_size, half))
+            LOG.warning("GetRecordById request for %d records timed out, reducing batch size to %d",
+                        len(guids), self.batch_size)
+            records = self._fetch_records(guids[:half])
+            records.update(self._fetch_records(guids[half:]))
+        return records
+
+    def _lookup_modified_dates(self, guids):
+        '''Request the modification dates of all `guids` (see
+           get_modified_dates()). Return an empty dict if that fails, so that
+           the records are fetched without the cache.'''
+
+        try:
+            return get_modified_dates(self.service_url, guids, timeout=self.timeout)
+        except Exception as error:
+            LOG.warning("could not get modification dates, bypassing record cache: %s", error)
+            return {}
+
+    def fetch(self, guids, modified=None, cache_hits=None):
+        '''Fetch the records for all `guids` (which should not be more than
+           `batch_size`). Return a dict mapping each GUID to the record's XML,
+           or to None if the record was missing from the response.
+           `modified` can map GUIDs to already known modification dates. Only
+           records with a known (or, with `lookup_modified`, requested)
+           modification date are looked up in the cache.
+           The GUIDs of all records served from the cache are added to the set
+           `cache_hits`, if given.'''
+
+        guids = list(guids)
+        records = {}
+        to_fetch = guids
+        modified_dates = dict(modified or {})
+        if self.cache is not None and guids:
+            unknown = [guid for guid in guids if not modified_dates.get(guid)]
+            if unknown and self.lookup_modified:
+                modified_dates.update(self._lookup_modified_dates(unknown))
+            to_fetch = []
+            for guid in guids:
+                record_xml = None
+                if modified_dates.get(guid):
+                    record_xml = self.cache.get(guid, modified_dates[guid])
+                if record_xml is None:
+                    to_fetch.append(guid)
+                else:
+                    records[guid] = record_xml
+                    if cache_hits is not None:
+                        cache_hits.add(guid)
+            LOG.debug("%d of %d records served from record cache", len(records), len(guids))
+
+        if to_fetch:
+            fetched = self._fetch_records(to_fetch)
+            if self.cache is not None:
+                for guid, record_xml in fetched.items():
+                    modified = modified_dates.get(guid) or \
+                        parse_modified_dates(record_xml).get(guid)
+                    if modified:
+                        self.cache.put(guid, modified, record_xml)
+            records.update(fetched)
+
+        missing = [guid for guid in guids if guid not in records]
+        if missing:
+            LOG.info("%d records missing from GetRecordById response: %s", len(missing), missing)
+        return {guid: records.get(guid) for guid in guids}
+
+
+class RecordFetchPipeline(object):
+    '''Fetch records from a CSW service with a bounded pool of worker threads.
+       Each worker fetches one batch of records at a time using `fetcher` and
+       puts the records into a bounded queue, which the caller drains serially
+       by iterating over `records()`. This way, network latency overlaps with
+       whatever the caller does with each record (e.g., importing it in the DB
+       session), instead of adding to it.
+       The workers never touch the database.'''
+
+    def __init__(self, fetcher, workers=FETCH_WORKERS_DEFAULT, queue_size=QUEUE_SIZE_DEFAULT):
+        self.fetcher = fetcher
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self._pending = None
+        self._lock = Lock()
+        self._stop = Event()
+
+    def _next_batch(self):
+        '''Return the next batch of (package_id, fb_guid) items to fetch, or an
+           empty list if there is nothing left to do. The batch size is taken
+           from the fetcher each time, so that it can shrink during the run.'''
+
+        with self._lock:
+            return list(islice(self._pending, self.fetcher.batch_size))
+
+    def _put(self, results, result):
+        '''Put `result` into the `results` queue. Give up if the consumer has stopped
+           iterating, so that workers don't block forever on a full queue.'''
+
+        while not self._stop.is_set():
+            try:
+                results.put(result, timeout=_PUT_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _work(self, results):
+        '''Worker loop: fetch batches of records until there are no items left.'''
+
+        try:
+            while not self._stop.is_set():
+                batch = self._next_batch()
+                if not batch:
+                    break
+                records = {}
+                cache_hits = set()
+                error = None
+                try:
+                    guids = []
+                    for _, fb_guid in batch:
+                        if fb_guid not in guids:
+                            guids.append(fb_guid)
+                    records = self.fetcher.fetch(guids, cache_hits=cache_hits)
+                except Exception as exc:
+                    error = exc
+                for package_id, fb_guid in batch:
+                    result = (package_id, fb_guid, records.get(fb_guid), fb_guid in cache_hits, error)
+                    if not self._put(results, result):
+                        return
+        finally:
+            self._put(results, _WORKER_DONE)
+
+    def records(self, items, deadline=None):
+        '''Generator yielding a (package_id, fb_guid, record_xml, from_cache, error)
+           tuple for each (package_id, fb_guid) tuple in `items`, in the order in
+           which the fetches complete. `record_xml` is None if FIS-Broker doesn't
+           know `fb_guid`, `from_cache` is True if the record was served from the
+           record cache, `error` is the exception raised while fetching the record,
+           if any.
+           If `deadline` (a time.time() value) is given, the generator stops
+           when it passes, even if not all items have been fetched yet.
+           Closing the generator early stops all workers.'''
+
+        items = list(items)
+        if not items:
+            return
+
+        self._pending = iter(items)
+        self._stop.clear()
+        results = Queue(maxsize=self.queue_size)
+        worker_count = min(self.workers, len(items))
+        LOG.debug("fetching %d records from %s with %d workers ...",
+                  len(items), self.fetcher.service_url, worker_count)
+        for _ in range(worker_count):
+            worker = Thread(target=self._work, args=(results,))
+            worker.setDaemon(True)
+            worker.start()
+
+        try:
+            running = worker_count
+            while running:
+                if deadline is None:
+                    result = results.get()
+                else:
+                    try:
+                        result = results.get(timeout=max(0, deadline - time.time()))
+                    except Empty:
+                        LOG.warning("deadline passed while fetching records from %s",
+                                    self.fetcher.service_url)
+                        return
+                if result is _WORKER_DONE:
+                    running -= 1
+                    continue
+                yield result
+        finally:
+            self._stop.set()
@@ -16,6 +16,8 @@ ERROR_NO_CONNECTION = 8
 ERROR_NO_CONNECTION_PACKAGE = 9
 ERROR_NOT_FOUND_IN_FISBROKER = 10
 ERROR_DURING_IMPORT = 11
+ERROR_JOB_NOT_FOUND = 12
+ERROR_JOB_EXISTS = 13
 ERROR_UNEXPECTED = 20
 
 ERROR_MESSAGES = {
@@ -30,6 +32,8 @@ ERROR_MESSAGES = {
     ERROR_NO_CONNECTION_PACKAGE: "Failed to establish connection to FIS-Broker service at {} ({}) while reimporting package '{}'.",
     ERROR_NOT_FOUND_IN_FISBROKER: "Package could not be re-imported because GUID '{}' was not found on FIS-Broker.",
     ERROR_DURING_IMPORT: "Package could not be re-imported because the FIS-Broker data is no longer valid. Reason: {}. Package will be deactivated.",
+    ERROR_JOB_NOT_FOUND: "Reimport job '{}' does not exist.",
+    ERROR_JOB_EXISTS: "Package could not be re-imported because another job of harvester '{}' is still running. Please try again later.".format(HARVESTER_ID),
     ERROR_UNEXPECTED: "Unexpected error"
 }
 
@@ -39,6 +43,16 @@ class NoFBHarvesterDefined(Exception):
     def __init__(self, msg="No FIS-Broker harvester found, cannot reimport."):
         super(NoFBHarvesterDefined, self).__init__(msg)
 
+class ReimportDeferred(Exception):
+    '''Exception raised when a reimport could not be done before its deadline,
+       and the remaining packages were queued for the harvest workers.'''
+
+    def __init__(self, job_id, package_ids):
+        super(ReimportDeferred, self).__init__(
+            "Reimport of {} packages continues in job {}".format(len(package_ids), job_id))
+        self.job_id = job_id
+        self.package_ids = package_ids
+
 class ReimportError(Exception):
     '''Basic exception for reimporting datasets from FIS-Broker.'''
 
@@ -116,6 +130,17 @@ class NotFoundInFisbrokerError(ReimportError):
 
         self.fb_guid = fb_guid
 
+class ReimportJobExistsError(ReimportError):
+    '''Exception raised when no reimport job can be created, because the
+       FIS-Broker harvest source has another unfinished job.'''
+
+    def __init__(self, package_id=None):
+        super(ReimportJobExistsError, self).__init__(
+            package_id,
+            ERROR_JOB_EXISTS,
+            ERROR_MESSAGES[ERROR_JOB_EXISTS]
+        )
+
 class FBImportError(ReimportError):
     '''Exception raised when a FIS-Broker record could not imported, possibly due
        to being invalid (not marked as open data, no license information etc.).'''
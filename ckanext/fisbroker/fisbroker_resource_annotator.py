@@ -2,9 +2,11 @@
 '''Code for annotating FIS-Broker resource objects.'''
 
 
+import hashlib
+import json
 import logging
-from urlparse import urlparse, parse_qs
-from ckanext.fisbroker.helper import normalize_url
+import re
+from ckanext.fisbroker.helper import PARSED_URLS
 
 LOG = logging.getLogger(__name__)
 FORMAT_WFS = "WFS"
@@ -18,9 +20,139 @@ FUNCTION_WEB_INTERFACE = "web_interface"
 FUNCTION_DOCUMENTATION = "documentation"
 VALID_SERVICE_TYPES = [FORMAT_WFS.lower(), FORMAT_WMS.lower()]
 
+# Rules for classifying resources by their URL, in order of precedence. A rule
+# matches if all of its conditions match:
+#   url: regular expression searched for in the URL
+#   host: network location of the URL
+#   path: regular expression matched against the path of the URL
+#   query: names of parameters that must be in the query string
+# A matching rule either marks the resource as a WFS or WMS `service` (see
+# FISBrokerResourceAnnotator.annotate_service_resource()), or sets the
+# resource's `name`, `description`, `format`, `internal_function`, `weight`
+# and `main`.
+FIS_BROKER_SERVICE_PAGE_RULE = {
+    'host': 'fbinter.stadt-berlin.de',
+    'path': r'^/*fb(/index\.jsp)?/*$',
+    'query': ['loginkey'],
+    'name': "Serviceseite im FIS-Broker",
+    'format': FORMAT_HTML,
+    'internal_function': FUNCTION_WEB_INTERFACE,
+    'weight': 20,
+}
+DEFAULT_RESOURCE_RULES = [
+    {
+        'url': '/feed/',
+        'name': "Atom Feed",
+        'description': "Atom Feed",
+        'format': FORMAT_ATOM,
+        'main': True,
+        'internal_function': FUNCTION_API_ENDPOINT,
+        'weight': 15,
+    },
+    {
+        'url': '/wfs/',
+        'service': FORMAT_WFS,
+    },
+    {
+        'url': '/wms/',
+        'service': FORMAT_WMS,
+    },
+    FIS_BROKER_SERVICE_PAGE_RULE,
+]
+RULE_CONDITIONS = ['url', 'host', 'path', 'query']
+RULE_ATTRIBUTES = ['name', 'description', 'format', 'internal_function', 'weight', 'main']
+
+
+class ResourceRule(object):
+    '''A compiled rule for classifying resources by their URL (see
+       DEFAULT_RESOURCE_RULES).'''
+
+    def __init__(self, spec):
+        unknown = set(spec) - set(RULE_CONDITIONS + RULE_ATTRIBUTES + ['service'])
+        if unknown:
+            raise ValueError("Unknown keys in resource rule: {}".format(', '.join(sorted(unknown))))
+        if not any(key in spec for key in RULE_CONDITIONS):
+            raise ValueError("Resource rule must have at least one of [ {} ].".format(
+                ', '.join(RULE_CONDITIONS)))
+        self.service = spec.get('service')
+        if self.service and self.service.lower() not in VALID_SERVICE_TYPES:
+            raise ValueError("Service must be one of [ {} ], is '{}'.".format(
+                ', '.join(VALID_SERVICE_TYPES), self.service))
+        self.url = re.compile(spec['url']) if 'url' in spec else None
+        self.host = spec.get('host')
+        self.path = re.compile(spec['path']) if 'path' in spec else None
+        self.query = list(spec.get('query', []))
+        self.attributes = dict((key, spec[key]) for key in RULE_ATTRIBUTES if key in spec)
+
+    def matches(self, url):
+        '''Return True if the ParsedUrl `url` matches all conditions of the rule.'''
+
+        if self.url and not self.url.search(url.url):
+            return False
+        if self.host is not None and url.parts.netloc != self.host:
+            return False
+        if self.path and not self.path.match(url.parts.path):
+            return False
+        for parameter in self.query:
+            if parameter not in url.query:
+                return False
+        return True
+
+
+def compile_resource_rules(specs):
+    '''Return a list of ResourceRule objects for the rule dicts in `specs`.'''
+
+    return [ResourceRule(spec) for spec in specs]
+
+
+def resource_rules_digest(specs):
+    '''Return a digest of the rule dicts in `specs`, which changes whenever
+       a rule is added, removed, reordered or changed.'''
+
+    return hashlib.sha1(json.dumps(specs, sort_keys=True)).hexdigest()
+
+_RESOURCE_RULES = compile_resource_rules(DEFAULT_RESOURCE_RULES)
+_FIS_BROKER_SERVICE_PAGE = ResourceRule(FIS_BROKER_SERVICE_PAGE_RULE)
+_RESOURCE_RULES_DIGEST = resource_rules_digest(DEFAULT_RESOURCE_RULES)
+
+
+def configure_resource_rules(path=None):
+    '''Set up the rules used for classifying resources: the rules in the JSON
+       file at `path` (a list of rule dicts, see DEFAULT_RESOURCE_RULES), if
+       given, take precedence over the default rules.'''
+
+    global _RESOURCE_RULES, _RESOURCE_RULES_DIGEST
+
+    specs = []
+    if path:
+        with open(path) as rules_file:
+            specs = json.load(rules_file)
+        LOG.info("using %d additional resource rules from %s", len(specs), path)
+    _RESOURCE_RULES = compile_resource_rules(specs + DEFAULT_RESOURCE_RULES)
+    _RESOURCE_RULES_DIGEST = resource_rules_digest(specs + DEFAULT_RESOURCE_RULES)
+    return _RESOURCE_RULES
+
+
+def get_resource_rules():
+    '''Return the rules used for classifying resources.'''
+
+    return _RESOURCE_RULES
+
+
+def get_resource_rules_digest():
+    '''Return the digest of the rules used for classifying resources (see
+       resource_rules_digest()).'''
+
+    return _RESOURCE_RULES_DIGEST
+
+
 class FISBrokerResourceAnnotator:
     '''A class to assign meaningful metadata to FIS-Broker resource objects from a CKAN
-       package_dict, based on their URLs.'''
+       package_dict, based on their URLs. The resources are classified with `rules`
+       (a list of ResourceRule objects), by default those from get_resource_rules().'''
+
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else get_resource_rules()
 
     @staticmethod
     def getcapabilities_query(service):
@@ -42,22 +174,24 @@ class FISBrokerResourceAnnotator:
         raise ValueError("Service must be one of [ {} ].".format(
             ', '.join(VALID_SERVICE_TYPES)))
 
-    def annotate_service_resource(self, resource):
-        '''Convert wfs and wms service resources.'''
+    def annotate_service_resource(self, resource, service_type=None, url=None):
+        '''Convert wfs and wms service resources. If `service_type` is not given,
+           it is taken from the resource's URL. `url` is the ParsedUrl of the
+           resource's URL, if it has already been parsed.'''
 
-        if "/wfs/" in resource['url']:
-            service_type = FORMAT_WFS
-        elif "/wms/" in resource['url']:
-            service_type = FORMAT_WMS
-        else:
-            raise ValueError("Resource type must be one of [ {} ].".format(
-                ', '.join(VALID_SERVICE_TYPES)))
+        if service_type is None:
+            if "/wfs/" in resource['url']:
+                service_type = FORMAT_WFS
+            elif "/wms/" in resource['url']:
+                service_type = FORMAT_WMS
+            else:
+                raise ValueError("Resource type must be one of [ {} ].".format(
+                    ', '.join(VALID_SERVICE_TYPES)))
 
         resource['name'] = "Unspezifizierter {}-Service".format(service_type)
         resource['description'] = "Unspezifizierter {}-Service".format(service_type)
 
-        parsed = urlparse(resource['url'])
-        query = parse_qs(parsed.query)
+        query = (url or PARSED_URLS.parse(resource['url'])).query
         if not query:
             # this is the service endpoint
             resource['name'] = "API-Endpunkt des {}-Service".format(service_type)
@@ -67,7 +201,7 @@ class FISBrokerResourceAnnotator:
         else:
             method = query.get('request')
             if method:
-                if method.pop().lower() == "getcapabilities":
+                if method[-1].lower() == "getcapabilities":
                     resource['name'] = "Endpunkt-Beschreibung des {}-Service".format(service_type)
                     resource['description'] = "Maschinenlesbare Endpunkt-Beschreibung des {}-Service. Weitere Informationen unter https://www.ogc.org/standards/{}".format(service_type, service_type.lower())
                     resource['main'] = True
@@ -80,36 +214,30 @@ class FISBrokerResourceAnnotator:
 
     def is_fis_broker_service_page(self, url):
         '''Analyzes url to decide whether it is the service's entry page in FIS-Broker.
-           Returns True or False accordingly.'''
+           Returns True or False accordingly. Other web interfaces classified by
+           additional rules don't count.'''
 
-        parsed = urlparse(url)
-        if parsed.netloc == 'fbinter.stadt-berlin.de':
-            if parsed.path.strip('/') == 'fb' or parsed.path.strip('/') == 'fb/index.jsp':
-                if 'loginkey' in parse_qs(parsed.query):
-                    return True
+        return _FIS_BROKER_SERVICE_PAGE.matches(PARSED_URLS.parse(url))
 
-        return False
+    def classify(self, url):
+        '''Return the first rule that matches the ParsedUrl `url`, or None.'''
 
+        for rule in self.rules:
+            if rule.matches(url):
+                return rule
+        return None
 
     def annotate_resource(self, resource):
         '''Assign meaningful metadata to FIS-Broker resource objects from a CKAN package_dict,
            based on their URLs.'''
 
         resource['main'] = False
-        if "/feed/" in resource['url']:
-            resource['name'] = "Atom Feed"
-            resource['description'] = "Atom Feed"
-            resource['format'] = "Atom"
-            resource['main'] = True
-            resource['internal_function'] = FUNCTION_API_ENDPOINT
-            resource['weight'] = 15
-        elif "/wfs/" in resource['url'] or "/wms/" in resource['url']:
-            resource = self.annotate_service_resource(resource)
-        elif self.is_fis_broker_service_page(resource['url']):
-            resource['name'] = "Serviceseite im FIS-Broker"
-            resource['format'] = "HTML"
-            resource['internal_function'] = FUNCTION_WEB_INTERFACE
-            resource['weight'] = 20
+        url = PARSED_URLS.parse(resource['url'])
+        rule = self.classify(url)
+        if rule and rule.service:
+            resource = self.annotate_service_resource(resource, rule.service, url)
+        elif rule:
+            resource.update(rule.attributes)
         elif 'description' in resource:
             if resource['description']:
                 resource['name'] = resource['description']
@@ -142,7 +270,7 @@ class FISBrokerResourceAnnotator:
             if res_format != FORMAT_ATOM:
                 url = '{}?{}'.format(res_dict['api_endpoint']['url'],
                                      FISBrokerResourceAnnotator.getcapabilities_query(res_format.lower()))
-                url = normalize_url(url)
+                url = PARSED_URLS.normalize(url)
                 resource = {
                     'url': url
                 }
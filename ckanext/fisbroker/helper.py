@@ -1,56 +1,185 @@
 # coding: utf-8
 """A collection of helper methods for the CKAN FIS-Broker harvester."""
 
+from collections import OrderedDict
 import logging
+from threading import Lock
 from urlparse import urlparse, urlunparse, parse_qs
 
+from sqlalchemy import or_
+
 from ckan import model
+from ckan.common import c
 from ckan.model.package import Package
 from ckan.plugins import toolkit
 
-from ckanext.harvest.model import HarvestJob
+from ckanext.harvest.model import (
+    HarvestJob,
+    HarvestObject,
+    HarvestObjectExtra,
+    HarvestSource,
+)
 
 from ckanext.fisbroker import HARVESTER_ID
+from ckanext.fisbroker.exceptions import (
+    PackageIdDoesNotExistError,
+    PackageNotHarvestedError,
+    PackageNotHarvestedInFisbrokerError,
+    NoFisbrokerIdError,
+)
+from ckanext.fisbroker.model import FisbrokerPackage
 
 LOG = logging.getLogger(__name__)
+PARSED_URLS_MAX_SIZE = 4096
+
+class ParsedUrl(object):
+    """A URL that is parsed only once. Its components (as returned by
+       urlparse()), its query parameters (as returned by parse_qs()) and its
+       normalized form (see normalize_url()) are computed on first use.
+       The query parameters must not be modified."""
+
+    def __init__(self, url):
+        self.url = url
+        self.parts = urlparse(url)
+        self._query = None
+        self._normalized = None
+
+    @property
+    def query(self):
+        """The query parameters of the URL, as returned by parse_qs()."""
+
+        if self._query is None:
+            self._query = parse_qs(self.parts.query)
+        return self._query
+
+    @property
+    def normalized(self):
+        """The URL with sorted query parameters and lowercased values."""
+
+        if self._normalized is None:
+            normalized_query = []
+            for parameter in sorted(self.query):
+                normalized_query.append("{}={}".format(parameter, self.query[parameter][0].lower()))
+            self._normalized = urlunparse(self.parts._replace(query="&".join(normalized_query)))
+        return self._normalized
 
 def normalize_url(url):
     """Normalize URL by sorting query parameters and lowercasing the values
        (because parameter values are not case sensitive in WMS/WFS)."""
 
-    parsed = urlparse(url)
-    query = parse_qs(parsed.query)
+    if not isinstance(url, ParsedUrl):
+        url = ParsedUrl(url)
+    return url.normalized
+
+class ParsedUrlCache(object):
+    """LRU cache of parsed URLs (see ParsedUrl), so that the same service URLs,
+       which appear in many records of a harvest job, are only parsed once,
+       whether for annotating resources or for normalizing their URLs. Safe to
+       use from several threads."""
 
-    normalized_query = []
-    for parameter in sorted(query):
-        normalized_query.append("{}={}".format(parameter, query[parameter][0].lower()))
+    def __init__(self, max_size=PARSED_URLS_MAX_SIZE):
+        self.max_size = max_size
+        self._urls = OrderedDict()
+        self._lock = Lock()
 
-    return urlunparse(parsed._replace(query="&".join(normalized_query)))
+    def parse(self, url):
+        """Return the ParsedUrl for url, from the cache if possible."""
 
-def uniq_resources_by_url(resources):
+        with self._lock:
+            parsed = self._urls.pop(url, None)
+            if parsed is not None:
+                # re-insert to mark as recently used
+                self._urls[url] = parsed
+                return parsed
+        parsed = ParsedUrl(url)
+        with self._lock:
+            self._urls[url] = parsed
+            while len(self._urls) > self.max_size:
+                self._urls.popitem(last=False)
+        return parsed
+
+    def normalize(self, url):
+        """Return normalize_url(url), from the cache if possible."""
+
+        return self.parse(url).normalized
+
+    def clear(self):
+        """Remove all parsed URLs from the cache."""
+
+        with self._lock:
+            self._urls.clear()
+
+PARSED_URLS = ParsedUrlCache()
+
+def uniq_resources_by_url(resources, cache=PARSED_URLS):
     """Consider resources with the same URL to be identical, remove duplicates
-       by keeping only the first one."""
+       by keeping only the first one. Each URL is normalized once (through
+       `cache`), and the resources are checked in a single pass."""
 
     uniq_resources = []
+    seen = set()
 
     for resource in resources:
-        unique = True
-        for uniq_resource in uniq_resources:
-            if normalize_url(resource['url']) == normalize_url(uniq_resource['url']):
-                unique = False
-        if unique:
+        key = cache.normalize(resource['url'])
+        if key not in seen:
+            seen.add(key)
             uniq_resources.append(resource)
 
     return uniq_resources
 
+def _request_memo():
+    """Return a dict for memoising helper results during the current request,
+       or None if there is no request (e.g., in paster commands)."""
+
+    try:
+        memo = getattr(c, '_fisbroker_helper_memo', None)
+        if memo is None:
+            memo = {}
+            c._fisbroker_helper_memo = memo
+        return memo
+    except (AttributeError, RuntimeError, TypeError):
+        return None
+
+def _harvest_info(package):
+    """Return a (guid, source_id, source_type) tuple describing how package
+       was harvested, or None if it wasn't harvested. The information is read
+       with a single query from the package index (or, for packages not in
+       the index, from the package's current harvest object), and memoised
+       for the rest of the request."""
+
+    memo = _request_memo()
+    if memo is not None and package.id in memo:
+        return memo[package.id]
+
+    row = model.Session.query(
+        FisbrokerPackage.guid,
+        FisbrokerPackage.source_id,
+        FisbrokerPackage.source_type,
+    ).filter(FisbrokerPackage.package_id == package.id).first()
+    if row is None:
+        row = model.Session.query(
+            HarvestObject.guid,
+            HarvestSource.id,
+            HarvestSource.type,
+        ).outerjoin(HarvestSource, HarvestSource.id == HarvestObject.harvest_source_id) \
+         .filter(HarvestObject.package_id == package.id) \
+         .order_by(HarvestObject.current.desc().nullslast(),
+                   HarvestObject.gathered.desc().nullslast()) \
+         .first()
+    info = tuple(row) if row else None
+
+    if memo is not None:
+        memo[package.id] = info
+    return info
+
 def is_fisbroker_package(package):
     """Return True if package was created by the FIS-Broker harvester,
        False if not."""
 
     if package:
-        harvester = harvester_for_package(package)
-        if harvester:
-            return bool(harvester.type == HARVESTER_ID)
+        info = _harvest_info(package)
+        if info:
+            return bool(info[2] == HARVESTER_ID)
     return False
 
 def fisbroker_guid(package):
@@ -58,29 +187,132 @@ def fisbroker_guid(package):
        there is none."""
 
     if package:
-        if dataset_was_harvested(package):
-            harvest_object = package.harvest_objects[0]
-            if hasattr(harvest_object, 'guid'):
-                return harvest_object.guid
+        info = _harvest_info(package)
+        if info:
+            return info[0]
     return None
 
 def dataset_was_harvested(package):
     """Return True if package was harvested by a harvester,
        False if not."""
-    return bool(len(package.harvest_objects) > 0)
+    return _harvest_info(package) is not None
 
 def harvester_for_package(package):
     """Return the harvester object that harvested package, else None."""
-    if dataset_was_harvested(package):
-        harvest_object = package.harvest_objects[0]
-        return harvest_object.source
+    info = _harvest_info(package)
+    if info and info[1]:
+        return HarvestSource.get(info[1])
     return None
 
+def package_ids_for_guids(guids):
+    """Return a dict mapping each of `guids` that is the FIS-Broker GUID of
+       an indexed package to the id of that package."""
+
+    guids = list(guids)
+    if not guids:
+        return {}
+    rows = model.Session.query(FisbrokerPackage.guid, FisbrokerPackage.package_id) \
+        .filter(FisbrokerPackage.guid.in_(guids))
+    return dict(rows)
+
+def resolve_fisbroker_packages(package_ids):
+    """Resolve all `package_ids` (ids or names) to the information needed to
+       reimport them from FIS-Broker, using the package index (see
+       ckanext.fisbroker.model.FisbrokerPackage) instead of loading each
+       package's harvest objects and source one by one. Packages missing from
+       the index are resolved through their harvest objects.
+       Return a tuple (mapping, errors): `mapping` maps the id of each
+       reimportable package to a dict with its FIS-Broker GUID and the id,
+       url and config of its harvest source. `errors` maps each entry of
+       `package_ids` that cannot be reimported to the ReimportError
+       describing why.
+       Packages whose index status is 'deleted' (their record was deleted in
+       FIS-Broker) are resolved as well: the record may have been restored
+       since, and otherwise the reimport reports it as not found in
+       FIS-Broker, as it did before there was an index."""
+
+    package_ids = list(package_ids)
+    mapping = {}
+    errors = {}
+    if not package_ids:
+        return mapping, errors
+
+    # one row per indexed package, with the package's harvest source
+    rows = model.Session.query(
+        Package.id,
+        Package.name,
+        FisbrokerPackage.package_id,
+        FisbrokerPackage.guid,
+        HarvestSource.id,
+        HarvestSource.type,
+        HarvestSource.url,
+        HarvestSource.config,
+    ).join(FisbrokerPackage, FisbrokerPackage.package_id == Package.id) \
+     .outerjoin(HarvestSource, HarvestSource.id == FisbrokerPackage.source_id) \
+     .filter(or_(Package.id.in_(package_ids), Package.name.in_(package_ids)))
+    found = _rows_by_id_and_name(rows)
+
+    missing = [package_id for package_id in package_ids if package_id not in found]
+    if missing:
+        # packages that are not in the index (e.g., harvested by other harvesters):
+        # their current harvest object (if there is none, the most recently
+        # gathered one) and that object's source
+        rows = model.Session.query(
+            Package.id,
+            Package.name,
+            HarvestObject.id,
+            HarvestObject.guid,
+            HarvestSource.id,
+            HarvestSource.type,
+            HarvestSource.url,
+            HarvestSource.config,
+        ).outerjoin(HarvestObject, HarvestObject.package_id == Package.id) \
+         .outerjoin(HarvestSource, HarvestSource.id == HarvestObject.harvest_source_id) \
+         .filter(or_(Package.id.in_(missing), Package.name.in_(missing))) \
+         .distinct(Package.id) \
+         .order_by(Package.id,
+                   HarvestObject.current.desc().nullslast(),
+                   HarvestObject.gathered.desc().nullslast())
+        found.update(_rows_by_id_and_name(rows))
+
+    for package_id in package_ids:
+        row = found.get(package_id)
+        if not row:
+            errors[package_id] = PackageIdDoesNotExistError(package_id)
+            continue
+        _id, _name, object_id, fb_guid, source_id, source_type, source_url, source_config = row
+        if not object_id:
+            errors[package_id] = PackageNotHarvestedError(package_id)
+        elif source_type != HARVESTER_ID:
+            errors[package_id] = PackageNotHarvestedInFisbrokerError(package_id)
+        elif not fb_guid:
+            errors[package_id] = NoFisbrokerIdError(package_id)
+        else:
+            mapping[_id] = {
+                'fb_guid': fb_guid,
+                'source_id': source_id,
+                'source_url': source_url,
+                'source_config': source_config,
+            }
+
+    return mapping, errors
+
+def _rows_by_id_and_name(rows):
+    """Return a dict mapping both the id and the name of the package in each
+       of `rows` to the row."""
+
+    found = {}
+    for row in rows:
+        found[row[0]] = row
+        found[row[1]] = row
+    return found
+
 def get_package_object(package_dict):
     """Return an instance of ckan.model.package.Package for
-       `package_dict` or None if there isn't one."""
+       `package_dict` or None if there isn't one. Looking the package up by id
+       first avoids a query if it is already loaded in the session."""
 
-    return Package.get(package_dict.get('name'))
+    return Package.get(package_dict.get('id') or package_dict.get('name'))
 
 def get_fisbroker_source():
     """Return the HarvestSource object that is responsible for harvesting the FIS-Broker.
@@ -106,3 +338,16 @@ def is_reimport_job(harvest_job):
             if extra.key == 'type' and extra.value == 'reimport':
                 return True
         return False
+
+def record_cache_hits(harvest_job):
+    '''Return the number of records in `harvest_job` (a HarvestJob or, as in
+       the harvest job templates, a dictized job) that were served from the
+       record cache instead of being downloaded from FIS-Broker.'''
+
+    job_id = harvest_job['id'] if isinstance(harvest_job, dict) else harvest_job.id
+    return model.Session.query(HarvestObjectExtra) \
+        .join(HarvestObject, HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+        .filter(HarvestObject.harvest_job_id == job_id) \
+        .filter(HarvestObjectExtra.key == 'record_cache') \
+        .filter(HarvestObjectExtra.value == 'hit') \
+        .count()
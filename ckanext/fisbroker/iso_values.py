@@ -0,0 +1,168 @@
+# coding: utf-8
+"""Extraction of the ISO values used by FisbrokerPlugin from FIS-Broker records."""
+
+from collections import Mapping
+import logging
+
+from lxml import etree
+
+LOG = logging.getLogger(__name__)
+
+NAMESPACES = {
+    'gco': 'http://www.isotc211.org/2005/gco',
+    'gmd': 'http://www.isotc211.org/2005/gmd',
+    'srv': 'http://www.isotc211.org/2005/srv',
+}
+DATA_IDENTIFICATION = 'gmd:identificationInfo/gmd:MD_DataIdentification/'
+SERVICE_IDENTIFICATION = 'gmd:identificationInfo/srv:SV_ServiceIdentification/'
+
+
+class ISOField(object):
+    '''An ISO value, read like ckanext-spatial's ISOElement: the results of the
+       first of `search_paths` that matches anything, reduced according to
+       `multiplicity` (one of '0..1', '1', '*', '1..*'). With `elements`,
+       each result is read into a dict of these sub-fields, by name.
+       The search paths are compiled once, when the field is defined.'''
+
+    def __init__(self, search_paths, multiplicity, elements=None):
+        self.search_paths = [etree.XPath(path, namespaces=NAMESPACES)
+                             for path in search_paths]
+        self.multiplicity = multiplicity
+        self.elements = elements or {}
+
+    def read(self, element):
+        '''Return the value of the field for `element`.'''
+
+        values = []
+        for search_path in self.search_paths:
+            values = [self._value(result) for result in search_path(element)]
+            if values:
+                break
+        if self.multiplicity in ('*', '1..*'):
+            return values
+        return values[0] if values else ''
+
+    def _value(self, result):
+        if self.elements:
+            return {name: field.read(result) for name, field in self.elements.items()}
+        if isinstance(result, unicode):
+            return unicode(result)
+        if isinstance(result, str):
+            return str(result)
+        return etree.tostring(result)
+
+
+def _paths(path):
+    '''Return the search paths for `path` below the data and the service
+       identification.'''
+
+    return [DATA_IDENTIFICATION + path, SERVICE_IDENTIFICATION + path]
+
+
+ONLINE_RESOURCE_FIELDS = {
+    'url': ISOField(['gmd:linkage/gmd:URL/text()'], '0..1'),
+    'function': ISOField(['gmd:function/gmd:CI_OnLineFunctionCode/@codeListValue'], '0..1'),
+    'name': ISOField(['gmd:name/gco:CharacterString/text()'], '0..1'),
+    'description': ISOField(['gmd:description/gco:CharacterString/text()'], '0..1'),
+    'protocol': ISOField(['gmd:protocol/gco:CharacterString/text()'], '0..1'),
+}
+
+RESPONSIBLE_PARTY_FIELDS = {
+    'individual-name': ISOField(['gmd:individualName/gco:CharacterString/text()'], '0..1'),
+    'organisation-name': ISOField(['gmd:organisationName/gco:CharacterString/text()'], '0..1'),
+    'position-name': ISOField(['gmd:positionName/gco:CharacterString/text()'], '0..1'),
+    'contact-info': ISOField(['gmd:contactInfo/gmd:CI_Contact'], '0..1', elements={
+        'email': ISOField([
+            'gmd:address/gmd:CI_Address/gmd:electronicMailAddress/gco:CharacterString/text()'
+        ], '0..1'),
+        'online-resource': ISOField(['gmd:onlineResource/gmd:CI_OnlineResource'], '0..1',
+                                    elements=ONLINE_RESOURCE_FIELDS),
+    }),
+    'role': ISOField(['gmd:role/gmd:CI_RoleCode/@codeListValue'], '0..1'),
+}
+
+# the fields of ckanext.spatial.model.ISODocument read by FisbrokerPlugin,
+# with the same search paths
+ISO_FIELDS = {
+    'guid': ISOField(['gmd:fileIdentifier/gco:CharacterString/text()'], '0..1'),
+    'title': ISOField(_paths(
+        'gmd:citation/gmd:CI_Citation/gmd:title/gco:CharacterString/text()'), '1'),
+    'resource-type': ISOField(['gmd:hierarchyLevel/gmd:MD_ScopeCode/@codeListValue'], '*'),
+    'keyword-inspire-theme': ISOField(_paths(
+        'gmd:descriptiveKeywords/gmd:MD_Keywords/gmd:keyword/gco:CharacterString/text()'), '*'),
+    'keyword-controlled-other': ISOField([
+        SERVICE_IDENTIFICATION +
+        'srv:keywords/gmd:MD_Keywords/gmd:keyword/gco:CharacterString/text()'
+    ], '*'),
+    'responsible-organisation': ISOField(
+        _paths('gmd:pointOfContact/gmd:CI_ResponsibleParty') +
+        ['gmd:contact/gmd:CI_ResponsibleParty'],
+        '1..*', elements=RESPONSIBLE_PARTY_FIELDS),
+    'limitations-on-public-access': ISOField(_paths(
+        'gmd:resourceConstraints/gmd:MD_LegalConstraints/gmd:otherConstraints/'
+        'gco:CharacterString/text()'), '*'),
+    'dataset-reference-date': ISOField(_paths(
+        'gmd:citation/gmd:CI_Citation/gmd:date/gmd:CI_Date'), '1..*', elements={
+            'type': ISOField(['gmd:dateType/gmd:CI_DateTypeCode/@codeListValue',
+                              'gmd:dateType/gmd:CI_DateTypeCode/text()'], '1'),
+            'value': ISOField(['gmd:date/gco:Date/text()',
+                               'gmd:date/gco:DateTime/text()'], '1'),
+        }),
+    'browse-graphic': ISOField(_paths('gmd:graphicOverview/gmd:MD_BrowseGraphic'), '*', elements={
+        'file': ISOField(['gmd:fileName/gco:CharacterString/text()'], '0..1'),
+        'description': ISOField(['gmd:fileDescription/gco:CharacterString/text()'], '0..1'),
+        'type': ISOField(['gmd:fileType/gco:CharacterString/text()'], '0..1'),
+    }),
+}
+
+
+def infer_tags(values):
+    '''Return the tags of a record, as inferred by ISODocument from its
+       keywords.'''
+
+    tags = []
+    for key in ['keyword-inspire-theme', 'keyword-controlled-other']:
+        for item in values[key]:
+            if item not in tags:
+                tags.append(item)
+    return tags
+
+
+INFERRED_FIELDS = {
+    'tags': infer_tags,
+}
+
+
+class FisbrokerISOValues(Mapping):
+    '''The ISO values of a FIS-Broker record used by FisbrokerPlugin, with the
+       same structure as those read by ckanext-spatial's ISODocument, but only
+       for the fields in ISO_FIELDS and INFERRED_FIELDS. The record is parsed
+       once, and each field is only read when it is first accessed.'''
+
+    def __init__(self, content):
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        self._tree = etree.fromstring(content)
+        self._values = {}
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            if name in ISO_FIELDS:
+                self._values[name] = ISO_FIELDS[name].read(self._tree)
+            elif name in INFERRED_FIELDS:
+                self._values[name] = INFERRED_FIELDS[name](self)
+            else:
+                raise KeyError(name)
+        return self._values[name]
+
+    def __contains__(self, name):
+        return name in ISO_FIELDS or name in INFERRED_FIELDS
+
+    def __iter__(self):
+        for name in ISO_FIELDS:
+            yield name
+        for name in INFERRED_FIELDS:
+            yield name
+
+    def __len__(self):
+        return len(ISO_FIELDS) + len(INFERRED_FIELDS)
@@ -0,0 +1,396 @@
+# coding: utf-8
+"""Database tables of the CKAN FIS-Broker harvester."""
+
+import datetime
+import json
+import logging
+
+from sqlalchemy import Column, Index, Table, and_, or_, select, types
+from sqlalchemy.exc import IntegrityError
+
+from ckan import model
+from ckan.model.domain_object import DomainObject
+from ckan.model.meta import metadata, mapper, Session
+from ckan.model.types import make_uuid
+from ckanext.harvest import model as harvest_model
+
+LOG = logging.getLogger(__name__)
+
+fisbroker_watermark_table = None
+fisbroker_package_index_table = None
+fisbroker_reimport_run_table = None
+fisbroker_rejection_table = None
+
+
+class FisbrokerWatermark(DomainObject):
+    '''The highest FIS-Broker modification date of the records imported by an
+       error-free harvest job of a harvest source, and the candidate for the
+       next watermark: the highest modification date imported by the latest
+       job, which becomes the watermark if that job turns out to be
+       error-free.'''
+
+    @classmethod
+    def get(cls, source_id):
+        '''Return the watermark of the harvest source with `source_id`, or None.'''
+
+        # populate_existing(), as advance_watermark() updates in bulk
+        return Session.query(cls).populate_existing() \
+            .filter(cls.source_id == source_id).first()
+
+
+class FisbrokerPackage(DomainObject):
+    '''Index entry linking a harvested package to its GUID and harvest source,
+       so that these can be looked up without loading the package's harvest
+       objects.'''
+
+    @classmethod
+    def get(cls, package_id):
+        '''Return the index entry of the package with `package_id`, or None.'''
+
+        return Session.query(cls).filter(cls.package_id == package_id).first()
+
+    @classmethod
+    def for_source(cls, source_id):
+        '''Return a query for the index entries of all packages harvested by
+           the harvest source with `source_id`.'''
+
+        return Session.query(cls).filter(cls.source_id == source_id)
+
+
+class FisbrokerReimportRun(DomainObject):
+    '''Checkpoint of a bulk reimport: the datasets to reimport, those already
+       processed, the failures and the harvest job the datasets are reimported
+       in. The lists are stored as JSON.'''
+
+    @classmethod
+    def get(cls, run_id):
+        '''Return the reimport run with `run_id`, or None.'''
+
+        return Session.query(cls).filter(cls.id == run_id).first()
+
+    @classmethod
+    def start(cls, package_ids, job_id):
+        '''Create and save a new reimport run for `package_ids` in the harvest
+           job with `job_id`.'''
+
+        run = cls(package_ids=json.dumps(list(package_ids)), job_id=job_id,
+                  processed=json.dumps([]), failures=json.dumps({}), status=u'running')
+        Session.add(run)
+        Session.commit()
+        return run
+
+    def package_ids_list(self):
+        '''Return the ids of all datasets of the run.'''
+
+        return json.loads(self.package_ids)
+
+    def processed_list(self):
+        '''Return the ids of all datasets processed so far.'''
+
+        return json.loads(self.processed)
+
+    def failures_dict(self):
+        '''Return the outcomes of the datasets that failed so far, by id.'''
+
+        return json.loads(self.failures)
+
+    def checkpoint(self, processed, failures, status=u'running'):
+        '''Durably record the datasets processed so far and the failures.'''
+
+        self.processed = json.dumps(list(processed))
+        self.failures = json.dumps(failures)
+        self.status = status
+        self.updated = datetime.datetime.utcnow()
+        Session.add(self)
+        Session.commit()
+
+
+class FisbrokerRejection(DomainObject):
+    '''Record rejected by get_package_dict(), with the FIS-Broker modification
+       date of the rejected version and the error reported for it. A rejection
+       is only valid as long as the record isn't modified.'''
+
+    @classmethod
+    def get(cls, guid):
+        '''Return the rejection of the record with `guid`, or None.'''
+
+        return Session.query(cls).filter(cls.guid == guid).first()
+
+    @classmethod
+    def for_source(cls, source_id):
+        '''Return a query for the rejections of all records harvested by the
+           harvest source with `source_id`.'''
+
+        return Session.query(cls).filter(cls.source_id == source_id)
+
+    def is_valid(self, modified):
+        '''Return True if the rejection applies to the version of the record
+           modified at `modified`.'''
+
+        return bool(modified) and self.modified == modified
+
+    def error(self):
+        '''Return the error the record was rejected with, as set by
+           get_package_dict().'''
+
+        return {'code': self.code, 'description': self.description}
+
+
+def define_tables():
+    '''Define the tables of the FIS-Broker harvester and map them to their
+       classes.'''
+
+    global fisbroker_watermark_table
+    global fisbroker_package_index_table
+    global fisbroker_reimport_run_table
+    global fisbroker_rejection_table
+
+    fisbroker_watermark_table = Table(
+        'fisbroker_watermark',
+        metadata,
+        Column('source_id', types.UnicodeText, primary_key=True),
+        Column('modified', types.DateTime),
+        Column('job_id', types.UnicodeText),
+        Column('pending_modified', types.DateTime),
+        Column('pending_job_id', types.UnicodeText),
+        Column('updated', types.DateTime, default=datetime.datetime.utcnow),
+    )
+
+    fisbroker_package_index_table = Table(
+        'fisbroker_package_index',
+        metadata,
+        Column('package_id', types.UnicodeText, primary_key=True),
+        Column('guid', types.UnicodeText),
+        Column('source_id', types.UnicodeText),
+        Column('source_type', types.UnicodeText),
+        Column('last_modified', types.DateTime),
+        Column('content_digest', types.UnicodeText),
+        Column('status', types.UnicodeText),
+        Column('updated', types.DateTime, default=datetime.datetime.utcnow),
+        Index('idx_fisbroker_package_index_guid', 'guid'),
+        Index('idx_fisbroker_package_index_source_id', 'source_id'),
+    )
+
+    fisbroker_reimport_run_table = Table(
+        'fisbroker_reimport_run',
+        metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('job_id', types.UnicodeText),
+        Column('package_ids', types.UnicodeText),
+        Column('processed', types.UnicodeText),
+        Column('failures', types.UnicodeText),
+        Column('status', types.UnicodeText),
+        Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Column('updated', types.DateTime, default=datetime.datetime.utcnow),
+    )
+
+    fisbroker_rejection_table = Table(
+        'fisbroker_rejection',
+        metadata,
+        Column('guid', types.UnicodeText, primary_key=True),
+        Column('source_id', types.UnicodeText),
+        Column('modified', types.UnicodeText),
+        Column('code', types.Integer),
+        Column('description', types.UnicodeText),
+        Column('updated', types.DateTime, default=datetime.datetime.utcnow),
+        Index('idx_fisbroker_rejection_source_id', 'source_id'),
+    )
+
+    mapper(FisbrokerWatermark, fisbroker_watermark_table)
+    mapper(FisbrokerPackage, fisbroker_package_index_table)
+    mapper(FisbrokerReimportRun, fisbroker_reimport_run_table)
+    mapper(FisbrokerRejection, fisbroker_rejection_table)
+
+
+def setup():
+    '''Define the tables of the FIS-Broker harvester and create them if they
+       don't exist yet.'''
+
+    if fisbroker_watermark_table is None:
+        define_tables()
+        LOG.debug('FIS-Broker tables defined in memory')
+
+    if not model.package_table.exists():
+        LOG.debug('FIS-Broker table creation deferred')
+        return
+
+    for table in [fisbroker_watermark_table, fisbroker_reimport_run_table,
+                  fisbroker_rejection_table]:
+        if not table.exists():
+            table.create()
+            LOG.debug('FIS-Broker table %s created', table.name)
+
+    if harvest_model.harvest_object_table is None or \
+            not harvest_model.harvest_object_table.exists():
+        # the index is populated from the harvest objects
+        LOG.debug('FIS-Broker package index creation deferred')
+        return
+    if not fisbroker_package_index_table.exists():
+        fisbroker_package_index_table.create()
+        LOG.debug('FIS-Broker table %s created', fisbroker_package_index_table.name)
+        populate_package_index()
+
+
+def populate_package_index():
+    '''Fill the package index from the current (or, if there is none, the most
+       recently gathered) harvest object of every harvested package.'''
+
+    objects = harvest_model.harvest_object_table
+    extras = harvest_model.harvest_object_extra_table
+    sources = harvest_model.harvest_source_table
+    rows = select([
+        objects.c.package_id,
+        objects.c.guid,
+        objects.c.harvest_source_id,
+        sources.c.type,
+        objects.c.metadata_modified_date,
+        extras.c.value,
+        objects.c.report_status,
+    ]).select_from(
+        objects.join(sources, sources.c.id == objects.c.harvest_source_id)
+        .outerjoin(extras, and_(extras.c.harvest_object_id == objects.c.id,
+                                extras.c.key == 'content_digest'))
+    ).where(objects.c.package_id != None) \
+     .distinct(objects.c.package_id) \
+     .order_by(objects.c.package_id,
+               objects.c.current.desc().nullslast(),
+               objects.c.gathered.desc().nullslast())
+
+    now = datetime.datetime.utcnow()
+    entries = [{
+        'package_id': package_id,
+        'guid': guid,
+        'source_id': source_id,
+        'source_type': source_type,
+        'last_modified': last_modified,
+        'content_digest': digest,
+        'status': status,
+        'updated': now,
+    } for package_id, guid, source_id, source_type, last_modified, digest, status
+               in Session.execute(rows)]
+    if entries:
+        Session.execute(fisbroker_package_index_table.insert(), entries)
+    Session.commit()
+    LOG.info('FIS-Broker package index populated with %d packages', len(entries))
+
+
+def update_package_index(harvest_object, status, content_digest=None):
+    '''Create or update the index entry for the package of `harvest_object`,
+       with `status` as the outcome of the last import. The changes are not
+       committed.'''
+
+    entry = FisbrokerPackage.get(harvest_object.package_id)
+    if entry is None:
+        entry = FisbrokerPackage(package_id=harvest_object.package_id)
+        Session.add(entry)
+    entry.guid = harvest_object.guid
+    entry.source_id = harvest_object.harvest_source_id
+    entry.source_type = harvest_object.source.type if harvest_object.source else None
+    if harvest_object.metadata_modified_date:
+        entry.last_modified = harvest_object.metadata_modified_date
+    if content_digest:
+        entry.content_digest = content_digest
+    entry.status = status
+    entry.updated = datetime.datetime.utcnow()
+    return entry
+
+
+def update_rejection(harvest_object, modified, error):
+    '''Record that the version of the record of `harvest_object` modified at
+       `modified` was rejected with `error` (as set by get_package_dict()).
+       The changes are not committed.'''
+
+    rejection = FisbrokerRejection.get(harvest_object.guid)
+    if rejection is None:
+        rejection = FisbrokerRejection(guid=harvest_object.guid)
+        Session.add(rejection)
+    rejection.source_id = harvest_object.harvest_source_id
+    rejection.modified = modified
+    rejection.code = error.get('code')
+    rejection.description = error.get('description')
+    rejection.updated = datetime.datetime.utcnow()
+    return rejection
+
+
+def delete_rejections(guids):
+    '''Delete the rejections of the records with `guids`, e.g. because they
+       have been imported, modified or deleted. The changes are not
+       committed.'''
+
+    guids = list(guids)
+    if guids:
+        Session.query(FisbrokerRejection) \
+            .filter(FisbrokerRejection.guid.in_(guids)) \
+            .delete(synchronize_session=False)
+
+
+def advance_watermark(source_id, modified, job_id):
+    '''Set the watermark of the harvest source with `source_id` to `modified`,
+       unless it is already higher. The comparison and the update are done in
+       a single statement, so that concurrent jobs can't move the watermark
+       backwards. Return True if the watermark was changed.'''
+
+    values = {
+        'modified': modified,
+        'job_id': job_id,
+        'updated': datetime.datetime.utcnow(),
+    }
+    updated = Session.query(FisbrokerWatermark) \
+        .filter(FisbrokerWatermark.source_id == source_id) \
+        .filter(or_(FisbrokerWatermark.modified == None,
+                    FisbrokerWatermark.modified < modified)) \
+        .update(values, synchronize_session=False)
+    if not updated and not FisbrokerWatermark.get(source_id):
+        try:
+            Session.add(FisbrokerWatermark(source_id=source_id, **values))
+            Session.commit()
+            return True
+        except IntegrityError:
+            # another process created the watermark in the meantime
+            Session.rollback()
+            return advance_watermark(source_id, modified, job_id)
+    Session.commit()
+    return bool(updated)
+
+
+def record_watermark_candidate(source_id, job_id, modified):
+    '''Raise the watermark candidate of the harvest source with `source_id` to
+       `modified`, imported by the job with `job_id`. The candidate of another
+       job is replaced. As in advance_watermark(), the comparison and the
+       update are done in a single statement. Return True if the candidate
+       was changed.'''
+
+    values = {
+        'pending_modified': modified,
+        'pending_job_id': job_id,
+        'updated': datetime.datetime.utcnow(),
+    }
+    updated = Session.query(FisbrokerWatermark) \
+        .filter(FisbrokerWatermark.source_id == source_id) \
+        .filter(or_(FisbrokerWatermark.pending_job_id == None,
+                    FisbrokerWatermark.pending_job_id != job_id,
+                    FisbrokerWatermark.pending_modified < modified)) \
+        .update(values, synchronize_session=False)
+    if not updated and not FisbrokerWatermark.get(source_id):
+        try:
+            Session.add(FisbrokerWatermark(source_id=source_id, **values))
+            Session.commit()
+            return True
+        except IntegrityError:
+            # another process created the watermark in the meantime
+            Session.rollback()
+            return record_watermark_candidate(source_id, job_id, modified)
+    Session.commit()
+    return bool(updated)
+
+
+def drop_watermark_candidate(source_id, job_id):
+    '''Drop the watermark candidate of the harvest source with `source_id`, if
+       it was imported by the job with `job_id`.'''
+
+    Session.query(FisbrokerWatermark) \
+        .filter(FisbrokerWatermark.source_id == source_id) \
+        .filter(FisbrokerWatermark.pending_job_id == job_id) \
+        .update({'pending_modified': None, 'pending_job_id': None},
+                synchronize_session=False)
+    Session.commit()
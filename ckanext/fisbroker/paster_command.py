@@ -1,19 +1,78 @@
 '''Module to implement a paster action for the FIS-Broker-Harvester'''
 
+import csv
+import json
 import logging
+import multiprocessing
+from Queue import Empty
 import sys
 import time
 from ckan import logic
 from ckan import model
 from ckan.lib import cli
+import ckan.plugins.toolkit as toolkit
 
 from ckanext.fisbroker import HARVESTER_ID
 import ckanext.fisbroker.controller as controller
+from ckanext.fisbroker.csw_client import reset_session
+from ckanext.fisbroker.exceptions import ReimportJobExistsError
+from ckanext.fisbroker.helper import resolve_fisbroker_packages
+from ckanext.fisbroker.model import FisbrokerPackage, FisbrokerReimportRun
 from ckanext.fisbroker.plugin import FisbrokerPlugin
 
-from ckanext.harvest.model import HarvestSource
+from ckanext.harvest.model import HarvestJob, HarvestSource
 
 LOG = logging.getLogger(__name__)
+LIST_PAGE_SIZE = 500
+OUTPUT_FORMATS = ['csv', 'jsonl']
+# number of datasets a reimport worker reimports before reporting progress
+WORKER_CHUNK_SIZE = 50
+WORKER_POLL_INTERVAL = 5
+CHECKPOINT_INTERVAL_DEFAULT = 100
+
+
+def _failed(outcomes):
+    '''Return the outcomes of the packages that could not be reimported.'''
+
+    return dict((package_id, outcome) for package_id, outcome in (outcomes or {}).items()
+                if not outcome['success'])
+
+
+def _create_reimport_job(fb_controller, context):
+    '''Return a new reimport job, or exit if the FIS-Broker harvest source has
+    another unfinished job.'''
+
+    try:
+        return fb_controller.create_reimport_job(context)
+    except ReimportJobExistsError as error:
+        print str(error)
+        sys.exit(1)
+
+
+def _reimport_worker(worker, package_ids, job_id, results, continue_on_error=False):
+    '''Reimport `package_ids` in the existing harvest job `job_id`, in a process
+    of its own. Progress and the outcome are reported to the coordinator through
+    the `results` queue. If `continue_on_error` is set, the failed packages are
+    reported with the progress instead of stopping the worker.'''
+
+    # don't share the database and HTTP connections of the coordinator
+    model.Session.remove()
+    model.meta.engine.dispose()
+    reset_session()
+
+    fb_controller = controller.FISBrokerController()
+    context = {'model': model, 'session': model.Session}
+    try:
+        for start in range(0, len(package_ids), WORKER_CHUNK_SIZE):
+            chunk = package_ids[start:start + WORKER_CHUNK_SIZE]
+            outcomes = {} if continue_on_error else None
+            reimported = fb_controller.reimport_batch(chunk, context, job_id=job_id,
+                                                      outcomes=outcomes)
+            results.put(('progress', worker, chunk, reimported, _failed(outcomes)))
+        results.put(('done', worker, None))
+    except Exception as error:
+        LOG.exception("reimport worker %d failed", worker)
+        results.put(('done', worker, "{}: {}".format(error.__class__.__name__, error)))
 
 class FISBrokerCommand(cli.CkanCommand):
     '''Actions for the FIS-Broker harvester
@@ -23,18 +82,37 @@ class FISBrokerCommand(cli.CkanCommand):
       fisbroker list_sources
         - List all instances of the FIS-Broker harvester.
 
-      fisbroker [-s {source-id}] list_datasets
-        - List the ids and titles of all datasets harvested by the
+      fisbroker [-s {source-id}] [-o {offset}] [-l {limit}] [-f csv|jsonl] list_datasets
+        - List the ids, names and titles of all datasets harvested by the
           FIS-Broker harvester. Either of all instances or of the
-          one specified by {source-id}.
+          one specified by {source-id}. The datasets are ordered by id
+          and printed as they are read, either as CSV (default) or as
+          JSON lines (--format,-f). To list only a subset, use the
+          --offset,-o and --limit,-l options.
 
-      fisbroker [-s|-d {source|dataset-id}] [-o {offset}] [-l {limit}] reimport_dataset
+      fisbroker [-s|-d {source|dataset-id}] [-o {offset}] [-l {limit}] [-w {workers}] [-c] reimport_dataset
         - Reimport the specified datasets. The specified datasets are either
           all datasets by all instances of the FIS-Broker harvester (if no options
           are used), or all datasets by the FIS-Broker harvester instance with
           {source-id}, or the single dataset identified by {dataset-id}.
           To reimport only a subset or page through the complete set of datasets,
           use the --offset,-o and --limit,-l options.
+          To split the datasets between several processes, use the --workers,-w
+          option. With --continue-on-error,-c, datasets that cannot be reimported
+          don't stop the reimport, but are printed as JSON lines with their
+          error code and message at the end.
+          Without --continue-on-error, all datasets are checked before the
+          reimport starts, and the command stops if any of them cannot be
+          reimported.
+          The id of the reimport run is printed to stderr at the start, and the
+          progress is checkpointed in the database regularly. If the reimport
+          stops, its harvest job stays running until the run is resumed.
+
+      fisbroker -r {run-id} [-w {workers}] [-c] reimport_dataset
+        - Resume the interrupted reimport run {run-id}. Datasets that were
+          already processed are skipped, and the remaining ones are reimported
+          in the same harvest job (or in a new one, if the job was finished
+          in the meantime).
 
       fisbroker [-s {source-id}] last_successful_job
         - Show the last successful job that was not a reimport job, either
@@ -66,24 +144,54 @@ class FISBrokerCommand(cli.CkanCommand):
                                dest='limit',
                                default=False,
                                type='int',
-                               help='Max number of datasets to reimport')
+                               help='Max number of datasets to list or reimport')
 
         self.parser.add_option('-o',
                                '--offset',
                                dest='offset',
                                default=False,
                                type='int',
-                               help='Index of the first dataset to reimport')
+                               help='Index of the first dataset to list or reimport')
+
+        self.parser.add_option('-f',
+                               '--format',
+                               dest='format',
+                               default='csv',
+                               choices=OUTPUT_FORMATS,
+                               help='Output format of list_datasets: csv or jsonl')
+
+        self.parser.add_option('-w',
+                               '--workers',
+                               dest='workers',
+                               default=1,
+                               type='int',
+                               help='Number of processes for reimport_dataset')
+
+        self.parser.add_option('-c',
+                               '--continue-on-error',
+                               dest='continue_on_error',
+                               action='store_true',
+                               default=False,
+                               help='Continue reimport_dataset after datasets that cannot be reimported')
 
-    def print_dataset(self, dataset):
-        '''Print an individual dataset.'''
-        print u'{},{},"{}"'.format(dataset.get('id'), dataset.get('name'),dataset.get('title')).encode('utf-8')
+        self.parser.add_option('-r',
+                               '--resume',
+                               dest='resume',
+                               default=False,
+                               help='Id of an interrupted reimport run to resume')
 
     def print_datasets(self, datasets):
-        '''Print all datasets.'''
-        print 'id,name,title'
-        for dataset in datasets:
-            self.print_dataset(dataset)
+        '''Print all datasets, as CSV or as JSON lines (depending on --format),
+        one at a time as they are generated.'''
+        if self.options.format == 'jsonl':
+            for dataset in datasets:
+                print json.dumps(dataset)
+        else:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['id', 'name', 'title'])
+            for dataset in datasets:
+                writer.writerow([(dataset.get(key) or u'').encode('utf-8')
+                                 for key in ['id', 'name', 'title']])
 
     def print_harvest_sources(self, sources):
         '''Print all harvest sources (taken from ckanext-harvest).'''
@@ -116,50 +224,273 @@ class FISBrokerCommand(cli.CkanCommand):
         return [source for source in sources if source['type'] == HARVESTER_ID]
 
 
-    def list_packages(self, source_id):
-        '''List the ids and titles of all datasets harvested by the
-        FIS-Broker harvester. Either of all instances or of the
-        one specified by {source-id}.
+    def _active_packages(self, source_id, *columns):
+        '''Return a query for `columns` of all active datasets harvested by the
+        FIS-Broker instance {source-id}, from the package index, ordered by id.
+        '''
+
+        return model.Session.query(model.Package.id, *columns) \
+            .join(FisbrokerPackage, FisbrokerPackage.package_id == model.Package.id) \
+            .filter(FisbrokerPackage.source_id == source_id) \
+            .filter(model.Package.state == 'active') \
+            .order_by(model.Package.id)
+
+    def _page(self, query, page_size=LIST_PAGE_SIZE):
+        '''Generate the rows of `query` (ordered by id, which must be the first
+        column), with --offset and --limit applied in the database. The rows are
+        read in pages of `page_size`, each starting after the last id of the
+        previous one, so that neither deep offsets nor the complete list are
+        needed.
+        '''
+
+        remaining = self.options.limit or None
+        last_id = None
+        while remaining is None or remaining > 0:
+            page = query
+            if last_id is None:
+                page = page.offset(self.options.offset or 0)
+            else:
+                page = page.filter(model.Package.id > last_id)
+            size = page_size if remaining is None else min(page_size, remaining)
+            rows = page.limit(size).all()
+            for row in rows:
+                yield row
+            if len(rows) < size:
+                break
+            last_id = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def list_packages(self, source_id, page_size=LIST_PAGE_SIZE):
+        '''Generate the ids, names and titles of all active datasets harvested
+        by the FIS-Broker instance {source-id}, ordered by id and paged with
+        _page().
         '''
 
         LOG.debug("listing datasets for source %s ...", source_id)
 
-        filter_query = 'harvest_source_id:"{0}"'.format(source_id)
-        search_dict = {
-            'fq': filter_query,
-            'start': 0,
-            'rows': 500,
-            'sort': 'metadata_modified desc',
-        }
-        context = {'model': model, 'session': model.Session}
+        query = self._active_packages(source_id, model.Package.name, model.Package.title)
+        for package_id, name, title in self._page(query, page_size):
+            yield {'id': package_id, 'name': name, 'title': title}
 
-        total_results = []
-        while True:
-            result = logic.get_action('package_search')(context, search_dict)
-            length = len(result['results'])
-            total_results += result['results']
-            search_dict['start'] = search_dict['start'] + length
-            if len(total_results) >= result['count']:
-                break
+    def list_package_ids(self, source_id, page_size=LIST_PAGE_SIZE):
+        '''List the ids of all active datasets harvested by the FIS-Broker
+        instance {source-id}, using the package index instead of a search.
+        The order and the --offset and --limit options are the same as for
+        list_packages().
+        '''
+
+        return [package_id for package_id, in
+                self._page(self._active_packages(source_id), page_size)]
+
+    def checkpoint_interval(self):
+        '''Return the number of datasets after which the progress of a reimport
+        run is checkpointed.'''
+        return toolkit.asint(toolkit.config.get(
+            'ckanext.fisbroker.reimport.checkpoint_interval', CHECKPOINT_INTERVAL_DEFAULT))
 
-        offset = 0
-        limit = len(total_results)
-        if self.options.offset:
-            offset = self.options.offset
-        if self.options.limit:
-            limit = self.options.limit
+    def start_run(self, dataset_ids):
+        '''Create a reimport job and a reimport run for all datasets in
+        dataset_ids, and print the id of the run. The datasets are checked
+        first: unless --continue-on-error is set, datasets that cannot be
+        reimported are printed and the command exits without creating a job.'''
+        fb_controller = controller.FISBrokerController()
+        context = {'model': model, 'session': model.Session}
+        seen = set()
+        dataset_ids = [dataset_id for dataset_id in dataset_ids
+                       if not (dataset_id in seen or seen.add(dataset_id))]
+        if not dataset_ids:
+            print 'No datasets to reimport'
+            sys.exit(1)
+        if not self.options.continue_on_error:
+            _, errors = resolve_fisbroker_packages(dataset_ids)
+            if errors:
+                for dataset_id in dataset_ids:
+                    if dataset_id in errors:
+                        print 'Cannot reimport %s: %s' % (dataset_id, errors[dataset_id])
+                sys.exit(1)
+        harvest_job = _create_reimport_job(fb_controller, context)
+        run = FisbrokerReimportRun.start(dataset_ids, harvest_job.id)
+        sys.stderr.write("reimport run {} for {} datasets\n".format(run.id, len(dataset_ids)))
+
+        return run
+
+    def resume_run(self, run_id):
+        '''Return the unfinished reimport run with run_id, which continues in
+        its own harvest job. Only if that job has been finished from outside
+        the run, a new reimport job is created for the rest of the run.'''
+        run = FisbrokerReimportRun.get(run_id)
+        if not run:
+            print 'Reimport run %s not found' % run_id
+            sys.exit(1)
+        if run.status == u'finished':
+            print 'Reimport run %s is already finished' % run_id
+            sys.exit(1)
+        harvest_job = HarvestJob.get(run.job_id)
+        if not harvest_job or harvest_job.status == u'Finished':
+            fb_controller = controller.FISBrokerController()
+            context = {'model': model, 'session': model.Session}
+            job_id = _create_reimport_job(fb_controller, context).id
+            LOG.warning("harvest job %s of reimport run %s was finished outside the run, "
+                        "reimporting the remaining datasets in the new job %s",
+                        run.job_id, run.id, job_id)
+            run.job_id = job_id
+            run.save()
+        LOG.info("resuming reimport run %s after %d of %d datasets", run.id,
+                 len(run.processed_list()), len(run.package_ids_list()))
+
+        return run
+
+    def interrupt_run(self, run, processed, failures):
+        '''Checkpoint the incomplete reimport run run. Its harvest job stays
+        Running, so that the resumed run reimports the rest of the datasets in
+        the same job (see resume_run()). Until then, the job blocks other jobs
+        of the harvest source.'''
+        run.checkpoint(processed, failures)
+        LOG.error("reimport run %s stopped after %d datasets, resume it with --resume",
+                  run.id, len(processed))
+
+    def finish_run(self, run, processed, failures):
+        '''Finish the harvest job and the reimport run run, and print the
+        failures if --continue-on-error is set.'''
+        fb_controller = controller.FISBrokerController()
+        fb_controller.finish_reimport_job(HarvestJob.get(run.job_id))
+        run.checkpoint(processed, failures, status=u'finished')
+        if self.options.continue_on_error:
+            self.print_failures(failures)
 
-        return total_results[offset:offset+limit]
+    def reimport_dataset(self, run):
+        '''Reimport all datasets of the reimport run run that haven't been
+        processed yet, and checkpoint the progress after every
+        checkpoint_interval() datasets.'''
 
-    def reimport_dataset(self, dataset_ids):
-        '''Reimport all datasets in dataset_ids.'''
+        processed = run.processed_list()
+        failures = run.failures_dict()
+        done = set(processed)
+        dataset_ids = [dataset_id for dataset_id in run.package_ids_list()
+                       if dataset_id not in done]
+
+        if self.options.workers > 1 and len(dataset_ids) > 1:
+            return self.reimport_dataset_parallel(run, dataset_ids, self.options.workers)
 
         fb_controller = controller.FISBrokerController()
         context = {'model': model, 'session': model.Session}
-        result = fb_controller.reimport_batch(dataset_ids, context)
+        interval = self.checkpoint_interval()
+        result = []
+        for start in range(0, len(dataset_ids), interval):
+            chunk = dataset_ids[start:start + interval]
+            outcomes = {} if self.options.continue_on_error else None
+            try:
+                result += fb_controller.reimport_batch(chunk, context, job_id=run.job_id,
+                                                       outcomes=outcomes)
+            except (Exception, KeyboardInterrupt):
+                model.Session.rollback()
+                self.interrupt_run(run, processed, failures)
+                raise
+            processed += chunk
+            failures.update(_failed(outcomes))
+            run.checkpoint(processed, failures)
+        self.finish_run(run, processed, failures)
 
         return result
 
+    def print_failures(self, failures):
+        '''Print the datasets that could not be reimported as JSON lines, with
+        the error code and message of each.'''
+        LOG.info("%d datasets could not be reimported", len(failures))
+        for package_id, outcome in sorted(failures.items()):
+            print json.dumps({
+                'id': package_id,
+                'code': outcome['error']['code'],
+                'message': outcome['error']['message'],
+            })
+
+    def reimport_dataset_parallel(self, run, dataset_ids, workers):
+        '''Reimport all datasets in dataset_ids in the harvest job of the
+        reimport run run, split deterministically between `workers` processes.
+        Aggregate the progress and results of the workers, checkpoint the run
+        regularly and return the ids of the reimported datasets.
+        '''
+
+        run_id = run.id
+        job_id = run.job_id
+        processed = run.processed_list()
+        package_failures = run.failures_dict()
+        interval = self.checkpoint_interval()
+
+        dataset_ids = sorted(set(dataset_ids))
+        shares = [dataset_ids[worker::workers] for worker in range(workers)]
+        shares = [share for share in shares if share]
+
+        # the workers must open their own database connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        results = multiprocessing.Queue()
+        processes = {}
+        for worker, share in enumerate(shares):
+            process = multiprocessing.Process(
+                target=_reimport_worker,
+                args=(worker, share, job_id, results, self.options.continue_on_error))
+            process.start()
+            processes[worker] = process
+            LOG.info("started reimport worker %d for %d datasets", worker, len(share))
+
+        run = FisbrokerReimportRun.get(run_id)
+        reimported = []
+        checkpointed = len(processed)
+        progress = dict((worker, 0) for worker in processes)
+        failures = {}
+        running = set(processes)
+        try:
+            while running:
+                try:
+                    message = results.get(timeout=WORKER_POLL_INTERVAL)
+                except Empty:
+                    for worker in list(running):
+                        # a worker that exited normally has sent 'done', which
+                        # will be received with the next get()
+                        if not processes[worker].is_alive() and processes[worker].exitcode != 0:
+                            running.discard(worker)
+                            failures[worker] = "exited with code {}".format(processes[worker].exitcode)
+                    continue
+                if message[0] == 'progress':
+                    _, worker, chunk, worker_reimported, worker_failures = message
+                    progress[worker] += len(chunk)
+                    processed += chunk
+                    reimported += worker_reimported
+                    package_failures.update(worker_failures)
+                    if len(processed) - checkpointed >= interval:
+                        run.checkpoint(processed, package_failures)
+                        checkpointed = len(processed)
+                    LOG.info("reimport worker %d: %d/%d datasets, %d/%d in total", worker,
+                             progress[worker], len(shares[worker]), sum(progress.values()),
+                             len(dataset_ids))
+                else:
+                    _, worker, error = message
+                    running.discard(worker)
+                    if error:
+                        failures[worker] = error
+        except (Exception, KeyboardInterrupt):
+            for process in processes.values():
+                process.terminate()
+            self.interrupt_run(run, processed, package_failures)
+            raise
+        for process in processes.values():
+            process.join()
+
+        for worker, error in sorted(failures.items()):
+            LOG.error("reimport worker %d stopped after %d/%d datasets: %s", worker,
+                      progress[worker], len(shares[worker]), error)
+        LOG.info("reimported %d of %d datasets with %d workers", len(reimported),
+                 len(dataset_ids), len(shares))
+        if failures:
+            self.interrupt_run(run, processed, package_failures)
+        else:
+            self.finish_run(run, processed, package_failures)
+
+        return reimported
+
 
     def command(self):
         '''Implementation of the paster command
@@ -179,19 +510,21 @@ class FISBrokerCommand(cli.CkanCommand):
         elif cmd == 'list_datasets':
             LOG.debug("listing datasets harvested by FisbrokerPlugin ...")
             sources = [source.get('id') for source in self.list_sources()]
-            if len(self.args) >= 2:
+            if self.options.source_id:
+                sources = [unicode(self.options.source_id)]
+            elif len(self.args) >= 2:
                 sources = [unicode(self.args[1])]
             for source in sources:
                 start = time.time()
-                packages = self.list_packages(source)
-                self.print_datasets(packages)
-                LOG.debug("there were %i results ...", len(packages))
+                self.print_datasets(self.list_packages(source))
                 end = time.time()
                 LOG.debug("This took %f seconds", end - start)
         elif cmd == 'reimport_dataset':
             LOG.debug("reimporting datasets ...")
             package_ids = []
-            if self.options.dataset_id:
+            if self.options.resume:
+                LOG.debug("resuming reimport run %s ...", self.options.resume)
+            elif self.options.dataset_id:
                 LOG.debug("reimporting a single dataset ...")
                 package_ids = [ unicode(self.options.dataset_id) ]
             else:
@@ -203,9 +536,13 @@ class FISBrokerCommand(cli.CkanCommand):
                     LOG.debug("reimporting all dataset from all sources ...")
                     sources = [ source.get('id') for source in self.list_sources() ]
                 for source in sources:
-                    package_ids += [package['name'] for package in self.list_packages(source)]
+                    package_ids += self.list_package_ids(source)
+            if self.options.resume:
+                run = self.resume_run(unicode(self.options.resume))
+            else:
+                run = self.start_run(package_ids)
             start = time.time()
-            self.reimport_dataset(package_ids)
+            self.reimport_dataset(run)
             end = time.time()
             LOG.debug("This took %f seconds", end - start)
         elif cmd == 'last_successful_job':
@@ -1,13 +1,17 @@
 # coding: utf-8
 
-from datetime import datetime, timedelta
+from datetime import datetime
+import hashlib
+from io import BytesIO
 import json
 import logging
 import os
 import re
 
+from dateutil.parser import parse as parse_date
+from lxml import etree
 from owslib.fes import PropertyIsGreaterThanOrEqualTo
-from sqlalchemy import exists
+from sqlalchemy import exists, func, or_
 
 from ckan import model
 from ckan.lib.munge import munge_title_to_name
@@ -16,21 +20,209 @@ import ckan.plugins.toolkit as toolkit
 from ckanext.harvest.model import (
     HarvestJob ,
     HarvestGatherError ,
+    HarvestObject ,
+    HarvestObjectExtra ,
 )
 from ckanext.spatial.interfaces import ISpatialHarvester
 from ckanext.spatial.harvesters.csw import CSWHarvester
+from ckanext.spatial.lib.csw_client import CswService
 from ckanext.spatial.validation.validation import BaseValidator
 from ckanext.fisbroker import HARVESTER_ID
-from ckanext.fisbroker.fisbroker_resource_annotator import FISBrokerResourceAnnotator
+from ckanext.fisbroker.csw_client import (
+    BACKOFF_FACTOR_DEFAULT,
+    CAPABILITIES_CACHE,
+    CAPABILITIES_TTL_DEFAULT,
+    MAX_RETRIES_DEFAULT,
+    PAGE_SIZE_DEFAULT,
+    POOL_SIZE_DEFAULT,
+    BatchedRecordFetcher,
+    catalogue_service,
+    configure_session,
+    iter_modified_dates,
+)
+from ckanext.fisbroker.exceptions import (
+    ERROR_NO_CONNECTION,
+    ERROR_NOT_FOUND_IN_FISBROKER,
+)
+from ckanext.fisbroker.fisbroker_resource_annotator import (
+    FISBrokerResourceAnnotator,
+    configure_resource_rules,
+    get_resource_rules_digest,
+)
+from ckanext.fisbroker.iso_values import FisbrokerISOValues
+from ckanext.fisbroker import model as fisbroker_model
+from ckanext.fisbroker.record_cache import (
+    MAX_SIZE_DEFAULT as RECORD_CACHE_MAX_SIZE_DEFAULT,
+    configure_record_cache,
+    get_record_cache,
+)
 import ckanext.fisbroker.helper as helpers
 
 LOG = logging.getLogger(__name__)
 TIMEDELTA_DEFAULT = 0
 TIMEOUT_DEFAULT = 20
+# Increase whenever get_package_dict() changes in a way that should cause
+# unchanged records to be imported again.
+TRANSFORMATION_VERSION = 1
+SKIP_NOT_OPENDATA = {'code': 1, 'description': 'not tagged as open data'}
+SKIP_NOT_SERVICE = {'code': 2, 'description': 'not a service resource'}
+SKIP_NO_ORGANISATION_NAME = {'code': 3, 'description': 'no organisation name'}
+SKIP_NO_ORGANISATION_EMAIL = {'code': 4, 'description': 'no responsible organisation email'}
+SKIP_NO_LICENSE = {'code': 5, 'description': 'could not determine license code'}
+SKIP_NO_RELEASE_DATE = {'code': 6, 'description': 'no release date'}
+GMD_NAMESPACE = 'http://www.isotc211.org/2005/gmd'
+SRV_NAMESPACE = 'http://www.isotc211.org/2005/srv'
+KEYWORD_TAG = '{%s}keyword' % GMD_NAMESPACE
+KEYWORDS_TAG = '{%s}MD_Keywords' % GMD_NAMESPACE
+DESCRIPTIVE_KEYWORDS_TAG = '{%s}descriptiveKeywords' % GMD_NAMESPACE
+SERVICE_KEYWORDS_TAG = '{%s}keywords' % SRV_NAMESPACE
+DATA_IDENTIFICATION_TAG = '{%s}MD_DataIdentification' % GMD_NAMESPACE
+SERVICE_IDENTIFICATION_TAG = '{%s}SV_ServiceIdentification' % SRV_NAMESPACE
+IDENTIFICATION_INFO_TAG = '{%s}identificationInfo' % GMD_NAMESPACE
+HIERARCHY_LEVEL_TAG = '{%s}hierarchyLevel' % GMD_NAMESPACE
+SCOPE_CODE_TAG = '{%s}MD_ScopeCode' % GMD_NAMESPACE
+KEYWORD_SECTIONS = {
+    (DESCRIPTIVE_KEYWORDS_TAG, DATA_IDENTIFICATION_TAG): 'data',
+    (DESCRIPTIVE_KEYWORDS_TAG, SERVICE_IDENTIFICATION_TAG): 'service',
+    (SERVICE_KEYWORDS_TAG, SERVICE_IDENTIFICATION_TAG): 'srv',
+}
+KEYWORD_TEXT = etree.XPath('gco:CharacterString/text()',
+                           namespaces={'gco': 'http://www.isotc211.org/2005/gco'})
 
 # https://fbinter.stadt-berlin.de/fb/csw
 
 
+def content_digest(content, source_config=None):
+    '''Return a digest of the canonicalised XML `content`, prefixed with the
+       current TRANSFORMATION_VERSION and a digest of the settings the
+       transformation depends on: the active resource rules (see
+       configure_resource_rules()) and the harvest source's `source_config`.
+       Differences in whitespace between elements, attribute order or
+       namespace prefixes don't change the digest.'''
+
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    try:
+        parser = etree.XMLParser(remove_blank_text=True)
+        canonical = etree.tostring(etree.fromstring(content, parser=parser), method='c14n')
+    except etree.XMLSyntaxError:
+        canonical = content
+    if isinstance(source_config, unicode):
+        source_config = source_config.encode('utf-8')
+    settings = hashlib.sha1("{}\n{}".format(
+        get_resource_rules_digest(), source_config or '')).hexdigest()
+    return "{}:{}:{}".format(TRANSFORMATION_VERSION, settings[:12],
+                             hashlib.sha1(canonical).hexdigest())
+
+def prefilter_record(iso_values):
+    '''Check the ISO values `iso_values` of a record (see FisbrokerISOValues)
+       for the conditions of marked_as_opendata() and
+       marked_as_service_resource(). Only the keywords and the hierarchy level
+       are read. Return the error get_package_dict() would report for the
+       record, or None if it passes.'''
+
+    data_dict = {'iso_values': iso_values}
+    if not marked_as_opendata(data_dict):
+        return SKIP_NOT_OPENDATA
+    if not marked_as_service_resource(data_dict):
+        return SKIP_NOT_SERVICE
+    return None
+
+def _keyword_section(keyword):
+    '''Return the section of the identification info the gmd:keyword element
+       `keyword` belongs to, where ISO_FIELDS in ckanext.fisbroker.iso_values
+       read it: 'data' or 'service' for descriptive keywords, 'srv' for
+       srv:keywords, or None if ISODocument doesn't read the keyword.'''
+
+    ancestors = []
+    parent = keyword.getparent()
+    while parent is not None:
+        ancestors.append(parent.tag)
+        parent = parent.getparent()
+    # MD_Keywords, the keywords element, the identification, identificationInfo
+    # and the root element
+    if len(ancestors) != 5 or ancestors[0] != KEYWORDS_TAG or \
+            ancestors[3] != IDENTIFICATION_INFO_TAG:
+        return None
+    return KEYWORD_SECTIONS.get((ancestors[1], ancestors[2]))
+
+def scan_record(content):
+    '''Check the raw ISO XML `content` of a record for the conditions of
+       prefilter_record() in a single streaming pass, without building the
+       document tree: only the gmd:keyword and gmd:MD_ScopeCode elements are
+       looked at where ISODocument reads them (see _keyword_section()), and
+       parsing stops as soon as the record is known to pass. Return the error
+       get_package_dict() would report for the record (code 1 or 2), or None
+       if the record passes or can't be parsed.'''
+
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    # ISODocument reads the descriptive keywords of the service identification
+    # only if the data identification has none
+    opendata = {'data': False, 'service': False, 'srv': False}
+    data_keywords = service = False
+    try:
+        for _, element in etree.iterparse(BytesIO(content), events=('end',),
+                                          tag=(KEYWORD_TAG, SCOPE_CODE_TAG)):
+            if element.tag == KEYWORD_TAG:
+                section = _keyword_section(element)
+                if section:
+                    values = KEYWORD_TEXT(element)
+                    data_keywords = data_keywords or (section == 'data' and bool(values))
+                    opendata[section] = opendata[section] or 'opendata' in values
+            else:
+                # only the hierarchy levels of the root element count
+                level = element.getparent()
+                if level is not None and level.tag == HIERARCHY_LEVEL_TAG and \
+                        level.getparent() is not None and level.getparent().getparent() is None:
+                    service = service or element.get('codeListValue') == 'service'
+            element.clear()
+            if service and (opendata['data'] or opendata['srv']):
+                return None
+    except etree.XMLSyntaxError:
+        return None
+    if not (opendata['srv'] or opendata['data' if data_keywords else 'service']):
+        return SKIP_NOT_OPENDATA
+    if not service:
+        return SKIP_NOT_SERVICE
+    return None
+
+def rejection_error(data_dict):
+    '''Return the error get_package_dict() rejects a record with, judging
+       by its `iso_values` in `data_dict`, or None if the record passes all
+       checks.'''
+
+    error = prefilter_record(data_dict['iso_values'])
+    if error:
+        return error
+    contact_info = extract_contact_info(data_dict)
+    if 'author' not in contact_info:
+        return SKIP_NO_ORGANISATION_NAME
+    if 'maintainer_email' not in contact_info:
+        return SKIP_NO_ORGANISATION_EMAIL
+    if 'license_id' not in extract_license_and_attribution(data_dict):
+        return SKIP_NO_LICENSE
+    if 'date_released' not in extract_reference_dates(data_dict):
+        return SKIP_NO_RELEASE_DATE
+    return None
+
+def check_record(content):
+    '''Return the error get_package_dict() would reject the record with raw
+       ISO XML `content` with, or None if it passes or can't be parsed. Closed
+       data and non-service records are rejected by the streaming pass of
+       scan_record(). Only the records that pass it are parsed, and only the
+       ISO values the remaining checks need are read (see FisbrokerISOValues),
+       so that rejected records are never read into the full ISO values.'''
+
+    error = scan_record(content)
+    if error:
+        return error
+    try:
+        iso_values = FisbrokerISOValues(content)
+    except etree.XMLSyntaxError:
+        return None
+    return rejection_error({'iso_values': iso_values})
+
 def marked_as_opendata(data_dict):
     '''Check if `data_dict` is marked as Open Data. If it is,
        return True, otherwise False.'''
@@ -232,12 +424,16 @@ def extras_as_list(extras_dict):
 class FisbrokerPlugin(CSWHarvester):
     '''Main plugin class of the ckanext-fisbroker extension.'''
 
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(ISpatialHarvester, inherit=True)
 
     import_since_keywords = ["last_error_free", "big_bang"]
+    gather_modes = ["default", "brief"]
+    # source id -> ((number of finished jobs, last finish time), id of last error-free job)
+    _last_error_free_jobs = {}
 
     def extras_dict(self, extras_list):
         '''Convert input `extras_list` to a conventional extras dict.'''
@@ -255,19 +451,54 @@ class FisbrokerPlugin(CSWHarvester):
             return None
         import_since = self.source_config['import_since']
         if import_since == 'last_error_free':
-            last_error_free_job = self.last_error_free_job(harvest_job)
-            LOG.debug('Last error-free job: %r', last_error_free_job)
-            if last_error_free_job:
-                gather_time = (last_error_free_job.gather_started +
-                               timedelta(hours=self.get_timedelta()))
-                return gather_time.strftime("%Y-%m-%dT%H:%M:%S%z")
-            else:
-                return None
+            # the watermark has been advanced at the start of the gather stage
+            watermark = fisbroker_model.FisbrokerWatermark.get(harvest_job.source.id)
+            if watermark and watermark.modified:
+                return watermark.modified.strftime("%Y-%m-%dT%H:%M:%S")
+            # no records imported by an error-free job yet
+            return None
         elif import_since == 'big_bang':
             # looking since big bang means no date constraint
             return None
         return import_since
 
+    def advance_watermark(self, harvest_job):
+        '''Promote the watermark candidate of the harvest source of `harvest_job`
+           (the highest modification date imported by the previous job, see
+           _record_watermark_candidate()) to the watermark, if that job is
+           error-free, and drop it otherwise. As ckanext-harvest doesn't notify
+           harvesters when a job finishes, this is done at the start of the next
+           gather stage. Sources harvested before they had a watermark start
+           with that of the last error-free job.
+           Return the watermark, or None if the source has none yet.'''
+
+        source_id = harvest_job.source.id
+        watermark = fisbroker_model.FisbrokerWatermark.get(source_id)
+        if watermark is None:
+            job = self.last_error_free_job(harvest_job)
+            if job:
+                modified = model.Session.query(func.max(HarvestObject.metadata_modified_date)) \
+                    .filter(HarvestObject.harvest_job_id == job.id) \
+                    .filter(or_(HarvestObject.current == True,
+                                HarvestObject.report_status == 'not modified')) \
+                    .scalar()
+                if modified and fisbroker_model.advance_watermark(source_id, modified, job.id):
+                    LOG.info("watermark of source %s set to %s by job %s", source_id, modified, job.id)
+                    watermark = fisbroker_model.FisbrokerWatermark.get(source_id)
+        elif watermark.pending_job_id and watermark.pending_job_id != harvest_job.id:
+            job = HarvestJob.get(watermark.pending_job_id)
+            # the candidate of a job that is still running is kept
+            if not job or job.status == 'Finished':
+                if job and self.is_error_free_job(job) and fisbroker_model.advance_watermark(
+                        source_id, watermark.pending_modified, job.id):
+                    LOG.info("watermark of source %s advanced to %s by job %s",
+                             source_id, watermark.pending_modified, job.id)
+                fisbroker_model.drop_watermark_candidate(source_id, watermark.pending_job_id)
+                watermark = fisbroker_model.FisbrokerWatermark.get(source_id)
+        if watermark and watermark.modified:
+            return watermark
+        return None
+
     def get_constraints(self, harvest_job):
         '''Compute and get the query constraint for requesting datasets from
            FIS-Broker.'''
@@ -294,6 +525,13 @@ class FisbrokerPlugin(CSWHarvester):
             return int(self.source_config['timedelta'])
         return TIMEDELTA_DEFAULT
 
+    def _setup_csw_client(self, url):
+        '''Override CSWHarvester._setup_csw_client() to build the CSW client
+           from cached capabilities, so that the GetCapabilities handshake
+           is not repeated for every gather and fetch stage.'''
+        self.csw = CswService()
+        self.csw.__ows_obj__ = catalogue_service(url, timeout=self.get_timeout())
+
     # IHarvester
 
     def info(self):
@@ -334,6 +572,12 @@ class FisbrokerPlugin(CSWHarvester):
                     raise ValueError(
                         '\'timeout\' is not valid: \'%s\'. Please use whole numbers to indicate seconds until timeout.' % timeout)
 
+            if 'gather_mode' in config_obj:
+                gather_mode = config_obj['gather_mode']
+                if gather_mode not in self.gather_modes:
+                    raise ValueError('\'gather_mode\' is not valid: \'%s\'. Use one of %s.' % (
+                        gather_mode, self.gather_modes))
+
             if 'timedelta' in config_obj:
                 _timedelta = config_obj['timedelta']
                 try:
@@ -349,6 +593,329 @@ class FisbrokerPlugin(CSWHarvester):
 
         return CSWHarvester.validate_config(self, config)
 
+    def gather_stage(self, harvest_job):
+        '''Implementation of ckanext.harvest.interfaces.IHarvester.gather_stage().
+           Advances the watermark of the harvest source (see advance_watermark()),
+           then calls CSWHarvester.gather_stage(), or _gather_brief() if the source's
+           `gather_mode` is `brief`, but drops the cached capabilities of the
+           harvest source if gathering failed.
+        '''
+        self._set_source_config(harvest_job.source.config)
+        self.advance_watermark(harvest_job)
+        if self.source_config.get('gather_mode') == 'brief':
+            object_ids = self._gather_brief(harvest_job)
+        else:
+            object_ids = CSWHarvester.gather_stage(self, harvest_job)
+        if object_ids is None:
+            CAPABILITIES_CACHE.invalidate(harvest_job.source.url)
+        return object_ids
+
+    def _gather_brief(self, harvest_job):
+        '''Gather by paging through the GUIDs and modification dates of all
+           records in FIS-Broker, and comparing them to the modification dates of
+           the records harvested so far. Harvest objects are only created for new,
+           changed and deleted records. `import_since` is ignored, as the whole
+           catalogue is listed anyway. Records that were rejected by
+           get_package_dict() and haven't been modified since are skipped (see
+           ckanext.fisbroker.model.FisbrokerRejection).
+        '''
+
+        url = harvest_job.source.url
+        LOG.debug('FisbrokerPlugin brief gather_stage for job: %r', harvest_job)
+
+        query = model.Session.query(HarvestObject.guid, HarvestObject.package_id,
+                                    HarvestObject.metadata_modified_date) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.harvest_source_id == harvest_job.source.id)
+        harvested = {guid: (package_id, modified) for guid, package_id, modified in query}
+        rejections = {rejection.guid: rejection for rejection in
+                      fisbroker_model.FisbrokerRejection.for_source(harvest_job.source.id)}
+
+        modified_in_harvest = {}
+        try:
+            page_size = toolkit.asint(toolkit.config.get(
+                'ckanext.fisbroker.gather.page_size', PAGE_SIZE_DEFAULT))
+            for modified_dates in iter_modified_dates(url, page_size=page_size,
+                                                      timeout=self.get_timeout(),
+                                                      cql=self.source_config.get('cql')):
+                modified_in_harvest.update(modified_dates)
+        except Exception as error:
+            self._save_gather_error('Error gathering the identifiers from the CSW server [{}]'.format(
+                error), harvest_job)
+            return None
+
+        if not modified_in_harvest:
+            self._save_gather_error('No records received from the CSW server', harvest_job)
+            return None
+
+        ids = []
+        unchanged = 0
+        rejected = 0
+        stale_rejections = set(rejections) - set(modified_in_harvest)
+        for guid, modified in modified_in_harvest.items():
+            if guid in rejections:
+                if rejections[guid].is_valid(modified):
+                    rejected += 1
+                    continue
+                stale_rejections.add(guid)
+            extras = []
+            if modified:
+                extras.append(HarvestObjectExtra(key='modified', value=modified))
+            if guid not in harvested:
+                extras.append(HarvestObjectExtra(key='status', value='new'))
+                obj = HarvestObject(guid=guid, job=harvest_job, extras=extras)
+            elif self._modified_since(modified, harvested[guid][1]):
+                extras.append(HarvestObjectExtra(key='status', value='change'))
+                obj = HarvestObject(guid=guid, job=harvest_job, package_id=harvested[guid][0],
+                                    extras=extras)
+            else:
+                unchanged += 1
+                continue
+            obj.save()
+            ids.append(obj.id)
+
+        for guid in set(harvested) - set(modified_in_harvest):
+            obj = HarvestObject(guid=guid, job=harvest_job, package_id=harvested[guid][0],
+                                extras=[HarvestObjectExtra(key='status', value='delete')])
+            model.Session.query(HarvestObject) \
+                .filter_by(guid=guid) \
+                .update({'current': False}, False)
+            obj.save()
+            ids.append(obj.id)
+
+        fisbroker_model.delete_rejections(stale_rejections)
+        model.Session.commit()
+
+        LOG.info('brief gather: %d records in FIS-Broker, %d unchanged, %d rejected before, '
+                 '%d harvest objects created',
+                 len(modified_in_harvest), unchanged, rejected, len(ids))
+        return ids
+
+    def _modified_since(self, modified, harvested_modified):
+        '''Return True if the modification date `modified` reported by FIS-Broker
+           is more recent than `harvested_modified`, or if either is unknown.'''
+
+        if not modified or not harvested_modified:
+            return True
+        try:
+            modified = parse_date(modified).replace(tzinfo=None)
+        except (ValueError, OverflowError):
+            return True
+        return modified > harvested_modified
+
+    def fetch_stage(self, harvest_object):
+        '''Implementation of ckanext.harvest.interfaces.IHarvester.fetch_stage().
+           Replaces CSWHarvester.fetch_stage() to fetch the record through the
+           shared HTTP session (see ckanext.fisbroker.csw_client) instead of
+           a new connection for every record, reading through the record cache
+           if one is configured. Records that were rejected by get_package_dict()
+           and haven't been modified since are not fetched again, unless they are
+           reimported.
+        '''
+
+        # Check harvest object status
+        status = self._get_object_extra(harvest_object, 'status')
+
+        if status == 'delete':
+            # No need to fetch anything, just pass to the import stage
+            return True
+
+        LOG.debug('FisbrokerPlugin fetch_stage for object: %s', harvest_object.id)
+
+        self._set_source_config(harvest_object.source.config)
+        identifier = harvest_object.guid
+        fetcher = BatchedRecordFetcher(harvest_object.source.url, batch_size=1,
+                                       timeout=self.get_timeout(), cache=get_record_cache())
+        # the modification date is known if the record was gathered in brief mode
+        modified = self._get_object_extra(harvest_object, 'modified')
+        if self._get_object_extra(harvest_object, 'type') != 'reimport':
+            rejection = fisbroker_model.FisbrokerRejection.get(identifier)
+            if rejection and rejection.is_valid(modified):
+                harvest_object.extras.append(
+                    HarvestObjectExtra(key='error', value=json.dumps(rejection.error())))
+                harvest_object.save()
+                LOG.debug('Document with GUID %s rejected before, skipping...', identifier)
+                return 'unchanged'
+        cache_hits = set()
+        try:
+            record_xml = fetcher.fetch([identifier], modified={identifier: modified},
+                                       cache_hits=cache_hits)[identifier]
+        except Exception as error:
+            self._save_object_error('Error getting the CSW record with GUID {}: {}'.format(
+                identifier, error), harvest_object)
+            self._save_reimport_error(harvest_object, ERROR_NO_CONNECTION)
+            return False
+
+        if record_xml is None:
+            self._save_object_error('Empty record for GUID {}'.format(identifier),
+                                    harvest_object)
+            self._save_reimport_error(harvest_object, ERROR_NOT_FOUND_IN_FISBROKER)
+            return False
+
+        harvest_object.content = record_xml.strip()
+        if identifier in cache_hits:
+            harvest_object.extras.append(HarvestObjectExtra(key='record_cache', value='hit'))
+        harvest_object.save()
+
+        LOG.debug('XML content saved (len %s)', len(record_xml))
+        return True
+
+    def _save_reimport_error(self, harvest_object, error_code):
+        '''If `harvest_object` was queued by an asynchronous reimport, record
+           `error_code` (one of the ERROR_* codes in ckanext.fisbroker.exceptions)
+           as the reason why it could not be fetched, for the reimport status.'''
+
+        if self._get_object_extra(harvest_object, 'type') == 'reimport':
+            harvest_object.extras.append(
+                HarvestObjectExtra(key='reimport_error', value=str(error_code)))
+            harvest_object.save()
+
+    def import_stage(self, harvest_object):
+        '''Implementation of ckanext.harvest.interfaces.IHarvester.import_stage().
+           Skips records whose content digest (see content_digest()) is the same
+           as that of the last import of the record, unless `force_import` is set.
+           All other records are imported by SpatialHarvester.import_stage(),
+           and the digest is stored if the import was successful.
+           The package index (see ckanext.fisbroker.model.FisbrokerPackage) is
+           updated with the outcome, including the rejection of a record that
+           already had a package.
+           Reimport objects (e.g. queued by an asynchronous reimport) are always
+           imported.
+           New records that check_record() rejects are skipped before their
+           content is read into ISO values, with the same error
+           get_package_dict() would report. Rejections are recorded in the rejection index (see
+           _update_rejection()).
+        '''
+
+        if not self.force_import and \
+                self._get_object_extra(harvest_object, 'type') == 'reimport':
+            self.force_import = True
+            try:
+                return self.import_stage(harvest_object)
+            finally:
+                self.force_import = False
+
+        status = self._get_object_extra(harvest_object, 'status')
+        if status == 'delete' or not harvest_object.content:
+            result = CSWHarvester.import_stage(self, harvest_object)
+            if result and status == 'delete' and harvest_object.package_id:
+                fisbroker_model.update_package_index(harvest_object, 'deleted')
+                model.Session.commit()
+            return result
+
+        if status == 'new':
+            # changed records take the full path, so that their packages are
+            # deactivated when they are skipped
+            error = check_record(harvest_object.content)
+            if error:
+                LOG.debug('Document with GUID %s rejected before import: %s',
+                          harvest_object.guid, error['description'])
+                harvest_object.extras.append(
+                    HarvestObjectExtra(key='error', value=json.dumps(error)))
+                harvest_object.save()
+                self._update_rejection(harvest_object)
+                return True
+
+        digest = content_digest(harvest_object.content,
+                                harvest_object.source.config if harvest_object.source else None)
+        if status == 'change' and not self.force_import:
+            previous_object = model.Session.query(HarvestObject) \
+                .filter(HarvestObject.guid == harvest_object.guid) \
+                .filter(HarvestObject.current == True) \
+                .first()
+            if previous_object and previous_object.package_id and \
+                    self._get_object_extra(previous_object, 'content_digest') == digest:
+                previous_object.current = False
+                previous_object.add()
+                harvest_object.package_id = previous_object.package_id
+                harvest_object.metadata_modified_date = previous_object.metadata_modified_date
+                harvest_object.current = True
+                harvest_object.state = 'COMPLETE'
+                harvest_object.report_status = 'not modified'
+                harvest_object.import_finished = datetime.utcnow()
+                harvest_object.extras.append(HarvestObjectExtra(key='content_digest', value=digest))
+                harvest_object.add()
+                fisbroker_model.update_package_index(harvest_object, 'not modified', digest)
+                model.Session.commit()
+                self._record_watermark_candidate(harvest_object)
+                LOG.info('Document with GUID %s unchanged, skipping...', harvest_object.guid)
+                return 'unchanged'
+
+        result = CSWHarvester.import_stage(self, harvest_object)
+        if result and not self._get_object_extra(harvest_object, 'error'):
+            harvest_object.extras.append(HarvestObjectExtra(key='content_digest', value=digest))
+            if harvest_object.package_id:
+                fisbroker_model.update_package_index(
+                    harvest_object, 'added' if status == 'new' else 'updated', digest)
+            harvest_object.save()
+            if harvest_object.current:
+                self._record_watermark_candidate(harvest_object)
+        elif result and harvest_object.package_id:
+            # the record was rejected, and its package deactivated
+            fisbroker_model.update_package_index(harvest_object, 'rejected')
+            model.Session.commit()
+        if result:
+            self._update_rejection(harvest_object)
+        return result
+
+    def _record_watermark_candidate(self, harvest_object):
+        '''Raise the watermark candidate of the harvest source to the
+           modification date of the imported `harvest_object`, unless it was
+           imported by a reimport (see advance_watermark()).'''
+
+        if harvest_object.metadata_modified_date and \
+                self._get_object_extra(harvest_object, 'type') != 'reimport':
+            fisbroker_model.record_watermark_candidate(
+                harvest_object.harvest_source_id, harvest_object.harvest_job_id,
+                harvest_object.metadata_modified_date)
+
+    def _update_rejection(self, harvest_object):
+        '''Record the rejection of the imported `harvest_object` (its `error`
+           extra) in the rejection index, keyed by the modification date the
+           record was gathered with, or drop the record from the index if it
+           was not rejected. Without a modification date (i.e. if the record
+           wasn't gathered in brief mode), a rejection isn't recorded.
+        '''
+
+        error = self._get_object_extra(harvest_object, 'error')
+        if error:
+            modified = self._get_object_extra(harvest_object, 'modified')
+            try:
+                error = json.loads(error)
+            except ValueError:
+                return
+            if not modified or not isinstance(error, dict):
+                return
+            fisbroker_model.update_rejection(harvest_object, modified, error)
+        else:
+            fisbroker_model.delete_rejections([harvest_object.guid])
+        model.Session.commit()
+
+    # IConfigurable
+
+    def configure(self, config):
+        '''
+        Implementation of
+        https://docs.ckan.org/en/latest/extensions/plugin-interfaces.html#ckan.plugins.interfaces.IConfigurable.configure
+        '''
+        fisbroker_model.setup()
+        CAPABILITIES_CACHE.ttl = toolkit.asint(config.get(
+            'ckanext.fisbroker.csw.capabilities_ttl', CAPABILITIES_TTL_DEFAULT))
+        configure_session(
+            pool_size=toolkit.asint(config.get(
+                'ckanext.fisbroker.http.pool_size', POOL_SIZE_DEFAULT)),
+            max_retries=toolkit.asint(config.get(
+                'ckanext.fisbroker.http.max_retries', MAX_RETRIES_DEFAULT)),
+            backoff_factor=float(config.get(
+                'ckanext.fisbroker.http.backoff_factor', BACKOFF_FACTOR_DEFAULT))
+        )
+        configure_record_cache(
+            config.get('ckanext.fisbroker.record_cache.directory'),
+            max_size=toolkit.asint(config.get(
+                'ckanext.fisbroker.record_cache.max_size', RECORD_CACHE_MAX_SIZE_DEFAULT))
+        )
+        configure_resource_rules(config.get('ckanext.fisbroker.resource_rules'))
+
     # IConfigurer
 
     def update_config(self, config):
@@ -375,6 +942,7 @@ class FisbrokerPlugin(CSWHarvester):
             'berlin_fisbroker_guid': helpers.fisbroker_guid,
             'berlin_package_object': helpers.get_package_object,
             'berlin_is_reimport_job': helpers.is_reimport_job,
+            'berlin_record_cache_hits': helpers.record_cache_hits,
         }
 
     # IRoutes:
@@ -392,6 +960,14 @@ class FisbrokerPlugin(CSWHarvester):
             '/api/harvest/reimport',
             controller='ckanext.fisbroker.controller:FISBrokerController',
             action='reimport_api')
+        map_.connect(
+            '/api/harvest/reimport/batch',
+            controller='ckanext.fisbroker.controller:FISBrokerController',
+            action='reimport_batch_api')
+        map_.connect(
+            '/api/harvest/reimport/status',
+            controller='ckanext.fisbroker.controller:FISBrokerController',
+            action='reimport_status_api')
 
         return map_
 
@@ -420,14 +996,14 @@ class FisbrokerPlugin(CSWHarvester):
             # checking if marked for Open Data
             if not marked_as_opendata(data_dict):
                 LOG.debug("no 'opendata' tag, skipping dataset ...")
-                context['error'] = json.dumps({ 'code': 1, 'description': 'not tagged as open data'})
+                context['error'] = json.dumps(SKIP_NOT_OPENDATA)
                 return 'skip'
             LOG.debug("this is tagged 'opendata', continuing ...")
 
             # we're only interested in service resources
             if not marked_as_service_resource(data_dict):
                 LOG.debug("this is not a service resource, skipping dataset ...")
-                context['error'] = json.dumps({'code': 2, 'description': 'not a service resource'})
+                context['error'] = json.dumps(SKIP_NOT_SERVICE)
                 return 'skip'
             LOG.debug("this is a not service resource, continuing ...")
 
@@ -447,14 +1023,14 @@ class FisbrokerPlugin(CSWHarvester):
                 package_dict['author'] = contact_info['author']
             else:
                 LOG.error('could not determine responsible organisation name, skipping ...')
-                context['error'] = json.dumps({'code': 3, 'description': 'no organisation name'})
+                context['error'] = json.dumps(SKIP_NO_ORGANISATION_NAME)
                 return 'skip'
 
             if 'maintainer_email' in contact_info:
                 package_dict['maintainer_email'] = contact_info['maintainer_email']
             else:
                 LOG.error('could not determine responsible organisation email, skipping ...')
-                context['error'] = json.dumps({'code': 4, 'description': 'no responsible organisation email'})
+                context['error'] = json.dumps(SKIP_NO_ORGANISATION_EMAIL)
                 return 'skip'
 
             if 'maintainer' in contact_info:
@@ -469,7 +1045,7 @@ class FisbrokerPlugin(CSWHarvester):
 
             if 'license_id' not in license_and_attribution:
                 LOG.error('could not determine license code, skipping ...')
-                context['error'] = json.dumps({'code': 5, 'description': 'could not determine license code'})
+                context['error'] = json.dumps(SKIP_NO_LICENSE)
                 return 'skip'
 
             package_dict['license_id'] = license_and_attribution['license_id']
@@ -483,7 +1059,7 @@ class FisbrokerPlugin(CSWHarvester):
 
             if 'date_released' not in reference_dates:
                 LOG.error('could not get anything for date_released from ISO values, skipping ...')
-                context['error'] = json.dumps({'code': 6, 'description': 'no release date'})
+                context['error'] = json.dumps(SKIP_NO_RELEASE_DATE)
                 return 'skip'
 
             extras['date_released'] = reference_dates['date_released']
@@ -565,31 +1141,60 @@ class FisbrokerPlugin(CSWHarvester):
     def last_error_free_job(cls, harvest_job):
         '''Override last_error_free_job() from
            ckanext.harvest.harvesters.base.HarvesterBase to filter out
-           jobs that were created by a reimport action.'''
-
-        jobs = \
+           jobs that were created by a reimport action.
+           The job is found with a single query, and memoised per source until
+           another job of the source finishes.'''
+
+        source_id = harvest_job.source.id
+        finished_jobs = model.Session.query(func.count(HarvestJob.id), func.max(HarvestJob.finished)) \
+            .filter(HarvestJob.source_id == source_id) \
+            .filter(HarvestJob.status == 'Finished') \
+            .one()
+        memo = cls._last_error_free_jobs.get(source_id)
+        if memo and memo[0] == finished_jobs and memo[1] != harvest_job.id:
+            return HarvestJob.get(memo[1]) if memo[1] else None
+
+        reimport_objects = model.Session.query(HarvestObject.id) \
+            .join(HarvestObjectExtra, HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == HarvestJob.id) \
+            .filter(HarvestObjectExtra.key == 'type') \
+            .filter(HarvestObjectExtra.value == 'reimport')
+        failed_objects = model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == HarvestJob.id) \
+            .filter(HarvestObject.current == False) \
+            .filter(or_(HarvestObject.report_status == None,
+                        HarvestObject.report_status != 'not modified'))
+        job = \
             model.Session.query(HarvestJob) \
-                 .filter(HarvestJob.source == harvest_job.source) \
+                 .filter(HarvestJob.source_id == source_id) \
                  .filter(HarvestJob.gather_started != None) \
                  .filter(HarvestJob.status == 'Finished') \
                  .filter(HarvestJob.id != harvest_job.id) \
                  .filter(
                      ~exists().where(
                          HarvestGatherError.harvest_job_id == HarvestJob.id)) \
-                 .order_by(HarvestJob.gather_started.desc())
+                 .filter(~reimport_objects.exists()) \
+                 .filter(~failed_objects.exists()) \
+                 .order_by(HarvestJob.gather_started.desc()) \
+                 .first()
 
-        # now check them until we find one with no fetch/import errors,
-        # which isn't a reimport job
-        for job in jobs:
-            if helpers.is_reimport_job(job):
-                continue
-            for obj in job.objects:
-                if obj.current is False and \
-                        obj.report_status != 'not modified':
-                    # unsuccessful, so go onto the next job
-                    break
-            else:
-                return job
+        cls._last_error_free_jobs[source_id] = (finished_jobs, job.id if job else None)
+        return job
+
+    @classmethod
+    def is_error_free_job(cls, harvest_job):
+        '''Return True if `harvest_job` has neither gather errors nor objects
+           that failed, with the same criteria as last_error_free_job().'''
+
+        gather_errors = model.Session.query(HarvestGatherError.id) \
+            .filter(HarvestGatherError.harvest_job_id == harvest_job.id)
+        failed_objects = model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == harvest_job.id) \
+            .filter(HarvestObject.current == False) \
+            .filter(or_(HarvestObject.report_status == None,
+                        HarvestObject.report_status != 'not modified'))
+        return not model.Session.query(
+            or_(gather_errors.exists(), failed_objects.exists())).scalar()
 
 class AlwaysValid(BaseValidator):
     '''A validator that always validates. Needed because FIS-Broker-XML
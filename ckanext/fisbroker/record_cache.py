@@ -0,0 +1,181 @@
+# coding: utf-8
+"""An on-disk cache for raw FIS-Broker records, keyed by GUID and modification
+date. The cache can be shared between several processes (e.g., web and harvest
+workers) on the same host."""
+
+import errno
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+from threading import Lock
+
+LOG = logging.getLogger(__name__)
+MAX_SIZE_DEFAULT = 256
+EVICTION_INTERVAL = 100
+LOCK_FILE_NAME = '.lock'
+_RECORD_CACHE = None
+
+
+def _key_hash(value):
+    '''Return a hex digest of `value` that can be used as part of a file name.'''
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return hashlib.sha1(value).hexdigest()
+
+
+class RecordCache(object):
+    '''Cache of raw record XML on disk, keyed by GUID and the record's modification
+       date. Only one version (the last one written) of each record is kept, and
+       the cache is bounded to `max_size` megabytes by evicting the least recently
+       used records.
+       Records are written atomically (write to a temporary file, then rename),
+       so that concurrent readers in other processes never see partial records.
+       Eviction is serialized between processes with a lock file.'''
+
+    def __init__(self, directory, max_size=MAX_SIZE_DEFAULT):
+        self.directory = directory
+        self.max_size = max_size * 1024 * 1024
+        self._puts = 0
+        self._lock = Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+    def _record_dir(self, guid):
+        return os.path.join(self.directory, _key_hash(guid)[:2])
+
+    def _record_path(self, guid, modified):
+        return os.path.join(self._record_dir(guid),
+                            "{}-{}.xml".format(_key_hash(guid), _key_hash(modified)))
+
+    def get(self, guid, modified):
+        '''Return the cached XML of the record with `guid` and `modified` date, or
+           None if it is not in the cache.'''
+
+        path = self._record_path(guid, modified)
+        try:
+            with open(path, 'rb') as record_file:
+                record_xml = record_file.read()
+            # touch the file to mark it as recently used
+            os.utime(path, None)
+        except (IOError, OSError) as error:
+            if error.errno != errno.ENOENT:
+                LOG.warning("could not read cached record %s: %s", guid, error)
+            return None
+        return record_xml
+
+    def put(self, guid, modified, record_xml):
+        '''Store `record_xml` as the record with `guid` and `modified` date.
+           Older versions of the record are removed.'''
+
+        record_dir = self._record_dir(guid)
+        path = self._record_path(guid, modified)
+        try:
+            if not os.path.isdir(record_dir):
+                os.makedirs(record_dir)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        if isinstance(record_xml, unicode):
+            record_xml = record_xml.encode('utf-8')
+
+        file_descriptor, temp_path = tempfile.mkstemp(dir=record_dir, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                temp_file.write(record_xml)
+            os.rename(temp_path, path)
+        except Exception:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        for old_path in glob.glob(os.path.join(record_dir, "{}-*.xml".format(_key_hash(guid)))):
+            if old_path != path:
+                self._remove(old_path)
+
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                LOG.warning("could not remove cached record %s: %s", path, error)
+
+    def size(self):
+        '''Return the total size of all cached records in bytes.'''
+
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        '''Return a list of (mtime, size, path) tuples for all cached records.'''
+
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*', '*.xml')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        '''Remove the least recently used records until the cache is no bigger than
+           `max_size`. If another process is already evicting, do nothing.'''
+
+        lock_path = os.path.join(self.directory, LOCK_FILE_NAME)
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                LOG.debug("record cache eviction already running in another process")
+                return
+            try:
+                entries = self._entries()
+                total_size = sum(size for _, size, _ in entries)
+                if total_size <= self.max_size:
+                    return
+                evicted = 0
+                for _, size, path in sorted(entries):
+                    if total_size <= self.max_size:
+                        break
+                    self._remove(path)
+                    total_size -= size
+                    evicted += 1
+                LOG.info("evicted %d records from record cache %s", evicted, self.directory)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def configure_record_cache(directory, max_size=MAX_SIZE_DEFAULT):
+    '''Set up the record cache used for all fetches from FIS-Broker. If `directory`
+       is empty, no record cache is used.'''
+
+    global _RECORD_CACHE
+
+    if directory:
+        LOG.info("using record cache in %s (max. %d MB)", directory, max_size)
+        _RECORD_CACHE = RecordCache(directory, max_size)
+    else:
+        _RECORD_CACHE = None
+    return _RECORD_CACHE
+
+
+def get_record_cache():
+    '''Return the record cache used for all fetches from FIS-Broker, or None if
+       the record cache is disabled.'''
+
+    return _RECORD_CACHE
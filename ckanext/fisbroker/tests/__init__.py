@@ -24,6 +24,7 @@ from ckanext.harvest.model import (
 from ckanext.harvest.tests import factories as harvest_factories
 
 from ckanext.fisbroker import HARVESTER_ID
+from ckanext.fisbroker import model as fisbroker_model
 from ckanext.fisbroker.plugin import FisbrokerPlugin
 from ckanext.fisbroker.tests.mock_fis_broker import start_mock_server, reset_mock_server, VALID_GUID, METADATA_OLD
 from ckanext.fisbroker.tests.xml_file_server import serve
@@ -65,6 +66,7 @@ class FisbrokerTestBase(helpers.FunctionalTestBase):
 
     def setup(self):
         super(FisbrokerTestBase, self).setup()
+        fisbroker_model.setup()
         reset_mock_server()
         # Add sysadmin user
         user_name = u'harvest'
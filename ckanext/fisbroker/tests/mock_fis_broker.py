@@ -50,6 +50,47 @@ def read_responses():
             responses[name] = response_file.read()
     return responses
 
+def merge_records(records):
+    """Merge several canned GetRecordById responses into a single response
+       containing all their records."""
+
+    if len(records) == 1:
+        return records[0]
+    merged = etree.fromstring(records[0])
+    for record in records[1:]:
+        for metadata in etree.fromstring(record).iterchildren('{http://www.isotc211.org/2005/gmd}MD_Metadata'):
+            merged.append(metadata)
+    return etree.tostring(merged, xml_declaration=True, encoding='UTF-8')
+
+def summary_records(guids):
+    """Build a GetRecords response with the summary records (identifier and
+       modification date) of all canned records in `guids`."""
+
+    csw = 'http://www.opengis.net/cat/csw/2.0.2'
+    namespaces = {
+        'csw': csw,
+        'dc': 'http://purl.org/dc/elements/1.1/',
+        'dct': 'http://purl.org/dc/terms/',
+    }
+    response = etree.Element('{%s}GetRecordsResponse' % csw, nsmap=namespaces)
+    results = etree.SubElement(response, '{%s}SearchResults' % csw, elementSet='summary')
+    for guid in guids:
+        record = RESPONSES['records'].get(guid)
+        if not record:
+            continue
+        modified = etree.fromstring(record).xpath(
+            '//gmd:dateStamp/gco:DateTime/text()',
+            namespaces={'gmd': 'http://www.isotc211.org/2005/gmd',
+                        'gco': 'http://www.isotc211.org/2005/gco'})
+        summary = etree.SubElement(results, '{%s}SummaryRecord' % csw)
+        etree.SubElement(summary, '{%s}identifier' % namespaces['dc']).text = guid
+        if modified:
+            etree.SubElement(summary, '{%s}modified' % namespaces['dct']).text = modified[0].strip()
+    results.set('numberOfRecordsMatched', str(len(results)))
+    results.set('numberOfRecordsReturned', str(len(results)))
+    results.set('nextRecord', '0')
+    return etree.tostring(response, xml_declaration=True, encoding='UTF-8')
+
 RESPONSES = read_responses()
 LOG.debug("responses: %s", RESPONSES['records'].keys())
 
@@ -80,23 +121,27 @@ class MockFISBroker(BaseHTTPRequestHandler):
                     # exists, it will be served. If it doesn't exist, the 'no_record_found'
                     # response will be served, leading to an error in the harvest job.
                     # This can be used for tests that somehow involve errored harvest jobs.
-                    record_id = query.get('id')
+                    # Several ids can be requested at once, separated by commas.
+                    record_ids = query.get('id')
                     LOG.debug("this is a GetRecordById request: %s",
                               MockFISBroker.count_get_records)
-                    if record_id:
-                        record_id = record_id[0]
-                        if record_id not in RESPONSES['records']:
-                            record_id = "{}_{}".format(
-                                record_id, str(MockFISBroker.count_get_records).rjust(2, '0'))
-                        LOG.debug("looking for %s", record_id)
-                        if record_id == "cannot_connect_00":
-                            # mock a timeout happening during a GetRecordById request
-                            raise Timeout()
-                        record = RESPONSES['records'].get(record_id)
-                        if record:
+                    if record_ids:
+                        records = []
+                        for record_id in record_ids[0].split(','):
+                            if record_id not in RESPONSES['records']:
+                                record_id = "{}_{}".format(
+                                    record_id, str(MockFISBroker.count_get_records).rjust(2, '0'))
+                            LOG.debug("looking for %s", record_id)
+                            if record_id == "cannot_connect_00":
+                                # mock a timeout happening during a GetRecordById request
+                                raise Timeout()
+                            record = RESPONSES['records'].get(record_id)
+                            if record:
+                                records.append(record)
+                        if records:
                             response_code = requests.codes.ok
                             content_type = 'text/xml; charset=utf-8'
-                            response_content = record
+                            response_content = merge_records(records)
                         else:
                             response_code = requests.codes.ok
                             # /\ that really is the response code if id is not found...
@@ -133,7 +178,15 @@ class MockFISBroker(BaseHTTPRequestHandler):
         csw_request = root.tag
         content_type = "application/xml"
         response_content = "<foo></foo>"
-        if csw_request == "{http://www.opengis.net/cat/csw/2.0.2}GetRecords":
+        guids = root.xpath('//ogc:PropertyIsEqualTo[ogc:PropertyName="dc:identifier"]/ogc:Literal/text()',
+                           namespaces={'ogc': 'http://www.opengis.net/ogc'})
+        if csw_request == "{http://www.opengis.net/cat/csw/2.0.2}GetRecords" and guids:
+            # a lookup of the modification dates of some records, which doesn't
+            # count as a harvest run
+            LOG.debug("this is a GetRecords request for %s", guids)
+            response_content = summary_records(guids)
+            response_code = 200
+        elif csw_request == "{http://www.opengis.net/cat/csw/2.0.2}GetRecords":
             MockFISBroker.count_get_records += 1
             LOG.debug("this is a GetRecords request: %s", MockFISBroker.count_get_records)
             response_content = RESPONSES['csw_getrecords_01']
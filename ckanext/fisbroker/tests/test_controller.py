@@ -3,8 +3,12 @@
 
 import json
 import logging
+import shutil
+import tempfile
+import time
 from nose.tools import assert_raises, nottest
 from urlparse import urlparse
+from requests.exceptions import Timeout
 from webtest import AppError
 
 from ckan.common import c
@@ -18,14 +22,18 @@ from ckan.model import Session
 from ckan.model.package import Package
 from ckan.plugins import implements, SingletonPlugin
 from ckan.tests import factories as ckan_factories
+from ckan.tests import helpers
 
 
 from ckanext.harvest.interfaces import IHarvester
-from ckanext.harvest.model import HarvestSource
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestObjectExtra, HarvestSource
 from ckanext.harvest.tests import factories
 from ckanext.fisbroker import HARVESTER_ID
 import ckanext.fisbroker.controller as controller
+from ckanext.fisbroker.csw_client import BatchedRecordFetcher
 from ckanext.fisbroker.controller import get_error_dict, ERROR_MESSAGES, ERROR_DURING_IMPORT
+from ckanext.fisbroker.exceptions import ERROR_NOT_FOUND_IN_FISBROKER
+from ckanext.fisbroker.helper import record_cache_hits
 from ckanext.fisbroker.exceptions import (
     NoFBHarvesterDefined,
     PackageIdDoesNotExistError,
@@ -33,7 +41,11 @@ from ckanext.fisbroker.exceptions import (
     PackageNotHarvestedInFisbrokerError,
     NoFisbrokerIdError,
     NoConnectionError,
+    FBImportError,
+    ReimportDeferred,
 )
+from ckanext.fisbroker.model import FisbrokerPackage, FisbrokerReimportRun
+from ckanext.fisbroker.record_cache import configure_record_cache
 from ckanext.fisbroker.tests import _assert_equal, _assert_not_equal, FisbrokerTestBase, FISBROKER_HARVESTER_CONFIG
 from ckanext.fisbroker.tests.mock_fis_broker import VALID_GUID, INVALID_GUID
 
@@ -117,6 +129,34 @@ class TestReimport(FisbrokerTestBase):
         _assert_equal(response.status_int, 302)
         _assert_equal(url.path, "/dataset/{}".format(package_id))
 
+    def test_reimport_api_queued(self):
+        '''An asynchronous reimport should respond with an HTTP 202 and the id of
+           a running reimport job with one queued object per package. Another
+           reimport while that job runs should be refused with an HTTP 409 and
+           internal error code 13.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(self.context, fb_dataset_dict)
+        package_id = fb_dataset_dict['id']
+        url = "/api/harvest/reimport?id={}&async=true".format(package_id)
+        extra_environ = {'REMOTE_USER': self.context['user'].encode('ascii')}
+        response = self.app.get(url, headers={'Accept': 'application/json'},
+                                extra_environ=extra_environ)
+
+        _assert_equal(response.status_int, 202)
+        content = json.loads(response.body)
+        assert content['success']
+        reimport_job = HarvestJob.get(content['job_id'])
+        _assert_equal(reimport_job.status, u'Running')
+        _assert_equal([obj.package_id for obj in reimport_job.objects], [package_id])
+        _assert_equal(content['status_url'],
+                      "/api/harvest/reimport/status?id={}".format(reimport_job.id))
+
+        response = self.app.get(url, headers={'Accept': 'application/json'},
+                                extra_environ=extra_environ, expect_errors=True)
+        _assert_equal(response.status_int, 409)
+        _assert_equal(json.loads(response.body)['error']['code'], controller.ERROR_JOB_EXISTS)
+
     def test_can_only_reimport_harvested_packages(self):
         '''If we try to reimport an existing package that was not generated by a harvester, the response
            should be an HTTP 422, with an internal error code 5.'''
@@ -225,6 +265,69 @@ class TestReimport(FisbrokerTestBase):
         _assert_equal(package.title, u"Nährstoffversorgung des Oberbodens 2015 (Umweltatlas) - [WFS]")
         _assert_not_equal(package.title, old_title)
 
+    def test_reimport_batch_api_streams_outcomes(self):
+        '''A POST with several ids (or GUIDs) should reimport them in one job
+           and return one line of JSON per package.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        job.status = u'Finished'
+        job.save()
+        package_update(self.context, fb_dataset_dict)
+        response = self.app.post(
+            url="/api/harvest/reimport/batch",
+            params=json.dumps({'ids': ['dunk', VALID_GUID]}),
+            headers={'Content-Type': 'application/json'},
+            extra_environ={'REMOTE_USER': self.context['user'].encode('ascii')}
+        )
+
+        _assert_equal(response.status_int, 200)
+        lines = [json.loads(line) for line in response.body.splitlines()]
+        outcomes = dict((line['package_id'], line) for line in lines)
+        _assert_equal(len(lines), 2)
+        _assert_equal(outcomes['dunk']['error']['code'], controller.ERROR_NOT_FOUND_IN_CKAN)
+        assert outcomes[fb_dataset_dict['id']]['success']
+        _assert_equal(outcomes[fb_dataset_dict['id']]['guid'], VALID_GUID)
+        # the job is finished once the stream has been consumed
+        reimport_job = Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id == source.id) \
+            .order_by(HarvestJob.created.desc()).first()
+        _assert_not_equal(reimport_job.id, job.id)
+        _assert_equal(reimport_job.status, u'Finished')
+        _assert_equal([obj.package_id for obj in reimport_job.objects], [fb_dataset_dict['id']])
+
+    def test_reimport_batch_api_requires_string_ids(self):
+        '''A POST whose 'ids' aren't a list of strings should be refused with
+           an HTTP 400.'''
+
+        self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        for ids in [[1, 2], [['dunk']], 'dunk']:
+            response = self.app.post(
+                url="/api/harvest/reimport/batch",
+                params=json.dumps({'ids': ids}),
+                headers={'Content-Type': 'application/json'},
+                extra_environ={'REMOTE_USER': self.context['user'].encode('ascii')},
+                expect_errors=True
+            )
+            _assert_equal(response.status_int, 400)
+
+    def test_reimport_batch_api_job_exists(self):
+        '''A POST while another job of the harvest source is unfinished should
+           be refused with an HTTP 409 before anything is streamed.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(self.context, fb_dataset_dict)
+        controller.FISBrokerController().create_reimport_job(self.context)
+        response = self.app.post(
+            url="/api/harvest/reimport/batch",
+            params=json.dumps({'ids': [fb_dataset_dict['id']]}),
+            headers={'Content-Type': 'application/json'},
+            extra_environ={'REMOTE_USER': self.context['user'].encode('ascii')},
+            expect_errors=True
+        )
+
+        _assert_equal(response.status_int, 409)
+        _assert_equal(json.loads(response.body)['error']['code'], controller.ERROR_JOB_EXISTS)
+
     def test_reimport_anonymously_fails(self):
         '''Only a logged in user can initiate a successful reimport, so anonymous access
            should raise an authorization error.'''
@@ -269,6 +372,133 @@ class TestReimport(FisbrokerTestBase):
         _assert_equal(content['error']['code'], ERROR_DURING_IMPORT)
         package = Package.get(package_id)
         _assert_equal(package.state, 'deleted')
+        _assert_equal(FisbrokerPackage.get(package_id).status, 'rejected')
+
+    def test_failed_reimport_finishes_job(self):
+        '''A reimport that fails with an error should still finish its job,
+           so that the next reimport isn't refused.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(
+            FISBROKER_HARVESTER_CONFIG, fb_guid=INVALID_GUID)
+        job.status = u'Finished'
+        job.save()
+        package_update(self.context, fb_dataset_dict)
+        fb_controller = controller.FISBrokerController()
+
+        with assert_raises(FBImportError):
+            fb_controller.reimport_batch([fb_dataset_dict['id']], self.context)
+
+        reimport_job = Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id == source.id) \
+            .order_by(HarvestJob.created.desc()).first()
+        _assert_not_equal(reimport_job.id, job.id)
+        _assert_equal(reimport_job.status, u'Finished')
+
+    def test_reimport_batch_into_existing_job(self):
+        '''Reimporting into an existing job should leave the job running
+           for the caller to finish.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(self.context, fb_dataset_dict)
+        fb_controller = controller.FISBrokerController()
+        reimport_job = fb_controller.create_reimport_job(self.context)
+        # a New job would be gathered by `harvester run`
+        _assert_equal(reimport_job.status, u'Running')
+        _assert_equal(reimport_job.gather_finished, None)
+
+        reimported = fb_controller.reimport_batch(
+            [fb_dataset_dict['id']], self.context, job_id=reimport_job.id)
+
+        _assert_equal(reimported, [fb_dataset_dict['id']])
+        Session.refresh(reimport_job)
+        _assert_not_equal(reimport_job.status, u'Finished')
+        _assert_equal(len(reimport_job.objects), 1)
+        fb_controller.finish_reimport_job(reimport_job)
+        _assert_equal(reimport_job.status, u'Finished')
+
+    def test_reimport_status(self):
+        '''The status of a reimport job should report each package as pending,
+           reimported or failed with the error code recorded by the fetch stage.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        fb_controller = controller.FISBrokerController()
+        reimport_job = fb_controller.create_reimport_job(self.context)
+        for package_id, state, extras in [
+                ('package-a', u'COMPLETE', []),
+                ('package-b', u'ERROR', [HarvestObjectExtra(key='reimport_error',
+                                                            value=str(ERROR_NOT_FOUND_IN_FISBROKER))]),
+                ('package-c', u'WAITING', [])]:
+            HarvestObject(guid=package_id, job=reimport_job, package_id=package_id, state=state,
+                          extras=[HarvestObjectExtra(key='type', value='reimport')] + extras).save()
+
+        status = fb_controller.reimport_status(reimport_job)
+
+        _assert_equal(status['job_id'], reimport_job.id)
+        _assert_equal((status['pending'], status['reimported'], status['failed']), (1, 1, 1))
+        _assert_equal(status['packages']['package-a'], {'success': True})
+        _assert_equal(status['packages']['package-b']['error']['code'],
+                      ERROR_NOT_FOUND_IN_FISBROKER)
+        _assert_equal(status['packages']['package-c'], {'success': None, 'state': u'WAITING'})
+
+    def test_reimport_run_checkpoint(self):
+        '''A checkpoint of a reimport run should be readable from a fresh
+           session, so that the run can be resumed in its harvest job.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        fb_controller = controller.FISBrokerController()
+        reimport_job = fb_controller.create_reimport_job(self.context)
+        run = FisbrokerReimportRun.start(['a', 'b', 'c'], reimport_job.id)
+        failure = {'success': False, 'error': {'code': 1, 'message': 'dunk'}}
+        run.checkpoint(['a', 'b'], {'b': failure})
+        run_id = run.id
+        Session.remove()
+
+        run = FisbrokerReimportRun.get(run_id)
+        _assert_equal(run.job_id, reimport_job.id)
+        _assert_equal(run.package_ids_list(), ['a', 'b', 'c'])
+        _assert_equal(run.processed_list(), ['a', 'b'])
+        _assert_equal(run.failures_dict(), {'b': failure})
+        _assert_equal(run.status, u'running')
+
+    def test_reimport_batch_continue_on_error(self):
+        '''With an outcomes dict, packages that cannot be reimported should be
+           reported with their error code, and the others should still be
+           reimported in a finished job.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(self.context, fb_dataset_dict)
+        non_fb_dataset_dict = ckan_factories.Dataset()
+        package_ids = ['dunk', non_fb_dataset_dict['id'], fb_dataset_dict['id']]
+        fb_controller = controller.FISBrokerController()
+        outcomes = {}
+
+        reimported = fb_controller.reimport_batch(package_ids, self.context, outcomes=outcomes)
+
+        _assert_equal(reimported, [fb_dataset_dict['id']])
+        _assert_equal(outcomes[fb_dataset_dict['id']], {'success': True})
+        _assert_equal(outcomes['dunk']['error']['code'], controller.ERROR_NOT_FOUND_IN_CKAN)
+        _assert_equal(outcomes[non_fb_dataset_dict['id']]['error']['code'],
+                      controller.ERROR_NOT_HARVESTED)
+        reimport_job = Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id == source.id) \
+            .order_by(HarvestJob.created.desc()).first()
+        _assert_equal(reimport_job.status, u'Finished')
+
+    def test_reimport_batch_all_failed_creates_no_job(self):
+        '''If no package passes the checks done before contacting FIS-Broker,
+           only the failures should be reported, without a reimport job.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        fb_controller = controller.FISBrokerController()
+        outcomes = {}
+
+        reimported = fb_controller.reimport_batch(['dunk'], self.context, outcomes=outcomes)
+
+        _assert_equal(reimported, [])
+        _assert_equal(outcomes['dunk']['error']['code'], controller.ERROR_NOT_FOUND_IN_CKAN)
+        _assert_equal([harvest_job.id for harvest_job in
+                       Session.query(HarvestJob).filter(HarvestJob.source_id == source.id)],
+                      [job.id])
 
     def test_reimport_batch_raise_error_if_no_fb_havester_defined(self):
         '''Calling reimport_batch when there is not FIS-Broker harvester
@@ -376,6 +606,170 @@ class TestReimport(FisbrokerTestBase):
         with assert_raises(NoConnectionError):
             fb_controller.reimport_batch(package_ids, self.context)
 
+    def test_reimport_api_deadline(self):
+        '''A synchronous reimport that can't be done before its deadline should
+           respond with an HTTP 202 and the status URL of the reimport job the
+           package was queued in.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        job.status = u'Finished'
+        job.save()
+        package_update(self.context, fb_dataset_dict)
+        package_id = fb_dataset_dict['id']
+        response = self.app.get(
+            url="/api/harvest/reimport?id={}&deadline=0.000001".format(package_id),
+            headers={'Accept': 'application/json'},
+            extra_environ={'REMOTE_USER': self.context['user'].encode('ascii')}
+        )
+
+        _assert_equal(response.status_int, 202)
+        content = json.loads(response.body)
+        assert content['success']
+        queued_job = HarvestJob.get(content['job_id'])
+        _assert_equal(queued_job.status, u'Running')
+        _assert_equal([obj.package_id for obj in queued_job.objects], [package_id])
+        _assert_equal(content['status_url'],
+                      "/api/harvest/reimport/status?id={}".format(queued_job.id))
+
+    def test_reimport_batch_deferred_on_timeout(self):
+        '''If fetching a record times out while there is a deadline, the reimport
+           should stop, finish its job and queue the remaining packages in a new
+           reimport job, raising ReimportDeferred.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        job.status = u'Finished'
+        job.save()
+        package_update(self.context, fb_dataset_dict)
+        package_id = fb_dataset_dict['id']
+        fb_controller = controller.FISBrokerController()
+
+        pipeline = controller.RecordFetchPipeline
+        controller.RecordFetchPipeline = TimeoutPipeline
+        try:
+            with assert_raises(ReimportDeferred) as deferred:
+                fb_controller.reimport_batch([package_id], self.context,
+                                             deadline=time.time() + 60)
+        finally:
+            controller.RecordFetchPipeline = pipeline
+
+        _assert_equal(deferred.exception.package_ids, [package_id])
+        queued_job = HarvestJob.get(deferred.exception.job_id)
+        _assert_equal([obj.package_id for obj in queued_job.objects], [package_id])
+        reimport_jobs = Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id == source.id) \
+            .filter(HarvestJob.id != job.id) \
+            .filter(HarvestJob.id != queued_job.id).all()
+        _assert_equal([reimport_job.status for reimport_job in reimport_jobs], [u'Finished'])
+        _assert_equal(reimport_jobs[0].objects, [])
+
+    def test_import_records_deletes_leftovers_at_deadline(self):
+        '''If the longest import so far would end after the deadline, the
+           harvest objects that weren't imported should be deleted.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        job.status = u'Finished'
+        job.save()
+        fb_controller = controller.FISBrokerController()
+        reimport_job = fb_controller.create_reimport_job(self.context)
+        records = [(fb_dataset_dict['id'], VALID_GUID, '<xml/>', False)]
+
+        outcomes = list(fb_controller._import_records(
+            controller.FisbrokerPlugin(), reimport_job, records,
+            deadline=time.time() + 10, durations=[60]))
+
+        _assert_equal(outcomes, [])
+        Session.refresh(reimport_job)
+        _assert_equal(reimport_job.objects, [])
+
+    def test_import_records_deletes_leftovers_on_error(self):
+        '''If a record of a chunk is rejected and the reimport doesn't continue
+           on errors, the harvest objects of the records after it should be
+           deleted before the FBImportError is raised.'''
+
+        invalid_dataset_dict, source, job = self._harvester_setup(
+            FISBROKER_HARVESTER_CONFIG, fb_guid=INVALID_GUID)
+        package_update(self.context, invalid_dataset_dict)
+        fb_controller = controller.FISBrokerController()
+        reimport_job = fb_controller.create_reimport_job(self.context)
+        fetched = BatchedRecordFetcher(FISBROKER_HARVESTER_CONFIG['url']).fetch(
+            [INVALID_GUID, VALID_GUID])
+        records = [
+            (invalid_dataset_dict['id'], INVALID_GUID, fetched[INVALID_GUID], False),
+            ('dunk', VALID_GUID, fetched[VALID_GUID], False),
+        ]
+
+        with assert_raises(FBImportError):
+            list(fb_controller._import_records(
+                controller.FisbrokerPlugin(), reimport_job, records))
+
+        Session.refresh(reimport_job)
+        _assert_equal([obj.guid for obj in reimport_job.objects], [INVALID_GUID])
+
+    @helpers.change_config('ckanext.fisbroker.reimport.chunk_size', 1)
+    def test_reimport_batch_chunk_size(self):
+        '''The fetched records should be imported in chunks of
+           `ckanext.fisbroker.reimport.chunk_size` records.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(self.context, fb_dataset_dict)
+        invalid_dataset = ckan_factories.Dataset()
+        harvest_object = factories.HarvestObjectObj(guid=INVALID_GUID, job=job, source=source,
+                                                    package_id=invalid_dataset['id'])
+        harvest_object.current = True
+        harvest_object.save()
+        fb_controller = controller.FISBrokerController()
+        chunks = []
+        import_records = fb_controller._import_records
+
+        def record_chunks(harvester, harvest_job, records, *args):
+            if records:
+                chunks.append([record[0] for record in records])
+            return import_records(harvester, harvest_job, records, *args)
+
+        fb_controller._import_records = record_chunks
+        outcomes = {}
+        fb_controller.reimport_batch([fb_dataset_dict['id'], invalid_dataset['id']],
+                                     self.context, outcomes=outcomes)
+
+        _assert_equal(sorted(chunks),
+                      sorted([[fb_dataset_dict['id']], [invalid_dataset['id']]]))
+        _assert_equal(outcomes[fb_dataset_dict['id']], {'success': True})
+        _assert_equal(outcomes[invalid_dataset['id']]['error']['code'], ERROR_DURING_IMPORT)
+
+    def test_reimport_batch_reads_record_cache(self):
+        '''A reimport should look up the modification dates of its records,
+           so that a record that hasn't changed since the previous reimport
+           is served from the record cache.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(self.context, fb_dataset_dict)
+        fb_controller = controller.FISBrokerController()
+        directory = tempfile.mkdtemp()
+        configure_record_cache(directory)
+        try:
+            hits = []
+            for _ in range(2):
+                fb_controller.reimport_batch([fb_dataset_dict['id']], self.context)
+                reimport_job = Session.query(HarvestJob) \
+                    .filter(HarvestJob.source_id == source.id) \
+                    .order_by(HarvestJob.created.desc()).first()
+                hits.append(record_cache_hits(reimport_job))
+        finally:
+            configure_record_cache(None)
+            shutil.rmtree(directory)
+
+        _assert_equal(hits, [0, 1])
+
+class TimeoutPipeline(object):
+    '''A replacement for RecordFetchPipeline whose requests all time out.'''
+
+    def __init__(self, fetcher, workers=None, queue_size=None):
+        self.fetcher = fetcher
+
+    def records(self, items, deadline=None):
+        for package_id, fb_guid in items:
+            yield package_id, fb_guid, None, False, Timeout()
+
 class DummyHarvester(SingletonPlugin):
     '''A dummy harvester for testing purposes.'''
 
@@ -0,0 +1,223 @@
+# coding: utf-8
+"""Tests for ckanext.fisbroker.csw_client.py"""
+
+import logging
+import time
+
+from lxml import etree
+from requests.exceptions import RequestException
+
+from ckanext.fisbroker.csw_client import (
+    BatchedRecordFetcher,
+    CapabilitiesCache,
+    RecordFetchPipeline,
+    catalogue_service,
+    configure_session,
+    get_modified_dates,
+    get_session,
+    iter_modified_dates,
+    parse_modified_dates,
+    split_records,
+)
+from ckanext.fisbroker.tests import _assert_equal, FISBROKER_HARVESTER_CONFIG
+from ckanext.fisbroker.tests.mock_fis_broker import (
+    merge_records,
+    METADATA_NOW,
+    RESPONSES,
+    VALID_GUID,
+    INVALID_GUID,
+)
+
+LOG = logging.getLogger(__name__)
+CSW_URL = FISBROKER_HARVESTER_CONFIG['url']
+
+
+class TestSplitRecords:
+    '''Tests for splitting GetRecordById responses into individual records.'''
+
+    def test_split_multi_record_response(self):
+        '''A response with several records should be split into one
+           XML document per GUID.'''
+
+        response = merge_records([
+            RESPONSES['records'][VALID_GUID],
+            RESPONSES['records'][INVALID_GUID],
+        ])
+        records = split_records(response)
+        _assert_equal(sorted(records.keys()), sorted([VALID_GUID, INVALID_GUID]))
+        for guid, record_xml in records.items():
+            record = etree.fromstring(record_xml)
+            _assert_equal(record.tag, '{http://www.isotc211.org/2005/gmd}MD_Metadata')
+            assert guid in record_xml
+
+    def test_split_empty_response(self):
+        '''A response without records should result in an empty dict.'''
+
+        _assert_equal(split_records(RESPONSES['no_record_found']), {})
+
+
+class TestParseModifiedDates:
+    '''Tests for extracting modification dates from CSW responses.'''
+
+    def test_modified_dates_of_iso_records(self):
+        '''Every ISO record should be mapped to its dateStamp.'''
+
+        response = merge_records([
+            RESPONSES['records'][VALID_GUID],
+            RESPONSES['records'][INVALID_GUID],
+        ])
+        modified_dates = parse_modified_dates(response)
+        _assert_equal(sorted(modified_dates.keys()), sorted([VALID_GUID, INVALID_GUID]))
+        for modified in modified_dates.values():
+            assert modified
+
+
+class TestIterModifiedDates:
+    '''Tests for paging through the modification dates of all records.'''
+
+    def test_all_records_are_listed(self):
+        '''Every record of the service should be listed, and paging should stop
+           when the server doesn't advance nextRecord.'''
+
+        pages = list(iter_modified_dates(CSW_URL, page_size=10))
+        _assert_equal(len(pages), 1)
+        _assert_equal(sorted(pages[0].keys()), [
+            '8a7ea996-7955-4fbb-8980-7be09be6f193',
+            'aac23975-94e4-3707-96fa-e447e43d6013',
+            'f2a8a483-74b9-3c7d-9b40-113c60a55c9e',
+        ])
+
+
+class TestGetModifiedDates:
+    '''Tests for requesting the modification dates of some records.'''
+
+    def test_modified_dates_of_requested_records(self):
+        '''Only the requested records that the service knows should be
+           mapped to their modification dates.'''
+
+        modified_dates = get_modified_dates(CSW_URL, [VALID_GUID, 'unknown-guid'])
+        _assert_equal(modified_dates, {VALID_GUID: METADATA_NOW})
+
+
+class TestSession:
+    '''Tests for the HTTP session shared by all requests to FIS-Broker.'''
+
+    def teardown(self):
+        configure_session()
+
+    def test_session_is_shared(self):
+        '''get_session() should always return the same session.'''
+
+        assert get_session() is get_session()
+
+    def test_configure_session(self):
+        '''configure_session() should replace the shared session with one
+           using the given settings.'''
+
+        old_session = get_session()
+        session = configure_session(pool_size=3, max_retries=5)
+        assert session is not old_session
+        assert get_session() is session
+        adapter = session.get_adapter(CSW_URL)
+        _assert_equal(adapter._pool_maxsize, 3)
+        _assert_equal(adapter.max_retries.total, 5)
+        _assert_equal(session.headers['Accept-Encoding'], 'gzip, deflate')
+
+
+class TestCapabilitiesCache:
+    '''Tests for caching the capabilities of CSW services.'''
+
+    def test_cached_capabilities_are_reused(self):
+        '''The second client for the same URL should be built from the cached
+           capabilities of the first one.'''
+
+        cache = CapabilitiesCache()
+        first_csw = catalogue_service(CSW_URL, cache=cache)
+        assert cache.get(CSW_URL)
+        second_csw = catalogue_service(CSW_URL, cache=cache)
+        assert second_csw is not first_csw
+        assert second_csw.operations is first_csw.operations
+        _assert_equal(second_csw.identification, first_csw.identification)
+
+    def test_expired_capabilities_are_dropped(self):
+        '''Capabilities older than the TTL should not be returned.'''
+
+        cache = CapabilitiesCache(ttl=-1)
+        catalogue_service(CSW_URL, cache=cache)
+        _assert_equal(cache.get(CSW_URL), None)
+
+    def test_invalidate(self):
+        '''Invalidated capabilities should not be returned.'''
+
+        cache = CapabilitiesCache()
+        catalogue_service(CSW_URL, cache=cache)
+        cache.invalidate(CSW_URL)
+        _assert_equal(cache.get(CSW_URL), None)
+
+
+class TestBatchedRecordFetcher:
+    '''Tests for fetching several records per GetRecordById request.'''
+
+    def test_fetch_batch(self):
+        '''All requested GUIDs should be in the result, GUIDs unknown
+           to FIS-Broker should be mapped to None.'''
+
+        fetcher = BatchedRecordFetcher(CSW_URL, batch_size=3)
+        records = fetcher.fetch([VALID_GUID, INVALID_GUID, 'unknown-guid'])
+        _assert_equal(sorted(records.keys()), sorted([VALID_GUID, INVALID_GUID, 'unknown-guid']))
+        assert VALID_GUID in records[VALID_GUID]
+        assert INVALID_GUID in records[INVALID_GUID]
+        _assert_equal(records['unknown-guid'], None)
+
+
+class TestRecordFetchPipeline:
+    '''Tests for the concurrent record fetcher used for reimports.'''
+
+    def test_all_items_are_fetched(self):
+        '''Every requested item should be returned exactly once, with the record
+           if FIS-Broker knows the guid, and without the record if not.'''
+
+        items = [
+            ('package-a', VALID_GUID),
+            ('package-b', INVALID_GUID),
+            ('package-c', 'unknown-guid'),
+        ]
+        fetcher = BatchedRecordFetcher(CSW_URL, batch_size=2)
+        pipeline = RecordFetchPipeline(fetcher, workers=2, queue_size=1)
+        results = {package_id: (fb_guid, record_xml, error)
+                   for package_id, fb_guid, record_xml, _, error in pipeline.records(items)}
+
+        _assert_equal(sorted(results.keys()), ['package-a', 'package-b', 'package-c'])
+        for package_id, (fb_guid, record_xml, error) in results.items():
+            _assert_equal(error, None)
+            if package_id == 'package-c':
+                _assert_equal(record_xml, None)
+            else:
+                assert fb_guid in record_xml
+
+    def test_connection_errors_are_returned(self):
+        '''Errors raised while fetching should be handed to the consumer
+           instead of being swallowed by the worker.'''
+
+        items = [('package-a', VALID_GUID)]
+        fetcher = BatchedRecordFetcher("http://somewhere.over.the.ra.invalid/csw")
+        pipeline = RecordFetchPipeline(fetcher)
+        results = list(pipeline.records(items))
+
+        _assert_equal(len(results), 1)
+        package_id, fb_guid, record_xml, from_cache, error = results[0]
+        _assert_equal(record_xml, None)
+        assert isinstance(error, RequestException)
+
+    def test_deadline_stops_iteration(self):
+        '''Once the deadline has passed, no more records should be returned.'''
+
+        items = [('package-a', VALID_GUID), ('package-b', INVALID_GUID)]
+        pipeline = RecordFetchPipeline(BatchedRecordFetcher(CSW_URL, batch_size=1))
+        _assert_equal(list(pipeline.records(items, deadline=time.time() - 1)), [])
+
+    def test_no_items_means_no_results(self):
+        '''An empty list of items should not start any fetches.'''
+
+        pipeline = RecordFetchPipeline(BatchedRecordFetcher(CSW_URL))
+        _assert_equal(list(pipeline.records([])), [])
@@ -7,22 +7,51 @@ import copy
 from ckan.logic import get_action
 from ckan.model.package import Package
 from ckan.tests import factories as ckan_factories
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
 
 from ckanext.fisbroker.helper import (
     normalize_url,
+    ParsedUrlCache,
     uniq_resources_by_url,
     is_fisbroker_package,
     dataset_was_harvested,
     harvester_for_package,
     fisbroker_guid,
     get_package_object,
+    record_cache_hits,
+    resolve_fisbroker_packages,
+    _harvest_info,
+    _request_memo,
 )
+from ckanext.fisbroker.exceptions import (
+    PackageIdDoesNotExistError,
+    PackageNotHarvestedError,
+    NoFisbrokerIdError,
+)
+from ckanext.fisbroker.model import FisbrokerPackage, populate_package_index
 from ckanext.fisbroker.tests import _assert_equal, FisbrokerTestBase, FISBROKER_HARVESTER_CONFIG
+from ckanext.fisbroker.tests.mock_fis_broker import VALID_GUID
 
 LOG = logging.getLogger(__name__)
 GETCAPABILITIES_URL_1 = 'https://fbinter.stadt-berlin.de/fb/wfs/data/senstadt/s01_11_07naehr2015?request=getcapabilities&service=wfs&version=2.0.0'
 GETCAPABILITIES_URL_2 = 'https://fbinter.stadt-berlin.de/fb/wfs/data/senstadt/s01_11_07naehr2015?service=wfs&version=2.0.0&request=GetCapabilities'
 
+class TestParsedUrlCache:
+    """Tests for the LRU cache of parsed URLs."""
+
+    def test_least_recently_used_url_is_evicted(self):
+        """The cache should return normalized URLs and drop the least recently
+           used one when it grows beyond max_size."""
+
+        cache = ParsedUrlCache(max_size=2)
+        _assert_equal(cache.normalize(GETCAPABILITIES_URL_1), normalize_url(GETCAPABILITIES_URL_1))
+        cache.normalize(GETCAPABILITIES_URL_2)
+        cache.normalize(GETCAPABILITIES_URL_1)
+        cache.normalize('https://www.stadtentwicklung.berlin.de/')
+        _assert_equal(list(cache._urls.keys()),
+                      [GETCAPABILITIES_URL_1, 'https://www.stadtentwicklung.berlin.de/'])
+
+
 class TestHelper(FisbrokerTestBase):
     """Test functionality of ckanext.fisbroker.helper"""
 
@@ -107,3 +136,87 @@ class TestHelper(FisbrokerTestBase):
 
         _assert_equal(fisbroker_guid(get_package_object(fb_dataset_dict)), fisbroker_fixture['object_id'])
         assert not fisbroker_guid(get_package_object(non_fb_dataset_dict))
+
+    def test_import_updates_package_index(self):
+        '''Importing a record should create an index entry for its package.'''
+
+        fisbroker_fixture = {
+            'title': 'FIS-Broker',
+            'name': 'fisbroker',
+            'url': u'http://127.0.0.1:8999/wfs-open-data.xml',
+            'object_id': u'65715c6e-bbaf-3def-982b-3b5156272da7',
+            'source_type': u'fisbroker'
+        }
+        source, job = self._create_source_and_job(fisbroker_fixture)
+        harvest_object = self._run_job_for_single_document(job, fisbroker_fixture['object_id'])
+
+        entry = FisbrokerPackage.get(harvest_object.package_id)
+        _assert_equal(entry.guid, fisbroker_fixture['object_id'])
+        _assert_equal(entry.source_id, source.id)
+        _assert_equal(entry.source_type, u'fisbroker')
+        _assert_equal(entry.status, 'added')
+        assert entry.content_digest
+
+    def test_record_cache_hits(self):
+        '''Only the objects marked as record cache hits should be counted, for
+           a job object as well as for a dictized job.'''
+
+        source, job = self._create_source_and_job()
+        for guid, extras in [('guid-a', [HarvestObjectExtra(key='record_cache', value='hit')]),
+                             ('guid-b', [])]:
+            HarvestObject(guid=guid, job=job, extras=extras).save()
+
+        _assert_equal(record_cache_hits(job), 1)
+        _assert_equal(record_cache_hits({'id': job.id}), 1)
+
+    def test_populate_package_index(self):
+        '''Populating the index should add all packages harvested so far.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        _assert_equal(FisbrokerPackage.get(fb_dataset_dict['id']), None)
+
+        populate_package_index()
+
+        entry = FisbrokerPackage.get(fb_dataset_dict['id'])
+        _assert_equal(entry.guid, VALID_GUID)
+        _assert_equal(entry.source_id, source.id)
+        assert harvester_for_package(Package.get(fb_dataset_dict['id'])) is source
+
+    def test_harvest_info(self):
+        '''The harvest info should hold the GUID, source id and source type,
+           and there should be no memo outside of a request.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        _assert_equal(_harvest_info(get_package_object(fb_dataset_dict)),
+                      (VALID_GUID, source.id, u'fisbroker'))
+        _assert_equal(_harvest_info(get_package_object(ckan_factories.Dataset())), None)
+        _assert_equal(_request_memo(), None)
+
+    def test_resolve_fisbroker_packages(self):
+        """Reimportable packages should be resolved to their GUID and harvest source,
+           all others should be reported with the matching error."""
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        non_fb_dataset_dict = ckan_factories.Dataset()
+        package_ids = [fb_dataset_dict['name'], non_fb_dataset_dict['id'], 'dunk']
+
+        mapping, errors = resolve_fisbroker_packages(package_ids)
+
+        _assert_equal(mapping.keys(), [fb_dataset_dict['id']])
+        package_info = mapping[fb_dataset_dict['id']]
+        _assert_equal(package_info['fb_guid'], VALID_GUID)
+        _assert_equal(package_info['source_id'], source.id)
+        _assert_equal(package_info['source_url'], source.url)
+        _assert_equal(sorted(errors.keys()), sorted([non_fb_dataset_dict['id'], 'dunk']))
+        assert isinstance(errors[non_fb_dataset_dict['id']], PackageNotHarvestedError)
+        assert isinstance(errors['dunk'], PackageIdDoesNotExistError)
+
+    def test_resolve_fisbroker_package_without_guid(self):
+        """A FIS-Broker package without a GUID cannot be resolved."""
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG, fb_guid=None)
+
+        mapping, errors = resolve_fisbroker_packages([fb_dataset_dict['id']])
+
+        _assert_equal(mapping, {})
+        assert isinstance(errors[fb_dataset_dict['id']], NoFisbrokerIdError)
@@ -0,0 +1,57 @@
+# coding: utf-8
+"""Tests for ckanext.fisbroker.iso_values.py"""
+
+import logging
+import os
+
+from ckanext.spatial.model import ISODocument
+
+from ckanext.fisbroker.iso_values import (
+    FisbrokerISOValues,
+    INFERRED_FIELDS,
+    ISO_FIELDS,
+)
+from ckanext.fisbroker.tests import _assert_equal
+
+LOG = logging.getLogger(__name__)
+XML_FIXTURES = [
+    'dataset-open-data.xml',
+    'wfs-closed-data.xml',
+    'wfs-no-email.xml',
+    'wfs-no-release-date.xml',
+    'wfs-no-responsible-party.xml',
+    'wfs-open-data.xml',
+]
+
+
+def _open_xml_fixture(xml_filename):
+    xml_filepath = os.path.join(os.path.dirname(__file__), 'xml', xml_filename)
+    with open(xml_filepath, 'rb') as f:
+        return f.read()
+
+
+class TestFisbrokerISOValues:
+    '''Tests for the extractor of the ISO values used by FisbrokerPlugin.'''
+
+    def test_same_values_as_iso_document(self):
+        '''Every field should have the same value as read by ckanext-spatial's
+           ISODocument.'''
+
+        for xml_filename in XML_FIXTURES:
+            content = _open_xml_fixture(xml_filename)
+            expected = ISODocument(content).read_values()
+            iso_values = FisbrokerISOValues(content)
+            for name in list(ISO_FIELDS) + list(INFERRED_FIELDS):
+                _assert_equal(iso_values[name], expected[name])
+
+    def test_fields_are_read_lazily(self):
+        '''Fields should only be read when they are accessed, and unknown
+           fields should not be available.'''
+
+        iso_values = FisbrokerISOValues(_open_xml_fixture('wfs-open-data.xml'))
+        _assert_equal(iso_values._values, {})
+        _assert_equal(iso_values['resource-type'], ['service'])
+        _assert_equal(iso_values._values.keys(), ['resource-type'])
+        assert 'tags' in iso_values
+        assert 'abstract' not in iso_values
+        _assert_equal(iso_values.get('abstract'), None)
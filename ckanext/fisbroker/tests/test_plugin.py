@@ -1,31 +1,49 @@
 # coding: utf-8
 """Tests for plugin.py."""
 
-from datetime import timedelta
+from datetime import datetime, timedelta
+import json
 import logging
 import os
+from tempfile import NamedTemporaryFile
+from dateutil.parser import parse
 from nose.tools import assert_raises
 
 from owslib.fes import PropertyIsGreaterThanOrEqualTo
 
 from ckan.logic import get_action
 from ckan.logic.action.update import package_update
+from ckan.model import Session
 
 from ckanext.harvest.queue import (
     gather_stage ,
     fetch_and_import_stages ,
 )
 from ckanext.harvest.model import (
+    HarvestGatherError ,
     HarvestObject ,
+    HarvestObjectExtra ,
 )
 
 from ckanext.spatial.harvesters.base import SpatialHarvester
 from ckanext.spatial.model import ISODocument
 
+from ckanext.fisbroker.fisbroker_resource_annotator import configure_resource_rules
+from ckanext.fisbroker.iso_values import FisbrokerISOValues
+from ckanext.fisbroker.model import (
+    FisbrokerRejection,
+    FisbrokerWatermark,
+    advance_watermark,
+    record_watermark_candidate,
+)
 from ckanext.fisbroker.plugin import (
     FisbrokerPlugin,
+    check_record,
+    content_digest,
     marked_as_opendata,
     marked_as_service_resource,
+    prefilter_record,
+    scan_record,
     filter_tags,
     extract_license_and_attribution,
     extract_reference_dates,
@@ -35,7 +53,12 @@ from ckanext.fisbroker.plugin import (
     TIMEOUT_DEFAULT,
     TIMEDELTA_DEFAULT,
 )
-from ckanext.fisbroker.tests import FisbrokerTestBase, _assert_equal
+from ckanext.fisbroker.tests import (
+    FisbrokerTestBase,
+    _assert_equal,
+    _assert_not_equal,
+    FISBROKER_HARVESTER_CONFIG,
+)
 from ckanext.fisbroker.tests.mock_fis_broker import reset_mock_server
 
 LOG = logging.getLogger(__name__)
@@ -57,7 +80,12 @@ class TestTransformationHelpers(FisbrokerTestBase):
         '''Return an example open data dataset as expected as input
            to get_package_dict().'''
 
-        xml_string = self._open_xml_fixture(dataset_name)
+        return self._iso_data_dict(self._open_xml_fixture(dataset_name))
+
+    def _iso_data_dict(self, xml_string):
+        '''Return the input to get_package_dict() for the ISO record
+           `xml_string`.'''
+
         iso_document = ISODocument(xml_string)
         iso_values = iso_document.read_values()
         base_harvester = SpatialHarvester()
@@ -201,6 +229,128 @@ class TestTransformationHelpers(FisbrokerTestBase):
         data_dict = self._csw_resource_data_dict('dataset-open-data.xml')
         _assert_equal(FisbrokerPlugin().get_package_dict(self.context, data_dict), 'skip')
 
+    def test_prefilter_record(self):
+        '''Test that prefilter_record() rejects closed data and dataset
+           resources with the same errors as get_package_dict(), and lets
+           open data service resources pass.'''
+
+        def prefilter(xml_filename):
+            return prefilter_record(FisbrokerISOValues(self._open_xml_fixture(xml_filename)))
+
+        _assert_equal(prefilter('wfs-closed-data.xml'),
+                      {'code': 1, 'description': 'not tagged as open data'})
+        _assert_equal(prefilter('dataset-open-data.xml'),
+                      {'code': 2, 'description': 'not a service resource'})
+        _assert_equal(prefilter('wfs-open-data.xml'), None)
+
+    def test_scan_record(self):
+        '''Test that the streaming scan_record() rejects closed data and
+           dataset resources with the same errors as prefilter_record(), and
+           lets open data service resources pass.'''
+
+        for xml_filename in ['wfs-closed-data.xml', 'dataset-open-data.xml',
+                             'wfs-open-data.xml', 'wfs-no-license.xml']:
+            content = self._open_xml_fixture(xml_filename)
+            _assert_equal(scan_record(content),
+                          prefilter_record(FisbrokerISOValues(content)))
+        _assert_equal(scan_record('<gmd:MD_Metadata'), None)
+
+    def test_prefilter_record_reads_iso_values_only(self):
+        '''Test that prefilter_record() and scan_record() only find keywords
+           and hierarchy levels where ISODocument looks for them: keywords
+           outside the identification section, keywords with surrounding
+           whitespace and nested hierarchy levels don't count, and neither do
+           the descriptive keywords of the service identification if the data
+           identification has keywords.'''
+
+        def assert_rejected(content, code):
+            expected = prefilter_record(ISODocument(content).read_values())
+            _assert_equal(expected['code'], code)
+            _assert_equal(prefilter_record(FisbrokerISOValues(content)), expected)
+            _assert_equal(scan_record(content), expected)
+            _assert_equal(check_record(content), expected)
+
+        gco = 'xmlns:gco="http://www.isotc211.org/2005/gco"'
+        outside_keyword = (
+            '<gmd:metadataExtensionInfo><gmd:MD_Keywords><gmd:keyword>'
+            '<gco:CharacterString {}>opendata</gco:CharacterString>'
+            '</gmd:keyword></gmd:MD_Keywords></gmd:metadataExtensionInfo>'
+            '</gmd:MD_Metadata>').format(gco)
+        closed_data = self._open_xml_fixture('wfs-closed-data.xml').replace(
+            '</gmd:MD_Metadata>', outside_keyword)
+        assert_rejected(closed_data, 1)
+
+        padded_keyword = self._open_xml_fixture('wfs-open-data.xml').replace(
+            '>opendata<', '> opendata <')
+        assert_rejected(padded_keyword, 1)
+
+        data_keyword = (
+            '<gmd:identificationInfo><gmd:MD_DataIdentification><gmd:descriptiveKeywords>'
+            '<gmd:MD_Keywords><gmd:keyword><gco:CharacterString {}>geodata</gco:CharacterString>'
+            '</gmd:keyword></gmd:MD_Keywords></gmd:descriptiveKeywords>'
+            '</gmd:MD_DataIdentification></gmd:identificationInfo>'
+            '</gmd:MD_Metadata>').format(gco)
+        overridden_keyword = self._open_xml_fixture('wfs-open-data.xml').replace(
+            '</gmd:MD_Metadata>', data_keyword)
+        assert_rejected(overridden_keyword, 1)
+
+        nested_level = (
+            '<gmd:series><gmd:hierarchyLevel>'
+            '<gmd:MD_ScopeCode codeListValue="service"/>'
+            '</gmd:hierarchyLevel></gmd:series></gmd:MD_Metadata>')
+        dataset = self._open_xml_fixture('dataset-open-data.xml').replace(
+            '</gmd:MD_Metadata>', nested_level)
+        assert_rejected(dataset, 2)
+
+    def test_check_record(self):
+        '''Test that check_record() rejects records with the same errors as
+           get_package_dict(), and lets complete open data service resources
+           pass.'''
+
+        expected_codes = {
+            'wfs-closed-data.xml': 1,
+            'dataset-open-data.xml': 2,
+            'wfs-no-org-name.xml': 3,
+            'wfs-no-email.xml': 4,
+            'wfs-no-license.xml': 5,
+            'wfs-no-release-date.xml': 6,
+        }
+        for xml_filename, code in expected_codes.items():
+            _assert_equal(check_record(self._open_xml_fixture(xml_filename))['code'], code)
+        _assert_equal(check_record(self._open_xml_fixture('wfs-open-data.xml')), None)
+
+    def test_check_record_matches_get_package_dict(self):
+        '''Test that check_record() reports the same error as get_package_dict()
+           does for the values read by ISODocument, for every record both as a
+           service identification and as a data identification, as the
+           rejections of check_record() are persisted like those of
+           get_package_dict().'''
+
+        xml_filenames = [
+            'dataset-open-data.xml',
+            'wfs-closed-data.xml',
+            'wfs-no-email.xml',
+            'wfs-no-license.xml',
+            'wfs-no-org-name.xml',
+            'wfs-no-preview_1.xml',
+            'wfs-no-release-date.xml',
+            'wfs-no-responsible-party.xml',
+            'wfs-open-data.xml',
+        ]
+        for xml_filename in xml_filenames:
+            xml_string = self._open_xml_fixture(xml_filename)
+            data_identification = xml_string.replace(
+                'srv:SV_ServiceIdentification', 'gmd:MD_DataIdentification')
+            for content in set([xml_string, data_identification]):
+                context = dict(self.context)
+                package_dict = FisbrokerPlugin().get_package_dict(
+                    context, self._iso_data_dict(content))
+                if package_dict == 'skip':
+                    expected = json.loads(context['error'])
+                else:
+                    expected = None
+                _assert_equal(check_record(content), expected)
+
     def test_skip_on_missing_responsible_organisation(self):
         '''Test if get_package_dict() returns 'skip' for a service resource
            without any information of the responsible party.'''
@@ -481,6 +631,129 @@ class TestPlugin(FisbrokerTestBase):
             "nahrstoffversorgung-des-oberbodens-2015-umweltatlas-wfs-65715c6e", package_dict['name']
         )
 
+    def test_content_digest_ignores_formatting(self):
+        '''Reformatting a record without changing its content should not change
+           its digest.'''
+
+        digest = content_digest('<a xmlns="urn:x" y="1" z="2"><b>text</b></a>')
+        _assert_equal(content_digest('<a z="2" y="1" xmlns="urn:x">\n  <b>text</b>\n</a>'), digest)
+        _assert_not_equal(content_digest('<a xmlns="urn:x" y="1" z="2"><b>other</b></a>'), digest)
+
+    def test_content_digest_covers_settings(self):
+        '''Changing the resource rules or the harvest source config should
+           change the digest of a record.'''
+
+        content = '<a xmlns="urn:x"><b>text</b></a>'
+        digest = content_digest(content)
+        _assert_not_equal(content_digest(content, '{"default_tags": ["x"]}'), digest)
+        try:
+            rules = [{'host': 'example.com', 'format': 'HTML'}]
+            with NamedTemporaryFile() as rules_file:
+                rules_file.write(json.dumps(rules))
+                rules_file.flush()
+                configure_resource_rules(rules_file.name)
+            _assert_not_equal(content_digest(content), digest)
+        finally:
+            configure_resource_rules()
+        _assert_equal(content_digest(content), digest)
+
+    def test_unchanged_record_is_not_imported_again(self):
+        '''A changed record with the same content digest as the current harvest
+           object should be skipped, unless force_import is set.'''
+
+        wfs_fixture = {
+            'title': 'Test Source',
+            'name': 'test-source',
+            'url': u'http://127.0.0.1:8999/wfs-open-data.xml',
+            'object_id': u'65715c6e-bbaf-3def-982b-3b5156272da7',
+            'source_type': u'fisbroker'
+        }
+        source, job = self._create_source_and_job(wfs_fixture)
+        first_object = self._run_job_for_single_document(job, wfs_fixture['object_id'])
+        digests = [extra.value for extra in first_object.extras if extra.key == 'content_digest']
+        _assert_equal(digests, [content_digest(first_object.content, source.config)])
+
+        harvester = FisbrokerPlugin()
+        second_job = self._create_job(source.id)
+        second_object = HarvestObject(guid=wfs_fixture['object_id'],
+                                      job=second_job,
+                                      content=first_object.content,
+                                      extras=[HarvestObjectExtra(key='status', value='change')])
+        second_object.save()
+        _assert_equal(harvester.import_stage(second_object), 'unchanged')
+        Session.refresh(second_object)
+        _assert_equal(second_object.report_status, 'not modified')
+        _assert_equal(second_object.current, True)
+        _assert_equal(second_object.package_id, first_object.package_id)
+
+        third_object = HarvestObject(guid=wfs_fixture['object_id'],
+                                     job=second_job,
+                                     content=first_object.content,
+                                     extras=[HarvestObjectExtra(key='status', value='change')])
+        third_object.save()
+        harvester.force_import = True
+        try:
+            result = harvester.import_stage(third_object)
+        finally:
+            harvester.force_import = False
+        _assert_not_equal(result, 'unchanged')
+
+    def test_brief_gather_creates_objects_for_new_records(self):
+        '''A brief gather should create a harvest object for every record
+           listed by FIS-Broker that wasn't harvested before.'''
+
+        source_fixture = dict(FISBROKER_HARVESTER_CONFIG)
+        source_fixture['config'] = json.dumps({'gather_mode': 'brief'})
+        source, job = self._create_source_and_job(source_fixture)
+        object_ids = FisbrokerPlugin().gather_stage(job)
+
+        _assert_equal(len(object_ids), 3)
+        for object_id in object_ids:
+            harvest_object = HarvestObject.get(object_id)
+            statuses = [extra.value for extra in harvest_object.extras if extra.key == 'status']
+            _assert_equal(statuses, ['new'])
+
+    def test_brief_gather_skips_rejected_records(self):
+        '''A brief gather should skip records that were rejected in the same
+           version before, and drop the rejections of modified records.'''
+
+        source_fixture = dict(FISBROKER_HARVESTER_CONFIG)
+        source_fixture['config'] = json.dumps({'gather_mode': 'brief'})
+        source, job = self._create_source_and_job(source_fixture)
+        modified = {}
+        for object_id in FisbrokerPlugin().gather_stage(job):
+            harvest_object = HarvestObject.get(object_id)
+            modified[harvest_object.guid] = [extra.value for extra in harvest_object.extras
+                                             if extra.key == 'modified'][0]
+        rejected_guid, modified_guid = sorted(modified)[:2]
+        Session.add(FisbrokerRejection(guid=rejected_guid, source_id=source.id,
+                                       modified=modified[rejected_guid], code=1,
+                                       description=u'not tagged as open data'))
+        Session.add(FisbrokerRejection(guid=modified_guid, source_id=source.id,
+                                       modified=u'2000-01-01T00:00:00', code=1,
+                                       description=u'not tagged as open data'))
+        Session.commit()
+
+        second_job = self._create_job(source.id)
+        guids = [HarvestObject.get(object_id).guid
+                 for object_id in FisbrokerPlugin().gather_stage(second_job)]
+        assert rejected_guid not in guids
+        assert modified_guid in guids
+        assert FisbrokerRejection.get(rejected_guid)
+        _assert_equal(FisbrokerRejection.get(modified_guid), None)
+
+    def test_modified_since(self):
+        '''Records should only count as modified if their modification date is
+           newer than the harvested one, or if one of the dates is unknown.'''
+
+        harvester = FisbrokerPlugin()
+        harvested = parse("2019-11-25T13:18:43")
+        _assert_equal(harvester._modified_since("2019-11-25T13:18:43", harvested), False)
+        _assert_equal(harvester._modified_since("2019-11-24", harvested), False)
+        _assert_equal(harvester._modified_since("2019-11-26", harvested), True)
+        _assert_equal(harvester._modified_since(None, harvested), True)
+        _assert_equal(harvester._modified_since("2019-11-24", None), True)
+
     def test_empty_config(self):
         '''Test that an empty config just returns unchanged.'''
         _assert_equal(FisbrokerPlugin().validate_config(None), None)
@@ -581,12 +854,14 @@ class TestPlugin(FisbrokerTestBase):
         last_error_free_job = FisbrokerPlugin().last_error_free_job(new_job)
         _assert_equal(last_error_free_job, job)
 
-        # the import_since date should be the time job_a finished:
+        # the import_since date should be the watermark set by job, once
+        # the gather stage of new_job has promoted its candidate:
         FisbrokerPlugin().source_config['import_since'] = "last_error_free"
+        FisbrokerPlugin().advance_watermark(new_job)
         import_since = FisbrokerPlugin().get_import_since_date(new_job)
-        import_since_expected = (job.gather_started +
-                                 timedelta(hours=FisbrokerPlugin().get_timedelta()))
-        _assert_equal(import_since, import_since_expected.strftime("%Y-%m-%dT%H:%M:%S%z"))
+        import_since_expected = max(obj.metadata_modified_date for obj in job.objects)
+        _assert_equal(import_since, import_since_expected.strftime("%Y-%m-%dT%H:%M:%S"))
+        _assert_equal(FisbrokerWatermark.get(source.id).job_id, job.id)
 
         # the query constraints should reflect the import_since date:
         constraint = FisbrokerPlugin().get_constraints(new_job)[0]
@@ -623,12 +898,13 @@ class TestPlugin(FisbrokerTestBase):
         # job_a should be the last error free job:
         _assert_equal(last_error_free_job, job_a)
 
-        # the import_since date should be the time job_a finished:
+        # the import_since date should be the watermark set by job_a:
         FisbrokerPlugin().source_config['import_since'] = "last_error_free"
+        FisbrokerPlugin().advance_watermark(new_job)
         import_since = FisbrokerPlugin().get_import_since_date(new_job)
-        import_since_expected = (job_a.gather_started +
-                                 timedelta(hours=FisbrokerPlugin().get_timedelta()))
-        _assert_equal(import_since, import_since_expected.strftime("%Y-%m-%dT%H:%M:%S%z"))
+        import_since_expected = max(obj.metadata_modified_date for obj in job_a.objects)
+        _assert_equal(import_since, import_since_expected.strftime("%Y-%m-%dT%H:%M:%S"))
+        _assert_equal(FisbrokerWatermark.get(source.id).job_id, job_a.id)
 
         # the query constraints should reflect the import_since date:
         constraint = FisbrokerPlugin().get_constraints(new_job)[0]
@@ -683,6 +959,68 @@ class TestPlugin(FisbrokerTestBase):
         # job_a should be the last error free job:
         _assert_equal(last_error_free_job.id, job_a.id)
 
+    def test_last_error_free_job_is_recomputed_when_job_finishes(self):
+        '''The memoised last error-free job should be replaced as soon as
+           another job of the source finishes.'''
+
+        source, job_a = self._create_source_and_job()
+        job_a.gather_started = datetime.utcnow() - timedelta(hours=1)
+        job_a.status = u'Finished'
+        job_a.save()
+
+        new_job = self._create_job(source.id)
+        _assert_equal(FisbrokerPlugin().last_error_free_job(new_job).id, job_a.id)
+
+        new_job.gather_started = datetime.utcnow()
+        new_job.status = u'Finished'
+        new_job.save()
+
+        newest_job = self._create_job(source.id)
+        _assert_equal(FisbrokerPlugin().last_error_free_job(newest_job).id, new_job.id)
+
+    def test_watermark_never_moves_backwards(self):
+        '''Advancing the watermark to an older date should leave it unchanged.'''
+
+        source = self._create_source()
+        _assert_equal(advance_watermark(source.id, parse("2019-11-25T13:18:43"), u'job-a'), True)
+        _assert_equal(advance_watermark(source.id, parse("2019-11-24T00:00:00"), u'job-b'), False)
+        watermark = FisbrokerWatermark.get(source.id)
+        _assert_equal(watermark.modified, parse("2019-11-25T13:18:43"))
+        _assert_equal(watermark.job_id, u'job-a')
+
+    def test_watermark_candidate_of_error_free_job_is_promoted(self):
+        '''The watermark candidate of a finished error-free job should become
+           the watermark at the next gather, and be dropped afterwards.'''
+
+        source, job = self._create_source_and_job()
+        record_watermark_candidate(source.id, job.id, parse("2019-11-25T13:18:43"))
+        record_watermark_candidate(source.id, job.id, parse("2019-11-24T00:00:00"))
+        job.status = u'Finished'
+        job.save()
+
+        new_job = self._create_job(source.id)
+        watermark = FisbrokerPlugin().advance_watermark(new_job)
+        _assert_equal(watermark.modified, parse("2019-11-25T13:18:43"))
+        _assert_equal(watermark.job_id, job.id)
+        _assert_equal(watermark.pending_job_id, None)
+
+    def test_watermark_candidate_of_failed_job_is_dropped(self):
+        '''The watermark candidate of a job with errors should be dropped
+           without advancing the watermark.'''
+
+        source, job = self._create_source_and_job()
+        advance_watermark(source.id, parse("2019-11-23T13:18:43"), u'job-a')
+        record_watermark_candidate(source.id, job.id, parse("2019-11-25T13:18:43"))
+        HarvestGatherError(message=u'dunk', job=job).save()
+        job.status = u'Finished'
+        job.save()
+
+        new_job = self._create_job(source.id)
+        watermark = FisbrokerPlugin().advance_watermark(new_job)
+        _assert_equal(watermark.modified, parse("2019-11-23T13:18:43"))
+        _assert_equal(watermark.job_id, u'job-a')
+        _assert_equal(watermark.pending_job_id, None)
+
     def test_import_since_date_is_none_if_no_jobs(self):
         '''Test that, if the `import_since` setting is `last_error_free`, but
         no jobs have run successfully (or at all), get_import_since_date()
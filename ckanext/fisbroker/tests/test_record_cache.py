@@ -0,0 +1,81 @@
+# coding: utf-8
+"""Tests for ckanext.fisbroker.record_cache.py"""
+
+import logging
+import os
+import shutil
+import tempfile
+
+from ckanext.fisbroker.csw_client import BatchedRecordFetcher, parse_modified_dates
+from ckanext.fisbroker.record_cache import RecordCache
+from ckanext.fisbroker.tests import _assert_equal, FISBROKER_HARVESTER_CONFIG
+from ckanext.fisbroker.tests.mock_fis_broker import VALID_GUID
+
+LOG = logging.getLogger(__name__)
+
+
+class TestRecordCache:
+    '''Tests for the on-disk record cache.'''
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_put(self):
+        '''A record should only be returned for the modification date it was
+           stored with.'''
+
+        cache = RecordCache(self.directory)
+        cache.put(u'guid-a', u'2019-11-25T13:18:43', "<record/>")
+        _assert_equal(cache.get(u'guid-a', u'2019-11-25T13:18:43'), "<record/>")
+        _assert_equal(cache.get(u'guid-a', u'2020-01-01T00:00:00'), None)
+        _assert_equal(cache.get(u'guid-b', u'2019-11-25T13:18:43'), None)
+
+    def test_newer_version_replaces_older(self):
+        '''Storing a newer version of a record should remove the older one.'''
+
+        cache = RecordCache(self.directory)
+        cache.put(u'guid-a', u'2019-11-25T13:18:43', "<old/>")
+        cache.put(u'guid-a', u'2020-01-01T00:00:00', "<new/>")
+        _assert_equal(cache.get(u'guid-a', u'2019-11-25T13:18:43'), None)
+        _assert_equal(cache.get(u'guid-a', u'2020-01-01T00:00:00'), "<new/>")
+        _assert_equal(len(cache._entries()), 1)
+
+    def test_evict_least_recently_used(self):
+        '''Eviction should remove the least recently used records first, until
+           the cache fits into max_size.'''
+
+        cache = RecordCache(self.directory, max_size=0)
+        cache.max_size = 10
+        cache.put(u'guid-a', u'1', "x" * 6)
+        cache.put(u'guid-b', u'1', "x" * 6)
+        path_a = cache._record_path(u'guid-a', u'1')
+        path_b = cache._record_path(u'guid-b', u'1')
+        os.utime(path_a, (1000, 1000))
+        os.utime(path_b, (2000, 2000))
+        cache.evict()
+        _assert_equal(cache.get(u'guid-a', u'1'), None)
+        _assert_equal(cache.get(u'guid-b', u'1'), "x" * 6)
+        assert cache.size() <= 10
+
+    def test_fetcher_reads_through_cache(self):
+        '''A fetched record should be stored with its dateStamp, and the next
+           fetch with that modification date should be served from the cache.
+           Without a known modification date, the cache should not be read.'''
+
+        cache = RecordCache(self.directory)
+        fetcher = BatchedRecordFetcher(FISBROKER_HARVESTER_CONFIG['url'], cache=cache)
+        cache_hits = set()
+        first = fetcher.fetch([VALID_GUID], cache_hits=cache_hits)
+        _assert_equal(cache_hits, set())
+        modified = parse_modified_dates(first[VALID_GUID])[VALID_GUID]
+        _assert_equal(cache.get(VALID_GUID, modified), first[VALID_GUID])
+
+        fetcher.fetch([VALID_GUID], cache_hits=cache_hits)
+        _assert_equal(cache_hits, set())
+        second = fetcher.fetch([VALID_GUID], modified={VALID_GUID: modified},
+                               cache_hits=cache_hits)
+        _assert_equal(cache_hits, set([VALID_GUID]))
+        _assert_equal(second[VALID_GUID], first[VALID_GUID])
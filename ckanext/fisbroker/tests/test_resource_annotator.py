@@ -14,6 +14,8 @@ from ckanext.fisbroker.fisbroker_resource_annotator import (
     FUNCTION_API_DESCRIPTION,
     FUNCTION_WEB_INTERFACE,
     FUNCTION_DOCUMENTATION,
+    DEFAULT_RESOURCE_RULES,
+    compile_resource_rules,
 )
 from ckanext.fisbroker.helper import normalize_url
 from ckanext.fisbroker.tests import _assert_equal
@@ -263,3 +265,40 @@ class TestResourceAnnotator(object):
         ]
 
         _assert_equal(annotated, expected)
+
+    def test_additional_rule_takes_precedence(self):
+        """A rule added in front of the default rules should classify matching
+           URLs, while all other URLs are still classified by the defaults."""
+
+        rules = compile_resource_rules([{
+            'host': 'daten.berlin.de',
+            'path': r'^/datensaetze/',
+            'name': "Datensatz im Datenportal",
+            'format': FORMAT_HTML,
+            'internal_function': FUNCTION_WEB_INTERFACE,
+            'weight': 25,
+        }] + DEFAULT_RESOURCE_RULES)
+        annotator = FISBrokerResourceAnnotator(rules=rules)
+
+        converted_resource = annotator.annotate_resource(
+            {'url': 'https://daten.berlin.de/datensaetze/nsg-lsg'})
+        _assert_equal(converted_resource['name'], "Datensatz im Datenportal")
+        _assert_equal(converted_resource['weight'], 25)
+        converted_resource = annotator.annotate_resource(
+            {'url': 'https://fbinter.stadt-berlin.de/fb/feed/senstadt/a_SU_LOR'})
+        _assert_equal(converted_resource['format'], FORMAT_ATOM)
+        # the additional web interface is not a FIS-Broker service page
+        assert not annotator.is_fis_broker_service_page(
+            'https://daten.berlin.de/datensaetze/nsg-lsg')
+        assert annotator.is_fis_broker_service_page(
+            'https://fbinter.stadt-berlin.de/fb?loginkey=showMap&mapId=nsg_lsg@senstadt')
+
+    def test_invalid_rules_are_rejected(self):
+        """Rules without conditions or with unknown keys should raise an exception."""
+
+        with assert_raises(ValueError):
+            compile_resource_rules([{'name': "Alles"}])
+        with assert_raises(ValueError):
+            compile_resource_rules([{'url': '/wcs/', 'service': 'WCS'}])
+        with assert_raises(ValueError):
+            compile_resource_rules([{'url': '/wcs/', 'colour': 'blue'}])